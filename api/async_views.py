@@ -0,0 +1,199 @@
+from asgiref.sync import sync_to_async
+from django.http import Http404, HttpResponse
+from django.core.exceptions import ValidationError
+from django.utils.cache import get_conditional_response
+from django.contrib.auth.models import AnonymousUser
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework.response import Response
+
+from .principal import aget_principal
+from .instrumentation import timed
+from .replicas import ReplicaReadsMixin, ashould_use_replicas
+from .authentication import CachedTokenAuthentication
+from .views import MarathonViewSet, PaymentViewSet, ConditionalGetMixin, ResponseCacheMixin
+
+
+# Query params handled by the async path, requests with any other
+# (filters, format) go to the sync views
+ASYNC_QUERY_PARAMS = {'cursor', 'query', 'page', 'approximate_count'}
+
+
+class AsyncReadView():
+    """
+    Serve `GET` list or retrieve of a viewset with the async ORM and async
+    token authentication, so that an ASGI worker doesn't tie a thread up
+    while waiting for the database. Other methods and requests the async
+    path doesn't handle are passed to the sync viewset in a thread.
+
+    Permissions, querysets, pagination, serializers, validators and
+    renderers are the ones of the viewset so responses are identical.
+    """
+    def __init__(self, viewset, actions, **initkwargs):
+        self.viewset = viewset
+        self.action = actions['get']
+        self.initkwargs = initkwargs
+        self.sync_view = sync_to_async(viewset.as_view(actions, **initkwargs))
+        self.authenticator = CachedTokenAuthentication()
+
+    def as_view(self):
+        async def view(request, *args, **kwargs):
+            return await self.dispatch(request, *args, **kwargs)
+        return csrf_exempt(view)
+
+    def is_async(self, request):
+        if request.method != 'GET':
+            return False
+        if not set(request.GET) <= ASYNC_QUERY_PARAMS:
+            return False
+        # The browsable API renders forms which query the database
+        return 'text/html' not in request.headers.get('Accept', '')
+
+    def initialize(self, request, kwargs):
+        view = self.viewset(action_map={'get': self.action}, action=self.action, **self.initkwargs)
+        view.args = ()
+        view.kwargs = kwargs
+        view.format_kwarg = None
+        view.headers = view.default_response_headers
+        view.request = view.initialize_request(request, **kwargs)
+        # Don't let DRF authenticate lazily(and synchronously) on `request.user`
+        view.request.user = AnonymousUser()
+        view.request.auth = None
+        return view
+
+    async def authenticate(self, view):
+        request = view.request
+        with timed('auth'):
+            user_auth = await self.authenticator.aauthenticate(request)
+            if user_auth is not None:
+                request.user, request.auth = user_auth
+                # Load group memberships now, permissions read them from the principal
+                await aget_principal(request.user)
+
+    async def initial(self, view):
+        """
+        The steps of `APIView.initial` with async authentication, throttles
+        may sync buckets with a shared cache so they are checked in a thread.
+        """
+        request = view.request
+        view.format_kwarg = view.get_format_suffix(**view.kwargs)
+        neg = view.perform_content_negotiation(request)
+        request.accepted_renderer, request.accepted_media_type = neg
+        request.version, request.versioning_scheme = view.determine_version(request, **view.kwargs)
+        await self.authenticate(view)
+        # Groups were loaded by `authenticate`, permissions don't query
+        view.check_permissions(request)
+        await sync_to_async(view.check_throttles, thread_sensitive=False)(request)
+        if isinstance(view, ReplicaReadsMixin) and await ashould_use_replicas(request):
+            view.enter_replicas()
+
+    async def dispatch(self, request, *args, **kwargs):
+        if not self.is_async(request):
+            return await self.sync_view(request, *args, **kwargs)
+
+        view = self.initialize(request, kwargs)
+        try:
+            await self.initial(view)
+            response = await getattr(self, self.action)(view, **kwargs)
+        except Exception as exc:
+            response = view.handle_exception(exc)
+        return self.finalize_response(view, response)
+
+    def finalize_response(self, view, response):
+        response = view.finalize_response(view.request, response)
+        if not isinstance(response, Response):
+            return response
+        # Render here, Django would render in a thread otherwise
+        with timed('render'):
+            response.render()
+        return HttpResponse(
+            response.content, status=response.status_code, headers=response.headers
+        )
+
+    async def cached_response(self, view, get_response):
+        if not isinstance(view, ResponseCacheMixin):
+            return await get_response()
+
+        response = None
+
+        async def compute():
+            nonlocal response
+            response = await get_response()
+            if response.status_code == 200:
+                return response.data
+            return None
+
+        cache = view.response_cache
+        key = await cache.amake_key(
+            *view.get_response_cache_parts(view.request),
+            generation=await view.aget_cache_generation()
+        )
+        data = await cache.aget_or_compute(key, compute)
+        if response is not None:
+            return response
+        return Response(data)
+
+    async def conditional_response(self, view, state, last_modified, get_response):
+        if not isinstance(view, ConditionalGetMixin):
+            return await get_response()
+
+        request = view.request
+        etag, last_modified = view.get_validators(request, state, last_modified)
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = await get_response()
+        return view.set_validators(response, etag, last_modified)
+
+    async def list(self, view):
+        queryset = view.filter_queryset(view.get_queryset())
+
+        async def get_response():
+            paginator = view.paginator
+            page = await paginator.apaginate_queryset(queryset, view.request, view=view)
+            if page is None:
+                page = [obj async for obj in queryset]
+                return Response(view.get_serializer(page, many=True).data)
+            return paginator.get_paginated_response(view.get_serializer(page, many=True).data)
+
+        state = None
+        if isinstance(view, ConditionalGetMixin):
+            state = await view.aget_list_state(queryset)
+        return await self.conditional_response(
+            view, state, None, lambda: self.cached_response(view, get_response)
+        )
+
+    async def retrieve(self, view, pk):
+        queryset = view.filter_queryset(view.get_queryset())
+        try:
+            bare_object = await queryset.select_related(None).prefetch_related(None).aget(pk=pk)
+        except queryset.model.DoesNotExist:
+            raise Http404(f"No {queryset.model._meta.object_name} matches the given query.")
+        except (TypeError, ValueError, ValidationError):
+            raise Http404
+        view.check_object_permissions(view.request, bare_object)
+
+        async def get_response():
+            obj = await queryset.aget(pk=pk)
+            return Response(view.get_serializer(obj).data)
+
+        last_modified = None
+        if isinstance(view, ConditionalGetMixin):
+            last_modified = getattr(bare_object, view.last_modified_field)
+        return await self.conditional_response(
+            view, last_modified, last_modified, lambda: self.cached_response(view, get_response)
+        )
+
+
+LIST_ACTIONS = {'get': 'list', 'post': 'create'}
+DETAIL_ACTIONS = {
+    'get': 'retrieve', 'put': 'update', 'patch': 'partial_update', 'delete': 'destroy'
+}
+
+marathon_list = AsyncReadView(
+    MarathonViewSet, LIST_ACTIONS, basename='marathon', detail=False
+).as_view()
+marathon_detail = AsyncReadView(
+    MarathonViewSet, DETAIL_ACTIONS, basename='marathon', detail=True
+).as_view()
+payment_list = AsyncReadView(
+    PaymentViewSet, LIST_ACTIONS, basename='payment', detail=False
+).as_view()
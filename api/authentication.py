@@ -0,0 +1,199 @@
+import threading
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS
+from django.contrib.auth import get_user_model
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication, get_authorization_header
+
+from .cache import LRUCache
+
+
+class TokenCache():
+    """
+    Two tier cache of token key -> user snapshot, an in-process LRU in front
+    of an optional shared Django cache which is used by all workers.
+    Invalidations reach the worker making them and the shared tier, other
+    workers keep their local entries for at most `local_ttl` seconds(capped
+    to `SHARED_LOCAL_TTL` with a shared tier, `ttl` without one).
+    """
+    SHARED_LOCAL_TTL = 5
+
+    def __init__(self, maxsize, ttl, shared_alias=None, local_ttl=None):
+        if local_ttl is None:
+            local_ttl = ttl if shared_alias is None else min(ttl, self.SHARED_LOCAL_TTL)
+        self.local = LRUCache(maxsize=maxsize, ttl=local_ttl)
+        self.ttl = ttl
+        self.shared_alias = shared_alias
+        self._lock = threading.Lock()
+        self.hits = self.shared_hits = self.misses = self.invalidations = 0
+
+    @property
+    def shared(self):
+        if self.shared_alias is None:
+            return None
+        return caches[self.shared_alias]
+
+    @staticmethod
+    def shared_key(key):
+        return f'auth:token:{key}'
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def get(self, key):
+        snapshot = self.local.get(key)
+        if snapshot is not None:
+            self._count('hits')
+            return snapshot
+
+        if self.shared is not None:
+            snapshot = self.shared.get(self.shared_key(key))
+            if snapshot is not None:
+                self._count('shared_hits')
+                self.local.set(key, snapshot)
+                return snapshot
+
+        self._count('misses')
+        return None
+
+    def set(self, key, snapshot):
+        self.local.set(key, snapshot)
+        if self.shared is not None:
+            self.shared.set(self.shared_key(key), snapshot, self.ttl)
+
+    async def aget(self, key):
+        snapshot = self.local.get(key)
+        if snapshot is not None:
+            self._count('hits')
+            return snapshot
+
+        if self.shared is not None:
+            snapshot = await self.shared.aget(self.shared_key(key))
+            if snapshot is not None:
+                self._count('shared_hits')
+                self.local.set(key, snapshot)
+                return snapshot
+
+        self._count('misses')
+        return None
+
+    async def aset(self, key, snapshot):
+        self.local.set(key, snapshot)
+        if self.shared is not None:
+            await self.shared.aset(self.shared_key(key), snapshot, self.ttl)
+
+    def invalidate(self, keys):
+        keys = list(keys)
+        for key in keys:
+            self.local.delete(key)
+        if self.shared is not None:
+            self.shared.delete_many([self.shared_key(key) for key in keys])
+        with self._lock:
+            self.invalidations += len(keys)
+
+    def clear(self):
+        self.local.clear()
+
+    def stats(self):
+        return {
+            'size': len(self.local),
+            'hits': self.hits,
+            'shared_hits': self.shared_hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+        }
+
+
+token_cache = TokenCache(
+    maxsize=getattr(settings, 'TOKEN_AUTH_CACHE_SIZE', 10000),
+    ttl=getattr(settings, 'TOKEN_AUTH_CACHE_TTL', 300),
+    shared_alias=getattr(settings, 'TOKEN_AUTH_SHARED_CACHE', None),
+    local_ttl=getattr(settings, 'TOKEN_AUTH_LOCAL_CACHE_TTL', None)
+)
+
+
+# Left out of snapshots(the shared tier is readable by every worker), it's
+# loaded from the database when accessed
+UNCACHED_USER_FIELDS = ('password',)
+
+
+def snapshot_fields(User):
+    return [
+        field.attname for field in User._meta.concrete_fields
+        if field.attname not in UNCACHED_USER_FIELDS
+    ]
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    Drop-in replacement for DRF's `TokenAuthentication` which serves
+    token lookups from `token_cache` instead of querying the database
+    on every request, entries are invalidated by signals in `api.models`.
+    """
+    cache = token_cache
+
+    @staticmethod
+    def snapshot(user, token):
+        return (token.created, tuple(getattr(user, name) for name in snapshot_fields(type(user))))
+
+    def restore(self, key, snapshot):
+        # Build fresh instances for every request so that per request state
+        # (e.g the principal) never leaks between requests
+        created, values = snapshot
+        User = get_user_model()
+        user = User.from_db(DEFAULT_DB_ALIAS, snapshot_fields(User), values)
+        token = self.get_model().from_db(
+            DEFAULT_DB_ALIAS, ['key', 'user_id', 'created'], [key, user.pk, created]
+        )
+        token.user = user
+        return user, token
+
+    def authenticate_credentials(self, key):
+        snapshot = self.cache.get(key)
+        if snapshot is None:
+            user, token = super().authenticate_credentials(key)
+            self.cache.set(key, self.snapshot(user, token))
+            return (user, token)
+
+        user, token = self.restore(key, snapshot)
+        if not user.is_active:
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+        return (user, token)
+
+    async def aauthenticate(self, request):
+        """Async counterpart of `authenticate` for async views"""
+        auth = get_authorization_header(request).split()
+        if not auth or auth[0].lower() != self.keyword.lower().encode():
+            return None
+
+        if len(auth) != 2:
+            raise exceptions.AuthenticationFailed(_('Invalid token header.'))
+        try:
+            key = auth[1].decode()
+        except UnicodeError:
+            raise exceptions.AuthenticationFailed(
+                _('Invalid token header. Token string should not contain invalid characters.')
+            )
+        return await self.aauthenticate_credentials(key)
+
+    async def aauthenticate_credentials(self, key):
+        snapshot = await self.cache.aget(key)
+        if snapshot is None:
+            model = self.get_model()
+            try:
+                token = await model.objects.select_related('user').aget(key=key)
+            except model.DoesNotExist:
+                raise exceptions.AuthenticationFailed(_('Invalid token.'))
+            if not token.user.is_active:
+                raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+            await self.cache.aset(key, self.snapshot(token.user, token))
+            return (token.user, token)
+
+        user, token = self.restore(key, snapshot)
+        if not user.is_active:
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+        return (user, token)
@@ -0,0 +1,442 @@
+import time
+import contextlib
+import statistics
+from types import SimpleNamespace
+
+from django.db import connection, transaction
+from django.core.cache import cache
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient, APIRequestFactory, force_authenticate
+
+from .seeding import Seeder
+from .groups import create_groups
+from .models import User
+from .authentication import token_cache
+from .response_cache import marathon_response_cache
+from .values_plan import get_values_plan
+from .renderers import ORJSONRenderer, MessagePackRenderer, msgpack
+from .compression import CompressionMiddleware, brotli
+from .throttling import unthrottled
+from .search import search_substring
+
+
+PERCENTILES = (50, 95, 99)
+
+
+def scale_plan(payments):
+    """Number of rows of every table for a scale given in payments"""
+    return {
+        'users': max(20, payments // 10),
+        'marathons': max(5, payments // 100),
+        'payments': payments,
+    }
+
+
+def get_endpoints(router):
+    """
+    Paths of every `GET` endpoint of `router`: list, detail and extra
+    actions, details use the latest object of the viewset's queryset.
+    """
+    endpoints = []
+    for prefix, viewset, basename in router.registry:
+        obj = viewset.queryset.model.objects.order_by('-pk').first()
+        pk = obj.pk if obj is not None else 0
+        endpoints.append((f'{basename}-list', f'/{prefix}/'))
+        endpoints.append((f'{basename}-detail', f'/{prefix}/{pk}/'))
+        for extra_action in viewset.get_extra_actions():
+            if 'get' not in extra_action.mapping:
+                continue
+            if extra_action.detail:
+                path = f'/{prefix}/{pk}/{extra_action.url_path}/'
+            else:
+                path = f'/{prefix}/{extra_action.url_path}/'
+            endpoints.append((f'{basename}-{extra_action.url_name}', path))
+    return endpoints
+
+
+def read_content(response):
+    if response.streaming:
+        return b''.join(response.streaming_content)
+    return response.content
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+class QueryCounter():
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def measure(client, path, iterations):
+    # Warm up per process caches first, like a long running worker
+    client.get(path)
+
+    queries = QueryCounter()
+    with connection.execute_wrapper(queries):
+        response = client.get(path)
+        content = read_content(response)
+
+    latencies = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        read_content(client.get(path))
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    result = {
+        'status': response.status_code,
+        'queries': queries.count,
+        'bytes': len(content),
+        'mean': round(statistics.mean(latencies), 3),
+    }
+    for percent in PERCENTILES:
+        result[f'p{percent}'] = round(percentile(latencies, percent), 3)
+    return result
+
+
+def clear_caches():
+    cache.clear()
+    token_cache.clear()
+    marathon_response_cache.invalidate()
+
+
+def run_benchmark(router, scales, iterations, seed=0, stdout=None):
+    """
+    Seed every scale(in payments) in a transaction, measure every endpoint
+    of `router` as an admin then roll the seeded rows back.
+    """
+    results = {}
+    for scale in scales:
+        with unthrottled(), transaction.atomic():
+            clear_caches()
+            seeder = Seeder(prefix=f'bench-{scale}', seed=seed, stdout=stdout)
+            users = seeder.seed(**scale_plan(scale))
+            client = APIClient()
+            client.credentials(HTTP_AUTHORIZATION=f'Token {seeder.get_token(users["admin"][0]).key}')
+
+            results[str(scale)] = {
+                name: measure(client, path, iterations)
+                for name, path in get_endpoints(router)
+            }
+            transaction.set_rollback(True)
+        clear_caches()
+    return results
+
+
+def compare(results, baseline, latency_tolerance=0.25, latency_slack=1.0, bytes_tolerance=0.05):
+    """
+    Regressions of `results` against `baseline`, more queries than the
+    baseline is always a regression while latency and bytes get a relative
+    tolerance(and latency an absolute slack in ms for timer noise).
+    """
+    regressions = []
+    for scale, endpoints in results.items():
+        for name, result in endpoints.items():
+            expected = baseline.get(scale, {}).get(name)
+            if expected is None:
+                continue
+            label = f'{name} at {scale} payments'
+            if result['status'] != expected['status']:
+                regressions.append(f"{label}: status {expected['status']} -> {result['status']}")
+            if result['queries'] > expected['queries']:
+                regressions.append(f"{label}: queries {expected['queries']} -> {result['queries']}")
+            if result['bytes'] > expected['bytes'] * (1 + bytes_tolerance):
+                regressions.append(f"{label}: bytes {expected['bytes']} -> {result['bytes']}")
+            for percent in PERCENTILES:
+                key = f'p{percent}'
+                if result[key] > expected[key] * (1 + latency_tolerance) + latency_slack:
+                    regressions.append(f"{label}: {key} {expected[key]}ms -> {result[key]}ms")
+    return regressions
+
+
+def list_view(viewset, user, path='/'):
+    """`viewset` set up to serve `GET path` as `list` for `user`"""
+    request = APIRequestFactory().get(path)
+    force_authenticate(request, user)
+    view = viewset(action_map={'get': 'list'}, format_kwarg=None, args=(), kwargs={})
+    view.request = view.initialize_request(request)
+    view.request.accepted_renderer = JSONRenderer()
+    return view
+
+
+def rows_per_second(serialize, rows, iterations):
+    durations = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        serialize()
+        durations.append(time.perf_counter() - start)
+    return round(rows / min(durations), 1)
+
+
+def measure_serialization(viewset, user, rows, iterations, path='/'):
+    """
+    Rows per second of serializing(fetch included) the first `rows` of the
+    list of `viewset` with its serializer and with its `ValuesPlan`.
+    """
+    view = list_view(viewset, user, path)
+    queryset = view.filter_queryset(view.get_queryset())
+    plan = get_values_plan(view.get_serializer(), view.request)
+    context = view.get_serializer_context()
+
+    def serialize():
+        return view.get_serializer(list(queryset[:rows]), many=True).data
+
+    def serialize_values():
+        return plan.serialize(plan.values(queryset)[:rows], context)
+
+    renderer = JSONRenderer()
+    data = serialize()
+    result = {'rows': len(data), 'serializer': rows_per_second(serialize, len(data), iterations)}
+    if plan is not None:
+        result['identical'] = renderer.render(serialize_values()) == renderer.render(data)
+        result['values_plan'] = rows_per_second(serialize_values, len(data), iterations)
+        result['speedup'] = round(result['values_plan'] / result['serializer'], 2)
+    return result
+
+
+def run_serialization_benchmark(viewsets, payments, rows, iterations, seed=0, stdout=None):
+    """
+    Seed a scale(in payments) in a transaction and measure serialization
+    of `viewsets` lists as an admin for every number of `rows`.
+    """
+    results = {}
+    with transaction.atomic():
+        clear_caches()
+        seeder = Seeder(prefix=f'bench-{payments}', seed=seed, stdout=stdout)
+        admin = seeder.seed(**scale_plan(payments))['admin'][0]
+        for name, viewset in viewsets:
+            results[name] = {
+                str(count): measure_serialization(viewset, admin, count, iterations)
+                for count in rows
+            }
+        transaction.set_rollback(True)
+    clear_caches()
+    return results
+
+
+def get_renderers():
+    renderers = {'json': JSONRenderer(), 'orjson': ORJSONRenderer()}
+    if msgpack is not None:
+        renderers['msgpack'] = MessagePackRenderer()
+    return renderers
+
+
+def measure_rendering(viewset, user, rows, iterations, path='/'):
+    """
+    Render time(ms) and bytes of the first `rows` of the list of
+    `viewset` with every renderer, and JSON bytes once compressed.
+    """
+    view = list_view(viewset, user, path)
+    queryset = view.filter_queryset(view.get_queryset())
+    data = view.get_serializer(list(queryset[:rows]), many=True).data
+
+    result = {'rows': len(data)}
+    for name, renderer in get_renderers().items():
+        durations = []
+        for i in range(iterations):
+            start = time.perf_counter()
+            content = renderer.render(data, renderer.media_type)
+            durations.append((time.perf_counter() - start) * 1000)
+        result[f'{name}_ms'] = round(min(durations), 3)
+        result[f'{name}_bytes'] = len(content)
+
+    content = JSONRenderer().render(data)
+    result['identical'] = ORJSONRenderer().render(data) == content
+    middleware = CompressionMiddleware(lambda request: None)
+    encodings = ['gzip'] + (['br'] if brotli is not None else [])
+    for encoding in encodings:
+        result[f'{encoding}_bytes'] = len(middleware.compress(encoding, content))
+    return result
+
+
+def run_rendering_benchmark(viewsets, payments, rows, iterations, seed=0, stdout=None):
+    """Seed a scale(in payments) in a transaction and measure rendering of `viewsets` lists"""
+    results = {}
+    with transaction.atomic():
+        clear_caches()
+        seeder = Seeder(prefix=f'bench-{payments}', seed=seed, stdout=stdout)
+        admin = seeder.seed(**scale_plan(payments))['admin'][0]
+        for name, viewset in viewsets:
+            results[name] = {
+                str(count): measure_rendering(viewset, admin, count, iterations)
+                for count in rows
+            }
+        transaction.set_rollback(True)
+    clear_caches()
+    return results
+
+
+def nested_write_payload(categories, sponsors, created, count):
+    """
+    Update every child of a marathon, create `count` more of each and
+    remove the ones `created` by the previous write.
+    """
+    return {
+        'categories': {
+            'update': {str(pk): {'price': 10 + i % 90} for i, pk in enumerate(categories)},
+            'create': [{'name': 'HALF', 'price': 20, 'currency': 'USD'} for i in range(count)],
+            'remove': created['categories'],
+        },
+        'sponsors': {
+            'update': {str(pk): {'name': f'Sponsor {i}'} for i, pk in enumerate(sponsors)},
+            'create': [{'name': f'New sponsor {i}'} for i in range(count)],
+            'remove': created['sponsors'],
+        },
+    }
+
+
+def measure_nested_writes(client, marathon, count, iterations):
+    """
+    Latency and queries of `PATCH /marathons/<pk>/` updating `count`
+    categories and sponsors, creating `count` and removing `count` more.
+    """
+    categories = list(marathon.categories.values_list('pk', flat=True))
+    sponsors = list(marathon.sponsors.values_list('pk', flat=True))
+    created = {'categories': [], 'sponsors': []}
+    path = f'/marathons/{marathon.pk}/'
+
+    def patch():
+        payload = nested_write_payload(categories, sponsors, created, count)
+        start = time.perf_counter()
+        response = client.patch(path, payload, format='json')
+        duration = (time.perf_counter() - start) * 1000
+        assert response.status_code == 200, response.content
+        created['categories'] = list(
+            marathon.categories.exclude(pk__in=categories).values_list('pk', flat=True)
+        )
+        created['sponsors'] = list(
+            marathon.sponsors.exclude(pk__in=sponsors).values_list('pk', flat=True)
+        )
+        return duration
+
+    # Warm up, later writes remove the children created by the previous one
+    patch()
+    queries = QueryCounter()
+    with connection.execute_wrapper(queries):
+        patch()
+    latencies = [patch() for i in range(iterations)]
+
+    result = {'children': count, 'queries': queries.count, 'mean': round(statistics.mean(latencies), 3)}
+    for percent in PERCENTILES:
+        result[f'p{percent}'] = round(percentile(latencies, percent), 3)
+    return result
+
+
+def run_nested_write_benchmark(counts, iterations, seed=0, stdout=None):
+    """
+    Create a marathon with every number of categories and sponsors in
+    `counts` in a transaction and measure nested writes as its organizer.
+    """
+    results = {}
+    with unthrottled(), transaction.atomic():
+        clear_caches()
+        create_groups()
+        seeder = Seeder(prefix='bench-nested', seed=seed, stdout=stdout)
+        organizer = seeder.create_users(20)['organizer'][0]
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Token {seeder.get_token(organizer).key}')
+        for count in counts:
+            marathon = seeder.create_marathons(1, [organizer])[0]
+            seeder.create_categories([marathon], count)
+            seeder.create_sponsors([marathon], count)
+            results[str(count)] = measure_nested_writes(client, marathon, count, iterations)
+        transaction.set_rollback(True)
+    clear_caches()
+    return results
+
+
+def measure_throttle(throttle_class, requests, clients):
+    """
+    Microseconds `throttle_class` adds to a request, `requests` spread
+    over `clients` users. A throttle is built per request like DRF does.
+    """
+    users = [SimpleNamespace(pk=pk, is_authenticated=True) for pk in range(clients)]
+    batch = [
+        SimpleNamespace(user=users[i % clients], method='GET', META={'REMOTE_ADDR': '127.0.0.1'})
+        for i in range(requests)
+    ]
+    view = SimpleNamespace()
+    allowed = 0
+    start = time.perf_counter()
+    for request in batch:
+        allowed += throttle_class().allow_request(request, view)
+    elapsed = time.perf_counter() - start
+    return {
+        'requests': requests,
+        'clients': clients,
+        'allowed': allowed,
+        'us_per_request': round(elapsed / requests * 1000000, 3),
+    }
+
+
+def search_page(queryset):
+    """Count and first page of a users list filtered by `queryset`"""
+    page = queryset.order_by('-date_joined').values_list('pk', flat=True)[:10]
+    return queryset.count(), list(page)
+
+
+def measure_search(search, iterations):
+    search()
+    queries = QueryCounter()
+    with connection.execute_wrapper(queries):
+        result = search()
+    latencies = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        search()
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    measured = {'matches': result[0], 'queries': queries.count, 'mean': round(statistics.mean(latencies), 3)}
+    for percent in PERCENTILES:
+        measured[f'p{percent}'] = round(percentile(latencies, percent), 3)
+    return measured, result
+
+
+@contextlib.contextmanager
+def sequential_scans():
+    """Keep PostgreSQL from using the trigram indexes in the block"""
+    if connection.vendor != 'postgresql':
+        yield
+        return
+    with connection.cursor() as cursor:
+        cursor.execute('SET LOCAL enable_bitmapscan = off')
+    try:
+        yield
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_bitmapscan = on')
+
+
+def run_user_search_benchmark(users, terms, iterations, field='email', seed=0, stdout=None):
+    """
+    Seed `users` users in a transaction and compare searching `field` for
+    every term of `terms` with a scan(`icontains`) and through the substring
+    index(`search_substring`), then roll the seeded rows back.
+    """
+    results = {}
+    with transaction.atomic():
+        create_groups()
+        seeder = Seeder(prefix='bench-search', seed=seed, stdout=stdout)
+        start = time.perf_counter()
+        seeder.create_users(users)
+        seeder.analyze()
+        if stdout is not None:
+            stdout.write(f"Seeded and indexed {users} users in {time.perf_counter() - start:.1f}s")
+
+        for term in terms:
+            with sequential_scans():
+                scan, expected = measure_search(
+                    lambda: search_page(User.objects.filter(**{f'{field}__icontains': term})), iterations
+                )
+            indexed, result = measure_search(
+                lambda: search_page(search_substring(User.objects.all(), field, term)), iterations
+            )
+            results[term] = {'scan': scan, 'indexed': indexed, 'identical': result == expected}
+        transaction.set_rollback(True)
+    return results
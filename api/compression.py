@@ -0,0 +1,140 @@
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from django.utils.deprecation import MiddlewareMixin
+from django.utils.text import compress_sequence, compress_string
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+DEFAULTS = {
+    # Responses smaller than this many bytes aren't worth compressing,
+    # streaming responses are always compressed
+    'MIN_SIZE': 1024,
+    # Encodings in order of preference, `br` needs the `brotli` package
+    'ENCODINGS': ('br', 'gzip'),
+    'BROTLI_QUALITY': 4,
+    # Random bytes added to gzip headers against BREACH(like `GZipMiddleware`)
+    'GZIP_MAX_RANDOM_BYTES': 100,
+    # Responses carrying secrets(tokens) are never compressed, brotli has no
+    # length masking and gzip's only blurs the length
+    'EXCLUDED_PATHS': ('/auth/', '/register/'),
+}
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'COMPRESSION', {})}
+
+
+def accepted_encodings(header):
+    """Content codings of an `Accept-Encoding` header which aren't refused with `q=0`"""
+    encodings = set()
+    for item in header.split(','):
+        name, *params = item.split(';')
+        quality = 1.0
+        for param in params:
+            key, _, value = param.strip().partition('=')
+            if key.lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name.strip() and quality > 0:
+            encodings.add(name.strip().lower())
+    return encodings
+
+
+def brotli_sequence(sequence, quality):
+    compressor = brotli.Compressor(quality=quality)
+    for chunk in sequence:
+        # Flush every chunk so that streamed rows reach the client right away
+        data = compressor.process(chunk) + compressor.flush()
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+async def abrotli_sequence(sequence, quality):
+    compressor = brotli.Compressor(quality=quality)
+    async for chunk in sequence:
+        data = compressor.process(chunk) + compressor.flush()
+        if data:
+            yield data
+    yield compressor.finish()
+
+
+async def agzip_sequence(sequence, max_random_bytes):
+    async for chunk in sequence:
+        yield compress_string(chunk, max_random_bytes=max_random_bytes)
+
+
+class CompressionMiddleware(MiddlewareMixin):
+    """
+    Compress responses with brotli or gzip(whichever the client accepts
+    first in `ENCODINGS`) when they are at least `MIN_SIZE` bytes, streaming
+    responses(e.g exports) are compressed chunk by chunk as they are sent.
+    Responses under `EXCLUDED_PATHS` are sent as they are.
+    """
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.config = get_config()
+        self.encodings = [
+            encoding for encoding in self.config['ENCODINGS']
+            if encoding == 'gzip' or (encoding == 'br' and brotli is not None)
+        ]
+
+    def get_encoding(self, request):
+        accepted = accepted_encodings(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        for encoding in self.encodings:
+            if encoding in accepted:
+                return encoding
+        return None
+
+    def compress(self, encoding, content):
+        if encoding == 'br':
+            return brotli.compress(content, quality=self.config['BROTLI_QUALITY'])
+        return compress_string(content, max_random_bytes=self.config['GZIP_MAX_RANDOM_BYTES'])
+
+    def compress_streaming(self, encoding, response):
+        content = response.streaming_content
+        if encoding == 'br':
+            quality = self.config['BROTLI_QUALITY']
+            if response.is_async:
+                return abrotli_sequence(content, quality)
+            return brotli_sequence(content, quality)
+        max_random_bytes = self.config['GZIP_MAX_RANDOM_BYTES']
+        if response.is_async:
+            return agzip_sequence(content, max_random_bytes)
+        return compress_sequence(content, max_random_bytes=max_random_bytes)
+
+    def process_response(self, request, response):
+        if request.path.startswith(tuple(self.config['EXCLUDED_PATHS'])):
+            return response
+        if not response.streaming and len(response.content) < self.config['MIN_SIZE']:
+            return response
+        if response.has_header('Content-Encoding'):
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+        encoding = self.get_encoding(request)
+        if encoding is None:
+            return response
+
+        if response.streaming:
+            response.streaming_content = self.compress_streaming(encoding, response)
+            del response.headers['Content-Length']
+        else:
+            content = self.compress(encoding, response.content)
+            if len(content) >= len(response.content):
+                return response
+            response.content = content
+            response.headers['Content-Length'] = str(len(content))
+
+        # Representations differ by encoding, so strong ETags become weak
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response.headers['ETag'] = 'W/' + etag
+        response.headers['Content-Encoding'] = encoding
+        return response
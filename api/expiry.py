@@ -0,0 +1,143 @@
+import time
+import logging
+from collections import Counter
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from .models import Payment, MarathonStats
+
+
+logger = logging.getLogger('api.expiry')
+
+
+class SweepStats():
+    """Progress of a sweep: chunks, payments cancelled and throughput"""
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.chunks = 0
+        self.cancelled = 0
+        self.marathons = set()
+        self.slowest_chunk = 0.0
+
+    def add_chunk(self, cancelled, marathons, duration):
+        self.chunks += 1
+        self.cancelled += cancelled
+        self.marathons.update(marathons)
+        self.slowest_chunk = max(self.slowest_chunk, duration)
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def as_dict(self):
+        elapsed = self.elapsed
+        return {
+            'chunks': self.chunks,
+            'cancelled': self.cancelled,
+            'marathons': len(self.marathons),
+            'elapsed_s': round(elapsed, 3),
+            'per_second': round(self.cancelled / elapsed, 1) if elapsed else 0.0,
+            'slowest_chunk_ms': round(self.slowest_chunk * 1000, 3),
+        }
+
+
+class PaymentExpirySweeper():
+    """
+    Cancel `UNPAID` payments whose `validation_date` passed, `chunk_size`
+    at a time. Every chunk is a short transaction which locks its rows with
+    `SELECT ... FOR UPDATE SKIP LOCKED`, so several sweepers can run at once
+    (each skips rows another one holds) and requests only ever wait for a
+    chunk. `MarathonStats` are moved from `UNPAID` to `CANCELLED` in the
+    same transaction.
+
+    Payments are cancelled, never deleted, paid ones are left alone like
+    `Payment.delete` protects them.
+    """
+    def __init__(self, chunk_size=500, dry_run=False, pause=0.0, stdout=None):
+        self.chunk_size = chunk_size
+        self.dry_run = dry_run
+        self.pause = pause
+        self.stdout = stdout
+
+    def log(self, message):
+        logger.info(message)
+        if self.stdout is not None:
+            self.stdout.write(message)
+
+    def expired(self, now):
+        return Payment.objects.filter(status='UNPAID', validation_date__lt=now)
+
+    def lock_chunk(self, now):
+        payments = self.expired(now).order_by('validation_date', 'pk')
+        if connection.features.has_select_for_update_skip_locked:
+            payments = payments.select_for_update(skip_locked=True)
+        # Without row locks(e.g SQLite) the whole database is locked on write
+        return list(payments.values_list('pk', 'marathon_id', 'category_id')[:self.chunk_size])
+
+    def cancel_chunk(self, now):
+        """Cancel one chunk, returns the rows which were cancelled"""
+        with transaction.atomic():
+            rows = self.lock_chunk(now)
+            if not rows:
+                return rows
+            Payment.objects.filter(pk__in=[pk for pk, *key in rows]).update(
+                status='CANCELLED', updated_at=now
+            )
+            counts = Counter((marathon_id, category_id) for pk, marathon_id, category_id in rows)
+            # Same order in every sweeper so that stats rows can't deadlock
+            for (marathon_id, category_id), count in sorted(counts.items()):
+                MarathonStats.objects.add(marathon_id, category_id, 'UNPAID', -count)
+                MarathonStats.objects.add(marathon_id, category_id, 'CANCELLED', count)
+        return rows
+
+    def preview_chunks(self, now):
+        """Chunks a sweep would cancel, read without locks by keyset"""
+        payments = self.expired(now).order_by('validation_date', 'pk')
+        last = None
+        while True:
+            chunk = payments
+            if last is not None:
+                validation_date, pk = last
+                chunk = chunk.filter(validation_date__gte=validation_date).exclude(
+                    validation_date=validation_date, pk__lte=pk
+                )
+            rows = list(chunk.values_list(
+                'pk', 'marathon_id', 'category_id', 'validation_date'
+            )[:self.chunk_size])
+            if not rows:
+                return
+            last = (rows[-1][3], rows[-1][0])
+            yield [row[:3] for row in rows]
+
+    def sweep(self, now=None, max_chunks=None, should_stop=None):
+        """
+        Cancel payments expired at `now` until none is left, `max_chunks`
+        were cancelled or `should_stop()` is true between chunks.
+        """
+        now = now or timezone.now()
+        stats = SweepStats()
+        chunks = self.preview_chunks(now) if self.dry_run else None
+        while max_chunks is None or stats.chunks < max_chunks:
+            if should_stop is not None and should_stop():
+                break
+            start = time.perf_counter()
+            if chunks is not None:
+                rows = next(chunks, [])
+            else:
+                rows = self.cancel_chunk(now)
+            if not rows:
+                break
+            duration = time.perf_counter() - start
+            marathons = {marathon_id for pk, marathon_id, category_id in rows}
+            stats.add_chunk(len(rows), marathons, duration)
+            self.log(
+                f"{'Would cancel' if self.dry_run else 'Cancelled'} {len(rows)} payments "
+                f"in chunk {stats.chunks} ({stats.cancelled} so far, {duration * 1000:.1f}ms)"
+            )
+            if len(rows) < self.chunk_size:
+                # The rest(if any) is locked by another sweeper
+                break
+            if self.pause:
+                time.sleep(self.pause)
+        return stats
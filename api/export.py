@@ -0,0 +1,66 @@
+import csv
+import json
+
+from django.http import StreamingHttpResponse
+from django.core.serializers.json import DjangoJSONEncoder
+
+
+# Columns of payment/participant exports, fetched with `values()`
+PAYMENT_EXPORT_FIELDS = (
+    'id', 'marathon_id', 'status', 'validation_date', 'created_at',
+    'category__name', 'category__price', 'category__currency',
+    'user__id', 'user__username', 'user__email', 'user__full_name',
+    'user__phone', 'user__gender'
+)
+
+EXPORT_CHUNK_SIZE = 2000
+
+# Spreadsheets run CSV cells starting with these as formulas
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+class Echo():
+    """File like object which returns what is written instead of buffering it"""
+    def write(self, value):
+        return value
+
+
+def ndjson_rows(rows):
+    encoder = DjangoJSONEncoder()
+    for row in rows:
+        yield encoder.encode(row) + '\n'
+
+
+def escape_formula(value):
+    """Quote user supplied text so that spreadsheets show it rather than run it"""
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return f"'{value}"
+    return value
+
+
+def csv_rows(rows, fields):
+    writer = csv.writer(Echo())
+    yield writer.writerow(fields)
+    for row in rows:
+        yield writer.writerow([escape_formula(row[field]) for field in fields])
+
+
+def export_response(queryset, fields, output, filename):
+    """
+    Stream `fields` of `queryset` rows as NDJSON or CSV, rows are read
+    through a server side cursor in chunks so memory stays flat.
+    """
+    rows = queryset.values(*fields).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+    if output == 'csv':
+        content = csv_rows(rows, fields)
+    else:
+        content = ndjson_rows(rows)
+
+    response = StreamingHttpResponse(content, content_type=EXPORT_FORMATS[output])
+    response['Content-Disposition'] = f'attachment; filename="{filename}.{output}"'
+    return response
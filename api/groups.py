@@ -1,7 +1,24 @@
 from django.contrib.auth.models import Group
 
 
+# Group ids by name, roles are created once and rarely change so they are
+# kept in process memory, cleared by signals on `Group` in `api.models`
+_group_ids = {}
+
+
 def create_groups():
     Group.objects.get_or_create(name='admin')
     Group.objects.get_or_create(name='organizer')
-    Group.objects.get_or_create(name='client')
\ No newline at end of file
+    Group.objects.get_or_create(name='client')
+
+
+def get_group_id(name):
+    group_id = _group_ids.get(name)
+    if group_id is None:
+        group_id = Group.objects.values_list('pk', flat=True).get(name=name)
+        _group_ids[name] = group_id
+    return group_id
+
+
+def clear_group_ids():
+    _group_ids.clear()
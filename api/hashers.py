@@ -0,0 +1,152 @@
+import time
+import base64
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError
+
+from django.conf import settings
+from django.utils.crypto import pbkdf2
+from django.contrib.auth.hashers import PBKDF2PasswordHasher
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from .instrumentation import timed
+
+
+logger = logging.getLogger('api.hashing')
+
+
+class HashingPoolSaturated(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Too many sign-ins at the moment, try again shortly.'
+    default_code = 'hashing_pool_saturated'
+
+    def __init__(self, wait, detail=None, code=None):
+        super().__init__(detail, code)
+        # Sent as `Retry-After` by DRF's exception handler
+        self.wait = wait
+
+
+class HashingPool():
+    """
+    Run password hashing in `workers` threads(or processes), at most
+    `max_queue` more hashes wait for a worker and anything beyond that is
+    rejected right away instead of piling up behind a login storm.
+    """
+    def __init__(self, workers, max_queue, executor='thread', timeout=30, retry_after=1):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.executor_class = ProcessPoolExecutor if executor == 'process' else ThreadPoolExecutor
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.slots = threading.BoundedSemaphore(workers + max_queue)
+        self._executor = None
+        self._lock = threading.Lock()
+        self.in_flight = self.submitted = self.completed = self.rejected = self.timed_out = 0
+        self.waits = deque(maxlen=1000)
+        self.durations = deque(maxlen=1000)
+
+    @property
+    def executor(self):
+        # Created on first use so that every forked(e.g gunicorn) worker gets its own
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = self.executor_class(max_workers=self.workers)
+        return self._executor
+
+    def _count(self, **deltas):
+        with self._lock:
+            for counter, delta in deltas.items():
+                setattr(self, counter, getattr(self, counter) + delta)
+
+    def run(self, func, *args):
+        if not self.slots.acquire(blocking=False):
+            self._count(rejected=1)
+            logger.warning("Password hashing pool saturated: %s", self.stats())
+            raise HashingPoolSaturated(wait=self.retry_after)
+
+        self._count(in_flight=1, submitted=1)
+        submitted = time.perf_counter()
+        try:
+            future = self.executor.submit(timed_call, func, *args)
+        except BaseException:
+            self.release()
+            raise
+        # The slot is freed once the hash is done rather than when the caller
+        # stops waiting, a hash which timed out still holds a worker
+        future.add_done_callback(self.release)
+        try:
+            with timed('hashing'):
+                result, started, finished = future.result(timeout=self.timeout)
+        except TimeoutError:
+            # Dropped if it's still queued
+            future.cancel()
+            self._count(timed_out=1)
+            logger.warning("Password hash timed out: %s", self.stats())
+            raise HashingPoolSaturated(wait=self.retry_after)
+
+        self._count(completed=1)
+        # `perf_counter` of another process isn't comparable, derive the wait instead
+        duration = finished - started
+        self.durations.append(duration)
+        self.waits.append(max(0.0, time.perf_counter() - submitted - duration))
+        return result
+
+    def release(self, future=None):
+        self.slots.release()
+        self._count(in_flight=-1)
+
+    def stats(self):
+        def percentiles(values):
+            values = sorted(values)
+            if not values:
+                return {'p50_ms': None, 'p95_ms': None}
+            return {
+                'p50_ms': round(values[len(values) // 2] * 1000, 3),
+                'p95_ms': round(values[min(len(values) - 1, int(len(values) * 0.95))] * 1000, 3),
+            }
+
+        return {
+            'workers': self.workers,
+            'max_queue': self.max_queue,
+            'in_flight': self.in_flight,
+            'queued': max(0, self.in_flight - self.workers),
+            'submitted': self.submitted,
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'timed_out': self.timed_out,
+            'wait': percentiles(self.waits),
+            'hashing': percentiles(self.durations),
+        }
+
+
+def timed_call(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return result, started, time.perf_counter()
+
+
+POOL = getattr(settings, 'PASSWORD_HASHING_POOL', {})
+
+hashing_pool = HashingPool(
+    workers=POOL.get('WORKERS', 2),
+    max_queue=POOL.get('MAX_QUEUE', 32),
+    executor=POOL.get('EXECUTOR', 'thread'),
+    timeout=POOL.get('TIMEOUT', 30),
+    retry_after=POOL.get('RETRY_AFTER', 1)
+)
+
+
+class PooledPBKDF2PasswordHasher(PBKDF2PasswordHasher):
+    """
+    `PBKDF2PasswordHasher` computing the key in `hashing_pool`, hashes
+    are the same as Django's so it can replace it for existing users.
+    """
+    def encode(self, password, salt, iterations=None):
+        self._check_encode_args(password, salt)
+        iterations = iterations or self.iterations
+        hash = hashing_pool.run(pbkdf2, password, salt, iterations, 0, self.digest)
+        hash = base64.b64encode(hash).decode('ascii').strip()
+        return "%s$%d$%s$%s" % (self.algorithm, iterations, salt, hash)
@@ -0,0 +1,241 @@
+import json
+import hashlib
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction, IntegrityError
+from django.utils import timezone
+from django.utils.crypto import salted_hmac
+from rest_framework import status
+from rest_framework.response import Response
+from rest_framework.exceptions import APIException, ValidationError
+
+from .models import IdempotencyKey
+
+
+logger = logging.getLogger('api.idempotency')
+
+HEADER = 'Idempotency-Key'
+
+DEFAULTS = {
+    # 'database' for the `IdempotencyKey` table or alias of a cache in `CACHES`
+    'BACKEND': 'database',
+    # Seconds responses are kept and replayed for repeats of a key
+    'TTL': 24 * 60 * 60,
+    # Seconds a key stays locked by a request which never finished(e.g a killed worker)
+    'LOCK_TIMEOUT': 60,
+    # Seconds clients are told to wait while a key is in flight
+    'RETRY_AFTER': 1,
+    'MAX_KEY_LENGTH': 255,
+}
+
+# Response headers replayed along with the stored data
+REPLAYED_HEADERS = ('Location',)
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'IDEMPOTENCY', {})}
+
+
+class IdempotencyKeyInFlight(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'A request with this Idempotency-Key is being processed, try again shortly.'
+    default_code = 'idempotency_key_in_flight'
+
+    def __init__(self, wait, detail=None, code=None):
+        super().__init__(detail, code)
+        # Sent as `Retry-After` by DRF's exception handler
+        self.wait = wait
+
+
+class IdempotencyKeyReused(APIException):
+    status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
+    default_detail = 'This Idempotency-Key was already used with a different request.'
+    default_code = 'idempotency_key_reused'
+
+
+def in_flight(fingerprint):
+    return {'fingerprint': fingerprint, 'status_code': None}
+
+
+class CacheStore():
+    """
+    Store on top of a cache in `CACHES`, in flight keys are entries added
+    with `LOCK_TIMEOUT` which are replaced by responses kept for `TTL`.
+    """
+    def __init__(self, alias, config):
+        self.cache = caches[alias]
+        self.config = config
+
+    def cache_key(self, key):
+        return f'idempotency:{key}'
+
+    def begin(self, key, fingerprint):
+        """
+        Lock `key` for the request with `fingerprint`, returns `None` once
+        locked or the record(in flight or stored response) of the key.
+        """
+        cache_key = self.cache_key(key)
+        record = self.cache.get(cache_key)
+        if record is not None:
+            return record
+        if self.cache.add(cache_key, in_flight(fingerprint), self.config['LOCK_TIMEOUT']):
+            return None
+        # Locked by a concurrent request, or evicted already
+        return self.cache.get(cache_key) or in_flight(fingerprint)
+
+    def complete(self, key, record):
+        self.cache.set(self.cache_key(key), record, self.config['TTL'])
+
+    def release(self, key):
+        self.cache.delete(self.cache_key(key))
+
+    def purge_expired(self):
+        # Entries expire with the cache
+        return 0
+
+
+class DatabaseStore():
+    """
+    Store in the `IdempotencyKey` table, a row is inserted as the lock of
+    an in flight key and updated with the response. Expired rows count as
+    missing and are deleted by `purge_expired`.
+    """
+    def __init__(self, config):
+        self.config = config
+
+    def as_record(self, row):
+        return {
+            'fingerprint': row.fingerprint, 'status_code': row.status_code,
+            'data': row.data, 'headers': row.headers
+        }
+
+    def begin(self, key, fingerprint):
+        now = timezone.now()
+        row = IdempotencyKey.objects.filter(key=key).first()
+        if row is not None and row.expires_at > now:
+            return self.as_record(row)
+
+        lock = {
+            'fingerprint': fingerprint, 'status_code': None, 'data': None, 'headers': {},
+            'expires_at': now + timedelta(seconds=self.config['LOCK_TIMEOUT'])
+        }
+        if row is not None:
+            # Take the expired row over unless a concurrent request did
+            taken = IdempotencyKey.objects.filter(key=key, expires_at=row.expires_at).update(**lock)
+            return None if taken else in_flight(fingerprint)
+        try:
+            with transaction.atomic():
+                IdempotencyKey.objects.create(key=key, **lock)
+        except IntegrityError:
+            # Inserted by a concurrent request
+            row = IdempotencyKey.objects.filter(key=key).first()
+            return in_flight(fingerprint) if row is None else self.as_record(row)
+        return None
+
+    def complete(self, key, record):
+        IdempotencyKey.objects.filter(key=key).update(
+            status_code=record['status_code'], data=record['data'], headers=record['headers'],
+            expires_at=timezone.now() + timedelta(seconds=self.config['TTL'])
+        )
+
+    def release(self, key):
+        IdempotencyKey.objects.filter(key=key).delete()
+
+    def purge_expired(self):
+        deleted, rows = IdempotencyKey.objects.filter(expires_at__lte=timezone.now()).delete()
+        return deleted
+
+
+def get_store(config=None):
+    config = config or get_config()
+    if config['BACKEND'] == 'database':
+        return DatabaseStore(config)
+    return CacheStore(config['BACKEND'], config)
+
+
+idempotency_store = get_store()
+
+
+def get_scoped_key(request, key):
+    """Keys are per user(or anonymous), method and path"""
+    user = request.user
+    scope = f'{user.pk if user.is_authenticated else "anonymous"}:{request.method}:{request.path}'
+    return hashlib.sha256(f'{scope}:{key}'.encode()).hexdigest()
+
+
+def get_fingerprint(request):
+    """Keyed digest of the request payload, which may hold passwords"""
+    data = request.data
+    if hasattr(data, 'lists'):
+        data = sorted(data.lists())
+    payload = json.dumps(data, sort_keys=True, default=str)
+    return salted_hmac('api.idempotency', payload, algorithm='sha256').hexdigest()
+
+
+def replay(record, restore=None):
+    data = record['data'] if restore is None else restore(record['data'])
+    response = Response(data, status=record['status_code'], headers=record['headers'])
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def idempotent_response(request, get_response, secret_fields=(), restore=None):
+    """
+    Run `get_response()` once per `Idempotency-Key` header of `request`.
+    A repeat of a completed request gets the stored response(a single
+    lookup), a repeat of one in flight gets a 409 and a different request
+    with the same key a 422. Only successful responses are stored, the key
+    is released on errors so that the request can be retried.
+
+    `secret_fields` of the response data(e.g tokens) aren't stored,
+    `restore(data)` adds them back to replayed data.
+    """
+    key = request.headers.get(HEADER)
+    if key is None:
+        return get_response()
+
+    config = get_config()
+    if not key or len(key) > config['MAX_KEY_LENGTH']:
+        raise ValidationError({
+            HEADER: [f"Ensure this value has between 1 and {config['MAX_KEY_LENGTH']} characters."]
+        })
+
+    store = idempotency_store
+    key = get_scoped_key(request, key)
+    fingerprint = get_fingerprint(request)
+    record = store.begin(key, fingerprint)
+    if record is not None:
+        if record['fingerprint'] != fingerprint:
+            raise IdempotencyKeyReused()
+        if record['status_code'] is None:
+            raise IdempotencyKeyInFlight(wait=config['RETRY_AFTER'])
+        return replay(record, restore)
+
+    try:
+        response = get_response()
+    except BaseException:
+        store.release(key)
+        raise
+
+    if not status.is_success(response.status_code):
+        store.release(key)
+        return response
+
+    headers = {
+        header: response[header] for header in REPLAYED_HEADERS if response.has_header(header)
+    }
+    data = response.data
+    if secret_fields:
+        data = {name: value for name, value in data.items() if name not in secret_fields}
+    try:
+        store.complete(key, {
+            'fingerprint': fingerprint, 'status_code': response.status_code,
+            'data': data, 'headers': headers
+        })
+    except Exception:
+        # The write succeeded, a repeat will run it again once the lock expires
+        logger.exception("Couldn't store the response of an idempotent request")
+    return response
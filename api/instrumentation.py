@@ -0,0 +1,252 @@
+import re
+import json
+import time
+import logging
+import functools
+import contextvars
+from collections import Counter
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+
+logger = logging.getLogger('api.requests')
+
+DEFAULTS = {
+    # Send phase timings in a `Server-Timing` response header, to every
+    # client(True), to staff users only('staff') or to nobody(False)
+    'SERVER_TIMING': False,
+    # Log requests slower than this many milliseconds(None to disable)
+    'SLOW_REQUEST_THRESHOLD': 500,
+    # Number of slowest statements included in slow request logs
+    'SLOWEST_QUERIES': 5,
+    # Log statements with the same fingerprint run this many times in a
+    # request, views can set their own `duplicate_query_threshold`
+    'DUPLICATE_QUERY_THRESHOLD': 10,
+}
+
+PHASES = ('auth', 'hashing', 'permissions', 'db', 'serializer', 'render')
+
+_current = contextvars.ContextVar('request_metrics', default=None)
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'REQUEST_METRICS', {})}
+
+
+@functools.lru_cache(maxsize=2048)
+def fingerprint(sql):
+    """
+    Normalize `sql` so that statements which only differ by parameters,
+    literals or the length of `IN` lists get the same fingerprint.
+    """
+    sql = re.sub(r"'(?:[^']|'')*'", '?', sql)
+    sql = re.sub(r'%s|\$\d+|\b\d+(?:\.\d+)?\b', '?', sql)
+    sql = re.sub(r'\(\s*\?(?:\s*,\s*\?)*\s*\)', '(...)', sql)
+    return re.sub(r'\s+', ' ', sql).strip()
+
+
+class RequestMetrics():
+    """Timings and statements of the request being served"""
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.timings = dict.fromkeys(PHASES, 0.0)
+        self.queries = []
+        self.duplicate_query_threshold = None
+        self._depth = Counter()
+
+    def add(self, phase, duration):
+        self.timings[phase] += duration
+
+    def add_query(self, sql, duration):
+        self.queries.append((sql, duration))
+        self.timings['db'] += duration
+
+    @property
+    def total(self):
+        return time.perf_counter() - self.started
+
+    def duplicates(self, threshold):
+        counts = Counter(fingerprint(sql) for sql, duration in self.queries)
+        return {sql: count for sql, count in counts.items() if count >= threshold}
+
+    def slowest(self, count):
+        queries = sorted(self.queries, key=lambda query: query[1], reverse=True)[:count]
+        return [
+            {'fingerprint': fingerprint(sql), 'ms': round(duration * 1000, 3)}
+            for sql, duration in queries
+        ]
+
+    def server_timing(self):
+        metrics = [
+            f'{phase};dur={self.timings[phase] * 1000:.3f}' for phase in PHASES
+        ]
+        metrics.append(f'queries;desc="{len(self.queries)}"')
+        metrics.append(f'total;dur={self.total * 1000:.3f}')
+        return ", ".join(metrics)
+
+
+def current_metrics():
+    return _current.get()
+
+
+class timed():
+    """
+    Add the time spent in the block to `phase` of the current request,
+    nested blocks of the same phase(e.g nested serializers) count once.
+    """
+    def __init__(self, phase):
+        self.phase = phase
+
+    def __enter__(self):
+        self.metrics = _current.get()
+        if self.metrics is not None:
+            self.metrics._depth[self.phase] += 1
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.metrics is not None:
+            self.metrics._depth[self.phase] -= 1
+            if not self.metrics._depth[self.phase]:
+                self.metrics.add(self.phase, time.perf_counter() - self.start)
+
+
+def record_query(execute, sql, params, many, context):
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.add_query(sql, time.perf_counter() - start)
+
+
+def install_query_recorder(connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+connection_created.connect(install_query_recorder)
+
+
+class InstrumentedViewMixin():
+    """Time authentication and permission checks of DRF views"""
+    def perform_authentication(self, request):
+        with timed('auth'):
+            super().perform_authentication(request)
+
+    def check_permissions(self, request):
+        with timed('permissions'):
+            super().check_permissions(request)
+
+    def check_object_permissions(self, request, obj):
+        with timed('permissions'):
+            super().check_object_permissions(request, obj)
+
+
+class TimedSerializerMixin():
+    """Time representing instances, nested serializers are part of their parent"""
+    def to_representation(self, instance):
+        with timed('serializer'):
+            return super().to_representation(instance)
+
+
+class RequestMetricsMiddleware():
+    """
+    Record query count, DB time, slowest statements, auth, password hashing,
+    permissions, serializer and render time of every request. They are sent in a
+    `Server-Timing` header when `SERVER_TIMING` allows it, requests slower than
+    `SLOW_REQUEST_THRESHOLD` are logged and so are statements repeated in a
+    request(N+1 queries).
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.config = get_config()
+        for connection in connections.all(initialized_only=True):
+            install_query_recorder(connection)
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, metrics)
+
+    async def __acall__(self, request):
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, metrics)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        metrics = _current.get()
+        # DRF views keep their class on the view function
+        threshold = getattr(getattr(view_func, 'cls', None), 'duplicate_query_threshold', None)
+        if metrics is not None and threshold is not None:
+            metrics.duplicate_query_threshold = threshold
+
+    def process_template_response(self, request, response):
+        # Called right before rendering(e.g DRF responses)
+        metrics = _current.get()
+        if metrics is not None:
+            start = time.perf_counter()
+            response.add_post_render_callback(
+                lambda response: metrics.add('render', time.perf_counter() - start)
+            )
+        return response
+
+    def sends_server_timing(self, request):
+        server_timing = self.config['SERVER_TIMING']
+        if server_timing == 'staff':
+            # Set by DRF once it authenticated the request
+            user = getattr(request, 'user', None)
+            return user is not None and user.is_staff
+        return bool(server_timing)
+
+    def finish(self, request, response, metrics):
+        if self.sends_server_timing(request):
+            response['Server-Timing'] = metrics.server_timing()
+
+        threshold = metrics.duplicate_query_threshold or self.config['DUPLICATE_QUERY_THRESHOLD']
+        duplicates = metrics.duplicates(threshold)
+        for sql, count in duplicates.items():
+            self.log('duplicate_queries', request, response, fingerprint=sql, count=count)
+
+        threshold = self.config['SLOW_REQUEST_THRESHOLD']
+        total = metrics.total * 1000
+        if threshold is not None and total >= threshold:
+            self.log(
+                'slow_request', request, response,
+                total_ms=round(total, 3),
+                queries=len(metrics.queries),
+                **{f'{phase}_ms': round(metrics.timings[phase] * 1000, 3) for phase in PHASES},
+                slowest_queries=metrics.slowest(self.config['SLOWEST_QUERIES']),
+                duplicate_queries=len(duplicates)
+            )
+        return response
+
+    def log(self, event, request, response, **data):
+        record = {
+            'event': event,
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            **data
+        }
+        logger.warning(json.dumps(record), extra={'request_metrics': record})
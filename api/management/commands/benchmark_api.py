@@ -0,0 +1,80 @@
+import os
+import json
+
+from django.db import connection
+from django.core.management.base import BaseCommand, CommandError
+
+from api.urls import router
+from api.benchmark import PERCENTILES, run_benchmark, compare
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed the database at several scales and measure latency percentiles, "
+        "SQL queries and bytes of every router endpoint, then compare them "
+        "against a JSON baseline and fail on regressions"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--scales', type=int, nargs='+', default=[100, 1000, 10000],
+            help="Number of payments of every scale, other tables grow with it"
+        )
+        parser.add_argument('--iterations', type=int, default=20, help="Timed requests per endpoint")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--baseline', default='benchmarks/baseline.json')
+        parser.add_argument(
+            '--save-baseline', action='store_true',
+            help="Write the results to the baseline instead of comparing them"
+        )
+        parser.add_argument(
+            '--check', action='store_true',
+            help="Fail when there is no baseline to compare against(e.g in CI)"
+        )
+        parser.add_argument('--latency-tolerance', type=float, default=0.25)
+        parser.add_argument('--latency-slack', type=float, default=1.0, help="Milliseconds")
+        parser.add_argument('--bytes-tolerance', type=float, default=0.05)
+
+    def handle(self, *args, **options):
+        path = options['baseline']
+        missing = not options['save_baseline'] and not os.path.exists(path)
+        if missing and options['check']:
+            # Before seeding anything
+            raise CommandError(f"No baseline at {path} to check against, use --save-baseline")
+
+        self.stdout.write(f"Benchmarking on {connection.vendor}")
+        results = run_benchmark(router, options['scales'], options['iterations'], seed=options['seed'])
+        self.report(results)
+
+        if options['save_baseline']:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            with open(path, 'w') as baseline_file:
+                json.dump(results, baseline_file, indent=2, sort_keys=True)
+            self.stdout.write(self.style.SUCCESS(f"Saved baseline to {path}"))
+            return
+
+        if missing:
+            self.stdout.write(self.style.WARNING(f"No baseline at {path}, use --save-baseline"))
+            return
+
+        with open(path) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(
+            results, baseline, options['latency_tolerance'],
+            options['latency_slack'], options['bytes_tolerance']
+        )
+        for regression in regressions:
+            self.stderr.write(regression)
+        if regressions:
+            raise CommandError(f"{len(regressions)} regressions against {path}")
+        self.stdout.write(self.style.SUCCESS(f"No regressions against {path}"))
+
+    def report(self, results):
+        columns = ['status', 'queries', 'bytes'] + [f'p{percent}' for percent in PERCENTILES]
+        for scale, endpoints in results.items():
+            self.stdout.write(self.style.MIGRATE_HEADING(f"{scale} payments"))
+            self.stdout.write(f"{'endpoint':<28}" + "".join(f"{column:>10}" for column in columns))
+            for name, result in endpoints.items():
+                self.stdout.write(
+                    f"{name:<28}" + "".join(f"{result[column]:>10}" for column in columns)
+                )
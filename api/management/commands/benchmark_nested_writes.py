@@ -0,0 +1,30 @@
+from django.db import connection
+from django.core.management.base import BaseCommand
+
+from api.benchmark import run_nested_write_benchmark, PERCENTILES
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure latency and queries of `PATCH /marathons/<pk>/` with nested "
+        "category and sponsor writes as the number of children grows"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--children', type=int, nargs='+', default=[10, 50, 200],
+            help="Children of each type updated, created and removed by every write"
+        )
+        parser.add_argument('--iterations', type=int, default=20)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"Benchmarking on {connection.vendor}")
+        results = run_nested_write_benchmark(
+            options['children'], options['iterations'], seed=options['seed']
+        )
+
+        columns = ['children', 'queries', 'mean'] + [f'p{percent}' for percent in PERCENTILES]
+        self.stdout.write("".join(f"{column:>12}" for column in columns))
+        for count, result in results.items():
+            self.stdout.write("".join(f"{str(result[column]):>12}" for column in columns))
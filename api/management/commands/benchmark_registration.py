@@ -0,0 +1,78 @@
+import time
+import uuid
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connections
+from django.test import Client
+from django.test.utils import override_settings
+from django.core.management.base import BaseCommand
+
+from api.models import User
+from api.groups import create_groups
+from api.benchmark import percentile
+from api.hashers import hashing_pool
+from api.throttling import unthrottled
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure throughput and latency of `POST /register/` under concurrent "
+        "sign-up bursts, registered users are deleted afterwards"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=500, help="Registrations per burst")
+        parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+        parser.add_argument(
+            '--fast-hasher', action='store_true',
+            help="Hash passwords with MD5 to measure everything but password hashing"
+        )
+        parser.add_argument('--keep', action='store_true', help="Don't delete registered users")
+
+    def register(self, prefix, index):
+        client = Client()
+        try:
+            start = time.perf_counter()
+            response = client.post('/register/', {
+                'username': f'{prefix}-{index}', 'email': f'{prefix}-{index}@marathon.com',
+                'password': 'bench-password', 'role': 'client'
+            })
+            duration = (time.perf_counter() - start) * 1000
+            queries = response.get('Server-Timing', '').split('queries;desc="')[-1].split('"')[0]
+            return response.status_code, duration, queries
+        finally:
+            connections.close_all()
+
+    def burst(self, concurrency, count):
+        prefix = f'bench-register-{uuid.uuid4().hex[:8]}'
+        start = time.perf_counter()
+        # Sign-ups come from one IP here, measure them rather than the limiter
+        with unthrottled(), ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(lambda index: self.register(prefix, index), range(count)))
+        elapsed = time.perf_counter() - start
+        return prefix, results, elapsed
+
+    def handle(self, *args, **options):
+        create_groups()
+        hashers = ['django.contrib.auth.hashers.MD5PasswordHasher'] if options['fast_hasher'] else None
+
+        for concurrency in options['concurrency']:
+            if hashers:
+                with override_settings(PASSWORD_HASHERS=hashers):
+                    prefix, results, elapsed = self.burst(concurrency, options['count'])
+            else:
+                prefix, results, elapsed = self.burst(concurrency, options['count'])
+
+            latencies = [duration for status, duration, queries in results]
+            failures = sum(1 for status, duration, queries in results if status != 200)
+            queries = sorted({queries for status, duration, queries in results})
+            self.stdout.write(
+                f"concurrency {concurrency}: {len(results) / elapsed:.1f} registrations/s, "
+                f"p50 {percentile(latencies, 50):.2f}ms, p95 {percentile(latencies, 95):.2f}ms, "
+                f"p99 {percentile(latencies, 99):.2f}ms, mean {statistics.mean(latencies):.2f}ms, "
+                f"queries {'/'.join(queries)}, {failures} failed"
+            )
+            self.stdout.write(f"password hashing pool: {hashing_pool.stats()}")
+            if not options['keep']:
+                User.objects.filter(username__startswith=prefix).delete()
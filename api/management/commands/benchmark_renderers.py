@@ -0,0 +1,39 @@
+from django.db import connection
+from django.core.management.base import BaseCommand, CommandError
+
+from api.views import MarathonViewSet, PaymentViewSet
+from api.benchmark import run_rendering_benchmark
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed the database and compare render time and bytes on the wire of "
+        "marathon and payment lists with every renderer and compression"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--payments', type=int, default=10000, help="Scale of the seeded data")
+        parser.add_argument(
+            '--rows', type=int, nargs='+', default=[10, 100, 1000],
+            help="Rows per rendered list, 10 is a page"
+        )
+        parser.add_argument('--iterations', type=int, default=20)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"Benchmarking on {connection.vendor}")
+        viewsets = [('marathon', MarathonViewSet), ('payment', PaymentViewSet)]
+        results = run_rendering_benchmark(
+            viewsets, options['payments'], options['rows'],
+            options['iterations'], seed=options['seed']
+        )
+
+        different = []
+        for name, counts in results.items():
+            self.stdout.write(self.style.MIGRATE_HEADING(f"{name} list"))
+            for count, result in counts.items():
+                self.stdout.write(", ".join(f"{key} {value}" for key, value in result.items()))
+                if not result['identical']:
+                    different.append(f'{name} ({count} rows)')
+        if different:
+            raise CommandError(f"orjson output differs for {', '.join(different)}")
@@ -0,0 +1,43 @@
+from django.db import connection
+from django.core.management.base import BaseCommand, CommandError
+
+from api.urls import router
+from api.views import ValuesListMixin
+from api.benchmark import run_serialization_benchmark
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed the database and compare rows per second of list serializers "
+        "against their compiled `values()` plans, outputs must be identical"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--payments', type=int, default=10000, help="Scale of the seeded data")
+        parser.add_argument('--rows', type=int, nargs='+', default=[100, 1000])
+        parser.add_argument('--iterations', type=int, default=5)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"Benchmarking on {connection.vendor}")
+        viewsets = [
+            (basename, viewset) for prefix, viewset, basename in router.registry
+            if issubclass(viewset, ValuesListMixin)
+        ]
+        results = run_serialization_benchmark(
+            viewsets, options['payments'], options['rows'],
+            options['iterations'], seed=options['seed']
+        )
+
+        columns = ['rows', 'serializer', 'values_plan', 'speedup', 'identical']
+        self.stdout.write(f"{'list':<12}" + "".join(f"{column:>14}" for column in columns))
+        different = []
+        for name, counts in results.items():
+            for count, result in counts.items():
+                self.stdout.write(
+                    f"{name:<12}" + "".join(f"{str(result.get(column, '-')):>14}" for column in columns)
+                )
+                if result.get('identical') is False:
+                    different.append(f'{name} ({count} rows)')
+        if different:
+            raise CommandError(f"Outputs differ for {', '.join(different)}")
@@ -0,0 +1,46 @@
+from django.core.cache import caches
+from django.core.management.base import BaseCommand
+from rest_framework.throttling import UserRateThrottle
+
+from api.benchmark import measure_throttle
+from api.throttling import RateLimiter, TokenBucketThrottle, get_config
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the time per request of `TokenBucketThrottle`(alone and synced "
+        "with a shared cache) with DRF's cache based `UserRateThrottle`"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=100000)
+        parser.add_argument('--clients', type=int, nargs='+', default=[1, 100, 10000])
+        parser.add_argument(
+            '--shared-cache', default='default',
+            help="Alias of the cache in `CACHES` buckets sync with and DRF throttles use"
+        )
+
+    def throttles(self, alias):
+        config = get_config()
+        local = RateLimiter(config['SCOPES'], max_buckets=config['MAX_BUCKETS'])
+        shared = RateLimiter(
+            config['SCOPES'], shared_alias=alias,
+            sync_interval=config['SYNC_INTERVAL'], max_buckets=config['MAX_BUCKETS']
+        )
+        rate = config['SCOPES']['reads']['RATE']
+        return {
+            'token bucket': type('LocalThrottle', (TokenBucketThrottle,), {'limiter': local}),
+            'token bucket, shared': type('SharedThrottle', (TokenBucketThrottle,), {'limiter': shared}),
+            'drf cache throttle': type('CacheThrottle', (UserRateThrottle,), {
+                'cache': caches[alias], 'rate': rate, 'scope': 'bench'
+            }),
+        }
+
+    def handle(self, *args, **options):
+        alias = options['shared_cache']
+        for clients in options['clients']:
+            self.stdout.write(self.style.MIGRATE_HEADING(f"{clients} clients"))
+            for name, throttle_class in self.throttles(alias).items():
+                result = measure_throttle(throttle_class, options['requests'], clients)
+                self.stdout.write(f"{name}: " + ", ".join(f"{key} {value}" for key, value in result.items()))
+            caches[alias].clear()
@@ -0,0 +1,42 @@
+from django.db import connection
+from django.core.management.base import BaseCommand, CommandError
+
+from api.benchmark import run_user_search_benchmark, PERCENTILES
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed users and compare substring searches of `/users/?email__icontains=` "
+        "with a scan and through the substring index, seeded users are rolled back"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000000)
+        parser.add_argument(
+            '--terms', nargs='+', default=['client-4242', 'organizer-77', 'nobody', 'marathon'],
+            help="Searched substrings, rare and common ones"
+        )
+        parser.add_argument('--field', choices=['email', 'username'], default='email')
+        parser.add_argument('--iterations', type=int, default=20)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"Benchmarking on {connection.vendor}")
+        results = run_user_search_benchmark(
+            options['users'], options['terms'], options['iterations'],
+            field=options['field'], seed=options['seed'], stdout=self.stdout
+        )
+
+        columns = ['matches', 'queries', 'mean'] + [f'p{percent}' for percent in PERCENTILES]
+        self.stdout.write(f"{'term':>16}{'search':>10}" + "".join(f"{column:>12}" for column in columns))
+        different = []
+        for term, result in results.items():
+            for search in ('scan', 'indexed'):
+                self.stdout.write(
+                    f"{term:>16}{search:>10}"
+                    + "".join(f"{str(result[search][column]):>12}" for column in columns)
+                )
+            if not result['identical']:
+                different.append(term)
+        if different:
+            raise CommandError(f"Indexed results differ for {', '.join(different)}")
@@ -0,0 +1,159 @@
+import os
+import sys
+import time
+import socket
+import asyncio
+import statistics
+import subprocess
+
+from django.contrib.auth.models import Group
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.authtoken.models import Token
+
+from api.models import User, Marathon
+
+
+# Directory of `wsgi.py` and `asgi.py`
+PROJECT_DIR = os.path.dirname(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+)
+
+SERVERS = {
+    'wsgi': lambda port, workers, threads: [
+        sys.executable, '-m', 'gunicorn', 'wsgi:application', '-k', 'gthread',
+        '--workers', str(workers), '--threads', str(threads), '--bind', f'127.0.0.1:{port}'
+    ],
+    'asgi': lambda port, workers, threads: [
+        sys.executable, '-m', 'uvicorn', 'asgi:application', '--no-access-log',
+        '--workers', str(workers), '--host', '127.0.0.1', '--port', str(port)
+    ],
+}
+
+
+async def fetch(reader, writer, request):
+    """Send a request on a keep-alive connection and read the whole response"""
+    writer.write(request)
+    await writer.drain()
+    status_line = await reader.readline()
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.lower() == 'content-length':
+            length = int(value)
+    await reader.readexactly(length)
+    return int(status_line.split()[1])
+
+
+async def load(port, path, token, concurrency, duration):
+    request = (
+        f'GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nAccept: application/json\r\n'
+        f'Authorization: Token {token}\r\n\r\n'
+    ).encode()
+    latencies = []
+    errors = 0
+    deadline = time.monotonic() + duration
+
+    async def worker():
+        nonlocal errors
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        try:
+            while time.monotonic() < deadline:
+                start = time.perf_counter()
+                status = await fetch(reader, writer, request)
+                latencies.append((time.perf_counter() - start) * 1000)
+                if status != 200:
+                    errors += 1
+        finally:
+            writer.close()
+
+    await asyncio.gather(*(worker() for i in range(concurrency)))
+    return latencies, errors
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare throughput and latency of the read endpoints served by "
+        "gunicorn gthread workers(WSGI) and uvicorn workers(ASGI)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--servers', nargs='+', choices=list(SERVERS), default=list(SERVERS))
+        parser.add_argument(
+            '--paths', nargs='+', default=['/marathons/', '/marathons/{marathon}/', '/payments/'],
+            help="Paths to load, `{marathon}` is replaced by the id of a marathon"
+        )
+        parser.add_argument('--workers', type=int, default=2)
+        parser.add_argument('--threads', type=int, default=8, help="Threads per gthread worker")
+        parser.add_argument('--concurrency', type=int, default=64, help="Open connections")
+        parser.add_argument('--duration', type=float, default=10, help="Seconds per path")
+        parser.add_argument('--port', type=int, default=8765)
+
+    def get_token(self):
+        user, created = User.objects.get_or_create(username='bench-client')
+        if created:
+            user.groups.add(Group.objects.get(name='client'))
+        return Token.objects.get_or_create(user=user)[0].key
+
+    def wait_until_listening(self, port, process, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise CommandError(f"Server exited with {process.returncode}")
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                return
+            except OSError:
+                time.sleep(0.2)
+        raise CommandError(f"Server didn't listen on {port} within {timeout}s")
+
+    def handle(self, *args, **options):
+        token = self.get_token()
+        marathon = self.get_marathon_id()
+        port = options['port']
+        env = dict(os.environ)
+        env.setdefault('DJANGO_SETTINGS_MODULE', 'settings')
+        # Every connection uses the same token, limits would answer most loads
+        env['MARATHON_UNTHROTTLED'] = '1'
+
+        for server in options['servers']:
+            command = SERVERS[server](port, options['workers'], options['threads'])
+            process = subprocess.Popen(
+                command, cwd=PROJECT_DIR, env=env,
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+            try:
+                self.wait_until_listening(port, process)
+                self.stdout.write(self.style.MIGRATE_HEADING(" ".join(command[2:])))
+                for path in options['paths']:
+                    path = path.format(marathon=marathon)
+                    latencies, errors = asyncio.run(load(
+                        port, path, token, options['concurrency'], options['duration']
+                    ))
+                    self.report(path, latencies, errors, options['duration'])
+            finally:
+                process.terminate()
+                process.wait()
+
+    def get_marathon_id(self):
+        marathon = Marathon.objects.order_by('-id').first()
+        return marathon.pk if marathon is not None else 0
+
+    def report(self, path, latencies, errors, duration):
+        if not latencies:
+            self.stderr.write(f"{path}: no responses")
+            return
+        self.stdout.write(
+            f"{path}: {len(latencies) / duration:.1f} req/s, "
+            f"p50 {percentile(latencies, 50):.2f}ms, "
+            f"p95 {percentile(latencies, 95):.2f}ms, "
+            f"p99 {percentile(latencies, 99):.2f}ms, "
+            f"mean {statistics.mean(latencies):.2f}ms, {errors} non 200"
+        )
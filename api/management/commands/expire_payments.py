@@ -0,0 +1,51 @@
+import json
+import time
+import signal
+
+from django.db import connections
+from django.core.management.base import BaseCommand
+
+from api.expiry import PaymentExpirySweeper
+
+
+class Command(BaseCommand):
+    help = (
+        "Cancel UNPAID payments whose validation date passed in chunks locked with "
+        "`FOR UPDATE SKIP LOCKED`, several sweepers can run at once"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help="Payments cancelled per transaction")
+        parser.add_argument('--max-chunks', type=int, default=None, help="Chunks per sweep, unlimited by default")
+        parser.add_argument('--pause', type=float, default=0.0, help="Seconds to sleep between chunks")
+        parser.add_argument('--dry-run', action='store_true', help="Report what would be cancelled")
+        parser.add_argument('--loop', action='store_true', help="Keep sweeping as a worker until stopped")
+        parser.add_argument('--interval', type=float, default=60.0, help="Seconds between sweeps with `--loop`")
+
+    def handle(self, *args, **options):
+        self.stopping = False
+        if options['loop']:
+            # Finish the current chunk on SIGTERM(e.g a deploy) rather than abort it
+            signal.signal(signal.SIGTERM, self.stop)
+
+        sweeper = PaymentExpirySweeper(
+            chunk_size=options['chunk_size'], dry_run=options['dry_run'],
+            pause=options['pause'], stdout=self.stdout if options['verbosity'] > 1 else None
+        )
+        while True:
+            stats = sweeper.sweep(max_chunks=options['max_chunks'], should_stop=lambda: self.stopping)
+            result = {'dry_run': options['dry_run'], **stats.as_dict()}
+            self.stdout.write(json.dumps(result))
+            if not options['loop'] or self.stopping:
+                break
+            # Don't hold a connection while idle
+            connections.close_all()
+            self.sleep(options['interval'])
+
+    def stop(self, signum, frame):
+        self.stopping = True
+
+    def sleep(self, seconds):
+        deadline = time.monotonic() + seconds
+        while not self.stopping and time.monotonic() < deadline:
+            time.sleep(min(1.0, deadline - time.monotonic()))
@@ -0,0 +1,140 @@
+import time
+import random
+import statistics
+
+from django.db import connection, transaction
+from django.utils import timezone
+from django.core.management.base import BaseCommand
+
+from api.models import User, Marathon, Category, Payment, MarathonStats
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare query plans and timings of payment listings through the "
+        "marathon join against the denormalized organizer and composite indexes"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--seed', type=int, default=0,
+            help="Create this many synthetic payments before benchmarking e.g 1000000"
+        )
+        parser.add_argument('--repeat', type=int, default=20, help="Runs per query")
+        parser.add_argument('--page-size', type=int, default=10)
+
+    def seed(self, count, batch_size=10000):
+        now = timezone.now()
+        organizers = User.objects.bulk_create([
+            User(username=f'bench-organizer-{i}-{now.timestamp()}') for i in range(20)
+        ])
+        clients = User.objects.bulk_create([
+            User(username=f'bench-client-{i}-{now.timestamp()}') for i in range(2000)
+        ])
+        marathons = Marathon.objects.bulk_create([
+            Marathon(
+                name=f'Bench marathon {i}', organizer=organizers[i % len(organizers)],
+                start_date=now, end_date=now
+            )
+            for i in range(200)
+        ])
+        categories = Category.objects.bulk_create([
+            Category(name=name, price=10, currency='USD', marathon=marathon)
+            for marathon in marathons for name in ('FULL', 'HALF')
+        ])
+
+        marathon_organizers = {marathon.pk: marathon.organizer_id for marathon in marathons}
+
+        created = 0
+        while created < count:
+            batch = []
+            for i in range(min(batch_size, count - created)):
+                category = random.choice(categories)
+                batch.append(Payment(
+                    marathon_id=category.marathon_id, category=category,
+                    organizer_id=marathon_organizers[category.marathon_id], user=random.choice(clients),
+                    status=random.choice(('PAID', 'UNPAID', 'CANCELLED')),
+                    validation_date=now
+                ))
+            with transaction.atomic():
+                Payment.objects.bulk_create(batch)
+            created += len(batch)
+            self.stdout.write(f"Seeded {created}/{count} payments", ending='\r')
+        self.stdout.write('')
+        # `bulk_create` bypasses `Payment.save`
+        MarathonStats.objects.rebuild(marathon_ids=list(marathon_organizers))
+
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                cursor.execute('ANALYZE api_payment')
+            else:
+                cursor.execute('ANALYZE')
+
+    def explain(self, queryset):
+        if connection.vendor == 'postgresql':
+            return queryset.explain(analyze=True, buffers=True)
+        return queryset.explain()
+
+    def timing(self, queryset, repeat):
+        durations = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            list(queryset.all())
+            durations.append((time.perf_counter() - start) * 1000)
+        return statistics.median(durations)
+
+    def report(self, title, queryset, repeat):
+        self.stdout.write(self.style.MIGRATE_HEADING(title))
+        self.stdout.write(self.explain(queryset))
+        self.stdout.write(self.style.SUCCESS(
+            f"median {self.timing(queryset, repeat):.3f}ms over {repeat} runs\n"
+        ))
+
+    def handle(self, *args, **options):
+        if options['seed']:
+            self.seed(options['seed'])
+
+        payment = Payment.objects.order_by('-id').first()
+        if payment is None:
+            self.stderr.write("No payments to benchmark, use --seed")
+            return
+
+        size = options['page_size']
+        repeat = options['repeat']
+        payments = Payment.objects.order_by('-id')
+        organizer_id = payment.organizer_id
+        deep_cursor = payments.filter(organizer_id=organizer_id).values_list(
+            'id', flat=True
+        )[size * 1000:size * 1000 + 1].first() or payment.pk
+
+        self.stdout.write(f"{Payment.objects.count()} payments on {connection.vendor}\n")
+        self.report(
+            "Organizer listing through marathon join",
+            payments.filter(marathon__organizer_id=organizer_id)[:size], repeat
+        )
+        self.report(
+            "Organizer listing through denormalized organizer",
+            payments.filter(organizer_id=organizer_id)[:size], repeat
+        )
+        self.report(
+            "Organizer deep page(keyset) through marathon join",
+            payments.filter(marathon__organizer_id=organizer_id, id__lt=deep_cursor)[:size], repeat
+        )
+        self.report(
+            "Organizer deep page(keyset) through denormalized organizer",
+            payments.filter(organizer_id=organizer_id, id__lt=deep_cursor)[:size], repeat
+        )
+        self.report(
+            "Client listing",
+            payments.filter(user_id=payment.user_id)[:size], repeat
+        )
+        self.report(
+            "Marathon payments by status",
+            payments.filter(marathon_id=payment.marathon_id, status='UNPAID')[:size], repeat
+        )
+        self.report(
+            "Expired unpaid payments",
+            Payment.objects.filter(
+                status='UNPAID', validation_date__lt=timezone.now()
+            ).order_by('validation_date')[:size], repeat
+        )
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from api.idempotency import idempotency_store
+
+
+class Command(BaseCommand):
+    help = "Delete stored responses and locks of expired `Idempotency-Key`s"
+
+    def handle(self, *args, **options):
+        deleted = idempotency_store.purge_expired()
+        self.stdout.write(f"Deleted {deleted} expired idempotency keys")
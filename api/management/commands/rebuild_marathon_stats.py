@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from api.models import MarathonStats
+
+
+class Command(BaseCommand):
+    help = "Recompute marathon registration stats from payments to fix any drift"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'marathons', nargs='*', type=int,
+            help="Ids of marathons to rebuild, all marathons are rebuilt if omitted"
+        )
+
+    def handle(self, *args, **options):
+        marathon_ids = options['marathons'] or None
+        rows = MarathonStats.objects.rebuild(marathon_ids=marathon_ids)
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {len(rows)} stats rows"))
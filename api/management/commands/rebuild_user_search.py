@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from api.models import UserSearchGram, uses_search_grams
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the n-gram table which indexes substring searches of user "
+        "emails and usernames(PostgreSQL uses trigram indexes instead)"
+    )
+
+    def handle(self, *args, **options):
+        if not uses_search_grams():
+            self.stdout.write("Trigram indexes of PostgreSQL need no rebuild")
+            return
+        count = UserSearchGram.objects.rebuild()
+        self.stdout.write(self.style.SUCCESS(f"Indexed {count} grams"))
@@ -0,0 +1,38 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.seeding import Seeder
+
+
+class Command(BaseCommand):
+    help = (
+        "Create synthetic users(across admin, organizer and client groups), "
+        "marathons, categories, sponsors and payments in bulk"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--marathons', type=int, default=100)
+        parser.add_argument('--categories', type=int, default=2, help="Categories per marathon")
+        parser.add_argument('--sponsors', type=int, default=2, help="Sponsors per marathon")
+        parser.add_argument('--payments', type=int, default=100000)
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=0, help="Seed of the random generator")
+        parser.add_argument(
+            '--prefix', default='seed',
+            help="Prefix of usernames and marathon names, use a new one to seed again"
+        )
+
+    def handle(self, *args, **options):
+        seeder = Seeder(
+            prefix=options['prefix'], seed=options['seed'],
+            batch_size=options['batch_size'], stdout=self.stdout
+        )
+        start = time.perf_counter()
+        seeder.seed(
+            users=options['users'], marathons=options['marathons'],
+            payments=options['payments'], categories=options['categories'],
+            sponsors=options['sponsors']
+        )
+        self.stdout.write(self.style.SUCCESS(f"Seeded in {time.perf_counter() - start:.1f}s"))
@@ -0,0 +1,40 @@
+from django.db import migrations, models
+from django.db.models import Count
+import django.db.models.deletion
+
+
+def populate_stats(apps, schema_editor):
+    Payment = apps.get_model('api', 'Payment')
+    MarathonStats = apps.get_model('api', 'MarathonStats')
+    counts = Payment.objects.order_by().values('marathon_id', 'category_id', 'status')
+    MarathonStats.objects.bulk_create([
+        MarathonStats(
+            marathon_id=row['marathon_id'], category_id=row['category_id'],
+            status=row['status'], registrations=row['registrations']
+        )
+        for row in counts.annotate(registrations=Count('id'))
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_auto_20261018_0350'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MarathonStats',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('status', models.CharField(choices=[('PAID', 'Paid'), ('UNPAID', 'Unpaid'), ('CANCELLED', 'Cancelled')], max_length=256)),
+                ('registrations', models.IntegerField(default=0)),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stats', to='api.Category')),
+                ('marathon', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stats', to='api.Marathon')),
+            ],
+            options={
+                'unique_together': {('marathon', 'category', 'status')},
+            },
+        ),
+        migrations.RunPython(populate_stats, migrations.RunPython.noop),
+    ]
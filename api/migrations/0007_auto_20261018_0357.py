@@ -0,0 +1,43 @@
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+import django.db.models.deletion
+
+
+def populate_organizers(apps, schema_editor):
+    Payment = apps.get_model('api', 'Payment')
+    Marathon = apps.get_model('api', 'Marathon')
+    organizer = Marathon.objects.filter(pk=OuterRef('marathon_id')).values('organizer_id')[:1]
+    Payment.objects.update(organizer_id=Subquery(organizer))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_marathonstats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='payment',
+            name='organizer',
+            field=models.ForeignKey(db_index=False, editable=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='organized_payments', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunPython(populate_organizers, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['user', '-id'], name='payment_user_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['organizer', '-id'], name='payment_organizer_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['marathon', 'status', '-id'], name='payment_marathon_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['status', 'validation_date'], name='payment_status_validation_idx'),
+        ),
+    ]
@@ -0,0 +1,87 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+SEARCH_FIELDS = ('email', 'username')
+
+
+def create_gram_table(apps, schema_editor):
+    # PostgreSQL searches through trigram indexes, the table would stay unused
+    if schema_editor.connection.vendor == 'postgresql':
+        return
+    schema_editor.create_model(apps.get_model('api', 'UserSearchGram'))
+
+
+def drop_gram_table(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        return
+    schema_editor.delete_model(apps.get_model('api', 'UserSearchGram'))
+
+
+def create_trigram_indexes(apps, schema_editor):
+    # `UPPER(<field>) LIKE UPPER(%s)` of `icontains` is served by these
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for field in SEARCH_FIELDS:
+        schema_editor.execute(
+            f'CREATE INDEX CONCURRENTLY IF NOT EXISTS api_user_{field}_trgm_idx '
+            f'ON api_user USING gin (UPPER({field}::text) gin_trgm_ops)'
+        )
+
+
+def index_existing_users(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        return
+    User = apps.get_model('api', 'User')
+    UserSearchGram = apps.get_model('api', 'UserSearchGram')
+    grams = []
+    for user in User.objects.only(*SEARCH_FIELDS).iterator(chunk_size=5000):
+        for field in SEARCH_FIELDS:
+            value = (getattr(user, field) or '').upper()
+            grams.extend(
+                UserSearchGram(user_id=user.pk, field=field, gram=gram)
+                for gram in {value[i:i + 3] for i in range(len(value) - 2)}
+            )
+        if len(grams) >= 5000:
+            UserSearchGram.objects.bulk_create(grams)
+            grams = []
+    UserSearchGram.objects.bulk_create(grams)
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for field in SEARCH_FIELDS:
+        schema_editor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS api_user_{field}_trgm_idx')
+
+
+class Migration(migrations.Migration):
+    # Indexes are built concurrently, which can't run in a transaction
+    atomic = False
+
+    dependencies = [
+        ('api', '0009_idempotencykey'),
+    ]
+
+    operations = [
+        # The table is created by `create_gram_table` but on PostgreSQL
+        migrations.SeparateDatabaseAndState(state_operations=[
+            migrations.CreateModel(
+                name='UserSearchGram',
+                fields=[
+                    ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                    ('field', models.CharField(choices=[('email', 'email'), ('username', 'username')], max_length=16)),
+                    ('gram', models.CharField(max_length=3)),
+                    ('user', models.ForeignKey(on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ],
+                options={
+                    'constraints': [models.UniqueConstraint(fields=('field', 'gram', 'user'), name='user_search_gram_unique')],
+                },
+            ),
+        ]),
+        migrations.RunPython(create_gram_table, drop_gram_table),
+        migrations.RunPython(index_existing_users, migrations.RunPython.noop),
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
@@ -0,0 +1,43 @@
+import unicodedata
+
+from django.db import migrations
+
+
+SEARCH_FIELDS = ('email', 'username')
+
+
+def fold(value):
+    value = unicodedata.normalize('NFKD', (value or '').casefold())
+    return ''.join(char for char in value if not unicodedata.combining(char))
+
+
+def fold_grams(apps, schema_editor):
+    # Grams were upper cased, searches now fold case and accents
+    if schema_editor.connection.vendor == 'postgresql':
+        return
+    User = apps.get_model('api', 'User')
+    UserSearchGram = apps.get_model('api', 'UserSearchGram')
+    UserSearchGram.objects.all().delete()
+    grams = []
+    for user in User.objects.only(*SEARCH_FIELDS).iterator(chunk_size=5000):
+        for field in SEARCH_FIELDS:
+            value = fold(getattr(user, field))
+            grams.extend(
+                UserSearchGram(user_id=user.pk, field=field, gram=gram)
+                for gram in {value[i:i + 3] for i in range(len(value) - 2)}
+            )
+        if len(grams) >= 5000:
+            UserSearchGram.objects.bulk_create(grams)
+            grams = []
+    UserSearchGram.objects.bulk_create(grams)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_usersearchgram'),
+    ]
+
+    operations = [
+        migrations.RunPython(fold_grams, migrations.RunPython.noop),
+    ]
@@ -1,11 +1,23 @@
-from django.db import models
+import itertools
+import contextlib
+import contextvars
+import unicodedata
+
+from django.db import models, transaction, connections, IntegrityError, DEFAULT_DB_ALIAS
 from django.conf import settings
-from django.db.models import ProtectedError
-from django.contrib.auth.models import AbstractUser
-from django.db.models.signals import post_save
+from django.utils import timezone
+from django.db.models import ProtectedError, Exists, OuterRef, F, Count
+from django.core.serializers.json import DjangoJSONEncoder
+from django.contrib.auth.models import AbstractUser, Group, UserManager
+from django.db.models.signals import post_save, pre_delete, post_delete, m2m_changed
 from django.dispatch import receiver
 from rest_framework.authtoken.models import Token
 
+from .groups import get_group_id, clear_group_ids
+from .principal import Principal, get_principal, invalidate_principals
+from .authentication import token_cache
+from .response_cache import marathon_response_cache
+
 
 GENDER_CHOICES = (
     ('M', 'Male'),
@@ -35,22 +47,210 @@ def create_auth_token(sender, instance=None, created=False, **kwargs):
         Token.objects.create(user=instance)
 
 
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def invalidate_cached_token(sender, instance=None, created=False, **kwargs):
+    # Cached tokens hold a snapshot of the user(including `is_active`)
+    if not created:
+        token_cache.invalidate(
+            Token.objects.filter(user=instance).values_list('key', flat=True)
+        )
+
+
+@receiver(post_delete, sender=Token)
+def invalidate_deleted_token(sender, instance=None, **kwargs):
+    token_cache.invalidate([instance.key])
+
+
+ROLES = ('admin', 'organizer', 'client')
+
+
+def role_annotation(role):
+    """Name of the annotation which holds the membership flag of `role`"""
+    return f'has_{role}_role'
+
+
+class UserQuerySet(models.QuerySet):
+    def with_roles(self):
+        """
+        Annotate role flags with `Exists()` subqueries so that
+        `is_admin`, `is_organizer` and `is_client` don't query per user.
+        """
+        return self.annotate(**{
+            role_annotation(role): Exists(
+                Group.objects.filter(user=OuterRef('pk'), name=role)
+            )
+            for role in ROLES
+        })
+
+
+class RoleUserManager(UserManager.from_queryset(UserQuerySet)):
+    def create_user_with_role(self, username, email, password, role, **extra_fields):
+        """
+        Create a user in the group of `role` in one transaction, the token is
+        created once(by `create_auth_token`) and the user comes back with its
+        roles, principal, token and(empty) payments already loaded.
+        """
+        with transaction.atomic():
+            user = self.create_user(username, email, password, **extra_fields)
+            User.groups.through.objects.create(user_id=user.pk, group_id=get_group_id(role))
+
+        for name in ROLES:
+            setattr(user, role_annotation(name), name == role)
+        user._principal = Principal(user, frozenset([role]))
+        user._prefetched_objects_cache = {'payments': Payment.objects.none()}
+        return user
+
+
 class User(AbstractUser):
     full_name = models.CharField(max_length=256, blank=True)
     phone = models.CharField(max_length=256, blank=True, null=True)
     gender = models.CharField(max_length=1, blank=True, choices=GENDER_CHOICES)
 
+    objects = RoleUserManager()
+
+    def has_role(self, role):
+        annotated = self.__dict__.get(role_annotation(role))
+        if annotated is not None:
+            return annotated
+        return get_principal(self).in_group(role)
+
     @property
     def is_admin(self):
-        return super().is_staff or self.groups.filter(name='admin').exists()
+        return super().is_staff or self.has_role('admin')
 
     @property
     def is_organizer(self):
-        return self.groups.filter(name='organizer').exists()
+        return self.has_role('organizer')
 
     @property
     def is_client(self):
-        return self.groups.filter(name='client').exists()
+        return self.has_role('client')
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def invalidate_user_groups(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear' and reverse:
+        # `pk_set` is not provided on clear, so collect members before they go
+        invalidate_principals(instance.user_set.values_list('pk', flat=True))
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        if reverse:
+            invalidate_principals(pk_set or [])
+        else:
+            instance.__dict__.pop('_principal', None)
+            invalidate_principals([instance.pk])
+
+
+@receiver(post_save, sender=Group)
+@receiver(pre_delete, sender=Group)
+def invalidate_group_members(sender, instance, created=False, **kwargs):
+    clear_group_ids()
+    if not created:
+        invalidate_principals(instance.user_set.values_list('pk', flat=True))
+
+
+# Fields of users searched by substring(`icontains`) from the support console
+SEARCH_FIELDS = ('email', 'username')
+
+GRAM_SIZE = 3
+
+
+def fold(value):
+    """
+    Case and accent folded `value`(e.g `Straße` and `STRASSE` give `strasse`),
+    at least as loose as database collations so that grams never miss a row
+    `icontains` matches.
+    """
+    value = unicodedata.normalize('NFKD', (value or '').casefold())
+    return ''.join(char for char in value if not unicodedata.combining(char))
+
+
+def ngrams(value):
+    """Distinct folded trigrams of `value`, empty if it's shorter than a gram"""
+    value = fold(value)
+    return {value[i:i + GRAM_SIZE] for i in range(len(value) - GRAM_SIZE + 1)}
+
+
+def uses_search_grams(using=DEFAULT_DB_ALIAS):
+    """PostgreSQL has trigram indexes(`pg_trgm`), other backends `UserSearchGram`"""
+    return connections[using].vendor != 'postgresql'
+
+
+class UserSearchGramManager(models.Manager):
+    def index(self, users, batch_size=5000):
+        """Add grams of `users` which have none yet(e.g just created), returns their number"""
+        rows = (
+            (user.pk, field, gram)
+            for user in users
+            for field in SEARCH_FIELDS
+            for gram in ngrams(getattr(user, field))
+        )
+        # Users have dozens of grams, plain tuples insert them far faster than models
+        connection = connections[self.db]
+        quote = connection.ops.quote_name
+        sql = (
+            f"INSERT INTO {quote(self.model._meta.db_table)} "
+            f"({quote('user_id')}, {quote('field')}, {quote('gram')}) VALUES (%s, %s, %s)"
+        )
+        count = 0
+        with connection.cursor() as cursor:
+            while batch := list(itertools.islice(rows, batch_size)):
+                # In the order of the unique index, its pages are then written once
+                batch.sort(key=lambda row: (row[1], row[2], row[0]))
+                cursor.executemany(sql, batch)
+                count += len(batch)
+        return count
+
+    def reindex(self, user):
+        with transaction.atomic():
+            self.filter(user_id=user.pk).delete()
+            self.index([user])
+
+    def rebuild(self, batch_size=5000):
+        """Recompute grams of every user, returns the number of grams"""
+        users = User.objects.only(*SEARCH_FIELDS).order_by('pk')
+        with transaction.atomic():
+            self.all().delete()
+            return self.index(users.iterator(chunk_size=batch_size), batch_size)
+
+
+class UserSearchGram(models.Model):
+    """
+    Trigram of the email or username of a user, an inverted index which
+    narrows `icontains` searches down on backends without `pg_trgm`. The
+    table isn't created on PostgreSQL(see migration 0010), it's only used
+    where `uses_search_grams()`.
+    """
+    id = models.BigAutoField(primary_key=True)
+    # Grams are deleted with their user by `delete_user_search_grams`, a
+    # cascade would have every user delete query the table
+    user = models.ForeignKey(User, on_delete=models.DO_NOTHING, related_name='+')
+    field = models.CharField(max_length=16, choices=[(field, field) for field in SEARCH_FIELDS])
+    gram = models.CharField(max_length=GRAM_SIZE)
+
+    objects = UserSearchGramManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['field', 'gram', 'user'], name='user_search_gram_unique'),
+        ]
+
+
+@receiver(post_save, sender=User)
+def index_user_search_grams(sender, instance=None, created=False, update_fields=None, **kwargs):
+    if not uses_search_grams():
+        return
+    if update_fields is not None and not set(update_fields) & set(SEARCH_FIELDS):
+        return
+    if created:
+        UserSearchGram.objects.index([instance])
+    else:
+        UserSearchGram.objects.reindex(instance)
+
+
+@receiver(pre_delete, sender=User)
+def delete_user_search_grams(sender, instance=None, using=DEFAULT_DB_ALIAS, **kwargs):
+    if uses_search_grams(using):
+        UserSearchGram.objects.using(using).filter(user_id=instance.pk).delete()
 
 
 class Marathon(models.Model):
@@ -60,6 +260,15 @@ class Marathon(models.Model):
     organizer = models.ForeignKey(User, on_delete=models.CASCADE, related_name='marathons')
     start_date = models.DateTimeField()
     end_date = models.DateTimeField()
+    # Bumped on changes to categories, sponsors and organizer too(used for ETags)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+
+@receiver(post_save, sender=Marathon)
+def sync_payments_organizer(sender, instance=None, created=False, **kwargs):
+    if not created:
+        organizer_id = instance.organizer_id
+        instance.payments.exclude(organizer_id=organizer_id).update(organizer_id=organizer_id)
 
 
 class Category(models.Model):
@@ -68,12 +277,69 @@ class Category(models.Model):
     price = models.FloatField()
     currency = models.CharField(max_length=256, choices=CURRENCY_CHOICES)
     marathon = models.ForeignKey(Marathon, on_delete=models.CASCADE, related_name='categories')
+    updated_at = models.DateTimeField(auto_now=True)
 
 
 class Sponsor(models.Model):
     id = models.AutoField(primary_key=True)
     name = models.CharField(max_length=256)
     marathon = models.ForeignKey(Marathon, on_delete=models.CASCADE, related_name='sponsors')
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+# Marathons touched by the block of `deferred_marathon_touches` running
+_deferred_touches = contextvars.ContextVar('deferred_touches', default=None)
+
+
+@contextlib.contextmanager
+def deferred_marathon_touches():
+    """
+    Touch marathons of categories and sponsors saved or deleted in the
+    block(and invalidate cached responses) once when it succeeds instead
+    of once per row, yields the set of marathon ids to touch.
+    """
+    touched = set()
+    token = _deferred_touches.set(touched)
+    try:
+        yield touched
+    finally:
+        _deferred_touches.reset(token)
+    if touched:
+        Marathon.objects.filter(pk__in=touched).update(updated_at=timezone.now())
+        marathon_response_cache.invalidate()
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=Sponsor)
+@receiver(post_delete, sender=Sponsor)
+def touch_marathon(sender, instance=None, **kwargs):
+    touched = _deferred_touches.get()
+    if touched is not None:
+        touched.add(instance.marathon_id)
+        return
+    Marathon.objects.filter(pk=instance.marathon_id).update(updated_at=timezone.now())
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def touch_organized_marathons(sender, instance=None, created=False, **kwargs):
+    # Marathons embed their organizer
+    if not created:
+        if Marathon.objects.filter(organizer=instance).update(updated_at=timezone.now()):
+            marathon_response_cache.invalidate()
+
+
+@receiver(post_save, sender=Marathon)
+@receiver(post_delete, sender=Marathon)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=Sponsor)
+@receiver(post_delete, sender=Sponsor)
+def invalidate_marathon_responses(sender, **kwargs):
+    if sender is not Marathon and _deferred_touches.get() is not None:
+        # Invalidated with the deferred touch
+        return
+    marathon_response_cache.invalidate()
 
 
 class Payment(models.Model):
@@ -81,12 +347,156 @@ class Payment(models.Model):
     marathon = models.ForeignKey(Marathon, on_delete=models.CASCADE, related_name='payments')
     category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='payment')
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='payments')
+    # Denormalized `marathon.organizer` so that organizer listings don't join marathons
+    organizer = models.ForeignKey(
+        User, on_delete=models.CASCADE, related_name='organized_payments',
+        null=True, editable=False, db_index=False
+    )
     status = models.CharField(max_length=256, choices=PAYMENT_STATUS_CHOICES)
     validation_date = models.DateTimeField()
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        # Match access paths of `PaymentViewSet` listings and expiry lookups
+        indexes = [
+            models.Index(fields=['user', '-id'], name='payment_user_id_idx'),
+            models.Index(fields=['organizer', '-id'], name='payment_organizer_id_idx'),
+            models.Index(fields=['marathon', 'status', '-id'], name='payment_marathon_status_idx'),
+            models.Index(fields=['status', 'validation_date'], name='payment_status_validation_idx'),
+        ]
+
+    STATS_FIELDS = ('marathon_id', 'category_id', 'status')
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if all(field in instance.__dict__ for field in cls.STATS_FIELDS):
+            instance._saved_stats_key = instance.stats_key
+        return instance
+
+    @property
+    def stats_key(self):
+        return tuple(getattr(self, field) for field in self.STATS_FIELDS)
+
+    def get_saved_stats_key(self):
+        """Get the stats key of this payment as currently stored in the db"""
+        if self._state.adding:
+            return None
+        saved_stats_key = getattr(self, '_saved_stats_key', None)
+        if saved_stats_key is None:
+            # Some fields were deferred when this payment was loaded
+            saved_stats_key = Payment.objects.filter(pk=self.pk).values_list(*self.STATS_FIELDS).first()
+            self._saved_stats_key = saved_stats_key
+        return saved_stats_key
+
+    def sync_organizer(self):
+        if Payment.marathon.is_cached(self):
+            self.organizer_id = self.marathon.organizer_id
+        else:
+            self.organizer_id = Marathon.objects.values_list(
+                'organizer_id', flat=True
+            ).get(pk=self.marathon_id)
+
+    def save(self, *args, **kwargs):
+        # Keep `MarathonStats` in sync within the same transaction
+        with transaction.atomic(using=kwargs.get('using')):
+            previous = self.get_saved_stats_key()
+            if self.organizer_id is None or previous is None or previous[0] != self.marathon_id:
+                self.sync_organizer()
+            super().save(*args, **kwargs)
+            current = self.stats_key
+            if previous != current:
+                if previous is not None:
+                    MarathonStats.objects.add(*previous, delta=-1)
+                MarathonStats.objects.add(*current, delta=1)
+        self._saved_stats_key = current
+
     def delete(self, using=None, keep_parents=False):
         if self.status != 'PAID':
             return super().delete(using=using, keep_parents=keep_parents)
-        raise ProtectedError("Can't delete paid payment", self)
\ No newline at end of file
+        raise ProtectedError("Can't delete paid payment", self)
+
+
+class MarathonStatsManager(models.Manager):
+    def add(self, marathon_id, category_id, status, delta):
+        """Add `delta` to the number of registrations of a summary row"""
+        rows = self.filter(marathon_id=marathon_id, category_id=category_id, status=status)
+        if rows.update(registrations=F('registrations') + delta) or delta < 0:
+            # Nothing to create when decrementing, the row is gone
+            # only if its marathon or category is being deleted
+            return
+        try:
+            with transaction.atomic():
+                self.create(
+                    marathon_id=marathon_id, category_id=category_id,
+                    status=status, registrations=delta
+                )
+        except IntegrityError:
+            # Created by a concurrent transaction
+            rows.update(registrations=F('registrations') + delta)
+
+    def rebuild(self, marathon_ids=None):
+        """Recompute summary rows from payments, this fixes any drift"""
+        payments = Payment.objects.all()
+        stats = self.all()
+        if marathon_ids is not None:
+            payments = payments.filter(marathon_id__in=marathon_ids)
+            stats = stats.filter(marathon_id__in=marathon_ids)
+
+        counts = payments.order_by().values('marathon_id', 'category_id', 'status')
+        with transaction.atomic():
+            stats.delete()
+            return self.bulk_create([
+                MarathonStats(
+                    marathon_id=row['marathon_id'], category_id=row['category_id'],
+                    status=row['status'], registrations=row['registrations']
+                )
+                for row in counts.annotate(registrations=Count('id'))
+            ])
+
+
+class MarathonStats(models.Model):
+    """
+    Number of registrations per marathon, category and payment status,
+    maintained incrementally as payments are created, updated and deleted.
+    Prices and currencies are read from categories so that they never drift.
+    """
+    id = models.AutoField(primary_key=True)
+    marathon = models.ForeignKey(Marathon, on_delete=models.CASCADE, related_name='stats')
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='stats')
+    status = models.CharField(max_length=256, choices=PAYMENT_STATUS_CHOICES)
+    registrations = models.IntegerField(default=0)
+
+    objects = MarathonStatsManager()
+
+    class Meta:
+        unique_together = ('marathon', 'category', 'status')
+
+
+@receiver(pre_delete, sender=Payment)
+def load_payment_stats_key(sender, instance=None, **kwargs):
+    instance.get_saved_stats_key()
+
+
+@receiver(post_delete, sender=Payment)
+def remove_payment_from_stats(sender, instance=None, **kwargs):
+    # Sent for cascading deletes too, which don't call `Payment.delete`
+    MarathonStats.objects.add(*instance.get_saved_stats_key(), delta=-1)
+
+
+class IdempotencyKey(models.Model):
+    """
+    Response of a request sent with an `Idempotency-Key` header, replayed
+    for repeats of the request. `status_code` is null while the request is
+    in flight, the row is then a lock which expires at `expires_at` like
+    stored responses do.
+    """
+    # Digest of the key and its scope(user, method and path)
+    key = models.CharField(max_length=64, primary_key=True)
+    fingerprint = models.CharField(max_length=64)
+    status_code = models.IntegerField(null=True)
+    data = models.JSONField(null=True, encoder=DjangoJSONEncoder)
+    headers = models.JSONField(default=dict)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
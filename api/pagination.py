@@ -0,0 +1,90 @@
+import json
+
+from asgiref.sync import sync_to_async
+from django.db import connections
+from rest_framework.response import Response
+from rest_framework.pagination import CursorPagination, PageNumberPagination
+
+
+def approximate_count(queryset):
+    """
+    Get the number of rows the database planner expects `queryset` to
+    return, this reads planner statistics instead of running `COUNT(*)`.
+    Returns `None` on databases other than PostgreSQL.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+
+    sql, params = queryset.order_by().query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+class KeysetPagination(CursorPagination):
+    """
+    Opaque cursor pagination on `id`, pages are fetched with
+    `WHERE id < cursor` so deep pages cost the same as the first one
+    and no `COUNT(*)` is performed.
+
+    Clients which still send `?page=<number>` get the old page number
+    pagination, `?approximate_count=true` adds an estimated total.
+    """
+    ordering = '-id'
+    page_number_query_param = 'page'
+    approximate_count_query_param = 'approximate_count'
+
+    def use_page_numbers(self, request):
+        self.page_number_pagination = None
+        self.count_estimate = None
+        if self.page_number_query_param in request.query_params:
+            self.page_number_pagination = PageNumberPagination()
+            return True
+        return False
+
+    def wants_approximate_count(self, request):
+        value = request.query_params.get(self.approximate_count_query_param, '')
+        return value.lower() in ('1', 'true')
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.use_page_numbers(request):
+            return self.page_number_pagination.paginate_queryset(queryset, request, view)
+
+        if self.wants_approximate_count(request):
+            self.count_estimate = approximate_count(queryset)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_ordering(self, request, queryset, view):
+        """
+        Ordering with ties broken by pk, rows sharing a position are then
+        in the same order both ways and cursor offsets point at the same rows.
+        """
+        ordering = tuple(super().get_ordering(request, queryset, view))
+        pk = queryset.model._meta.pk.name
+        if not any(field.lstrip('-') in ('pk', pk) for field in ordering):
+            ordering += ('-pk' if ordering[0].startswith('-') else 'pk',)
+        return ordering
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        """
+        `paginate_queryset` for async views, run in a thread like the async
+        ORM runs queries(which is one hop for the whole page).
+        """
+        return await sync_to_async(self.paginate_queryset)(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.page_number_pagination is not None:
+            return self.page_number_pagination.get_paginated_response(data)
+
+        response_data = {
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+        }
+        if self.count_estimate is not None:
+            response_data['approximate_count'] = self.count_estimate
+        response_data['results'] = data
+        return Response(response_data)
@@ -0,0 +1,33 @@
+import orjson
+from rest_framework.parsers import JSONParser, BaseParser
+from rest_framework.exceptions import ParseError
+
+from .renderers import ORJSONRenderer, MessagePackRenderer, msgpack
+
+
+class ORJSONParser(JSONParser):
+    """`JSONParser` decoding with orjson, it rejects `NaN` and `Infinity` too"""
+    renderer_class = ORJSONRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', 'utf-8')
+        content = stream.read() if stream is not None else b''
+        try:
+            if encoding.lower().replace('-', '') != 'utf8':
+                content = content.decode(encoding)
+            return orjson.loads(content)
+        except (ValueError, UnicodeDecodeError) as exc:
+            raise ParseError('JSON parse error - %s' % str(exc))
+
+
+class MessagePackParser(BaseParser):
+    """Parser for `application/msgpack` request bodies, needs `msgpack`"""
+    media_type = 'application/msgpack'
+    renderer_class = MessagePackRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return msgpack.unpackb(stream.read(), raw=False, strict_map_key=False)
+        except (ValueError, msgpack.ExtraData, msgpack.FormatError, msgpack.StackError) as exc:
+            raise ParseError('MessagePack parse error - %s' % str(exc))
@@ -1,4 +1,22 @@
 from rest_framework import permissions
+from django.contrib.auth.models import Group
+from drf_guard import permissions as guard_permissions
+
+from .principal import get_principal
+
+
+class HasRequiredGroups(guard_permissions.HasRequiredGroups):
+    """
+    Ensure user is in required groups, memberships are read from the
+    request principal instead of querying the database for every group.
+    """
+    @classmethod
+    def is_in_group(cls, user, group):
+        if isinstance(group, Group):
+            group = group.name
+        if isinstance(group, str) and group != '__all__':
+            return get_principal(user).in_group(group)
+        return super().is_in_group(user, group)
 
 
 class IsAllowedUser(permissions.BasePermission):
@@ -16,7 +34,7 @@ class IsCategoryOwner(permissions.BasePermission):
     """
 
     def has_object_permission(self, request, view, obj):
-        return obj.marathon.organizer == request.user
+        return obj.marathon.organizer_id == request.user.pk
 
 
 class IsSponsorOwner(permissions.BasePermission):
@@ -25,7 +43,7 @@ class IsSponsorOwner(permissions.BasePermission):
     """
 
     def has_object_permission(self, request, view, obj):
-        return obj.marathon.organizer == request.user
+        return obj.marathon.organizer_id == request.user.pk
 
 
 class IsMarathonOwner(permissions.BasePermission):
@@ -34,7 +52,7 @@ class IsMarathonOwner(permissions.BasePermission):
     """
 
     def has_object_permission(self, request, view, obj):
-        return obj.organizer == request.user
+        return obj.organizer_id == request.user.pk
         
 
 class IsPaymentOwner(permissions.BasePermission):
@@ -43,7 +61,8 @@ class IsPaymentOwner(permissions.BasePermission):
     """
 
     def has_object_permission(self, request, view, obj):
-        return obj.user == request.user or obj.marathon.organizer == request.user
+        user = request.user
+        return user.is_authenticated and user.pk in (obj.user_id, obj.organizer_id)
 
 
 class IsAdminUser(permissions.BasePermission):
@@ -52,4 +71,4 @@ class IsAdminUser(permissions.BasePermission):
     """
 
     def has_permission(self, request, view):
-        return request.user.is_authenticated and request.user.is_admin
\ No newline at end of file
+        return request.user.is_authenticated and get_principal(request.user).is_admin
\ No newline at end of file
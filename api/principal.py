@@ -0,0 +1,97 @@
+from django.conf import settings
+from django.core.cache import caches
+
+
+# How long (in seconds) group memberships are cached, signals invalidate them
+# in the cache of the worker making the change so unless the cache is shared
+# by all workers this bounds how long the others keep a revoked membership
+GROUPS_CACHE_TIMEOUT = getattr(settings, 'PRINCIPAL_GROUPS_CACHE_TIMEOUT', 300)
+
+# Alias of the cache in `CACHES` memberships are kept in, shared by all workers
+GROUPS_CACHE_ALIAS = getattr(settings, 'PRINCIPAL_GROUPS_CACHE', 'shared')
+
+
+def groups_cache():
+    return caches[GROUPS_CACHE_ALIAS]
+
+
+def groups_cache_key(user_id):
+    return f'principal:groups:{user_id}'
+
+
+class Principal():
+    """
+    Authenticated user together with the names of the groups it belongs to,
+    all group and role checks during a request should be answered from here.
+    """
+    def __init__(self, user, groups):
+        self.user = user
+        self.groups = groups
+
+    def in_group(self, name):
+        return name in self.groups
+
+    @property
+    def is_admin(self):
+        return self.user.is_staff or self.in_group('admin')
+
+    @property
+    def is_organizer(self):
+        return self.in_group('organizer')
+
+    @property
+    def is_client(self):
+        return self.in_group('client')
+
+
+def load_group_names(user):
+    if not user.is_authenticated:
+        return frozenset()
+
+    cache = groups_cache()
+    key = groups_cache_key(user.pk)
+    groups = cache.get(key)
+    if groups is None:
+        groups = frozenset(user.groups.values_list('name', flat=True))
+        cache.set(key, groups, GROUPS_CACHE_TIMEOUT)
+    return groups
+
+
+async def aload_group_names(user):
+    if not user.is_authenticated:
+        return frozenset()
+
+    cache = groups_cache()
+    key = groups_cache_key(user.pk)
+    groups = await cache.aget(key)
+    if groups is None:
+        groups = frozenset([
+            name async for name in user.groups.values_list('name', flat=True)
+        ])
+        await cache.aset(key, groups, GROUPS_CACHE_TIMEOUT)
+    return groups
+
+
+def get_principal(user):
+    """
+    Get the principal of `user`, group names are loaded at most once
+    per user instance i.e once per request for `request.user`.
+    """
+    principal = getattr(user, '_principal', None)
+    if principal is None:
+        principal = Principal(user, load_group_names(user))
+        user._principal = principal
+    return principal
+
+
+async def aget_principal(user):
+    """Async counterpart of `get_principal`"""
+    principal = getattr(user, '_principal', None)
+    if principal is None:
+        principal = Principal(user, await aload_group_names(user))
+        user._principal = principal
+    return principal
+
+
+def invalidate_principals(user_ids):
+    groups_cache().delete_many([groups_cache_key(user_id) for user_id in user_ids])
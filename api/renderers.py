@@ -0,0 +1,69 @@
+import re
+
+import orjson
+from rest_framework.renderers import JSONRenderer, BaseRenderer
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+# Floats orjson and `json` write differently, `json` switches to exponents
+# below 1e-4(orjson writes `0.00001`) and writes them as `1e+16`(orjson `1e16`).
+# Led by a literal so that it's searched fast, strings matching it only
+# cost a fallback
+EXPONENT = re.compile(rb'e(?=[-+0-9])(?<=[0-9]e)')
+SMALL_FLOAT = b'0.0000'
+
+LINE_SEPARATORS = ((b'\xe2\x80\xa8', b'\\u2028'), (b'\xe2\x80\xa9', b'\\u2029'))
+
+
+class ORJSONRenderer(JSONRenderer):
+    """
+    `JSONRenderer` encoding with orjson, the output is the same byte for
+    byte. Indented output, ASCII only output and data orjson encodes
+    differently(tiny or huge floats, non string keys, big integers) are
+    rendered by `JSONRenderer`.
+    """
+    options = orjson.OPT_PASSTHROUGH_DATETIME
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+
+        renderer_context = renderer_context or {}
+        if self.ensure_ascii or not self.compact \
+                or self.get_indent(accepted_media_type, renderer_context) is not None:
+            return super().render(data, accepted_media_type, renderer_context)
+
+        try:
+            content = orjson.dumps(data, default=self.encoder_class().default, option=self.options)
+        except (orjson.JSONEncodeError, TypeError):
+            return super().render(data, accepted_media_type, renderer_context)
+
+        if SMALL_FLOAT in content or EXPONENT.search(content):
+            return super().render(data, accepted_media_type, renderer_context)
+        for separator, escaped in LINE_SEPARATORS:
+            if separator in content:
+                content = content.replace(separator, escaped)
+        return content
+
+
+class MessagePackRenderer(BaseRenderer):
+    """
+    Renderer for `application/msgpack`, values JSON has no type for(e.g
+    dates) are encoded like `JSONRenderer` encodes them. Needs `msgpack`.
+    """
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+    encoder_class = JSONRenderer.encoder_class
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return msgpack.packb(
+            data, default=self.encoder_class().default, use_bin_type=True, datetime=False
+        )
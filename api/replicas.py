@@ -0,0 +1,266 @@
+import time
+import logging
+import itertools
+import threading
+import contextvars
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connections, DEFAULT_DB_ALIAS, DatabaseError
+from rest_framework.permissions import SAFE_METHODS
+
+
+logger = logging.getLogger('api.replicas')
+
+DEFAULTS = {
+    # Aliases in `DATABASES` to read from, all but `default` if None
+    'ALIASES': None,
+    # Seconds reads of a user stick to the primary after a write
+    'STICKY_SECONDS': 5,
+    # Cookie which pins browsers(and anonymous writers) to the primary
+    'COOKIE_NAME': 'primary_until',
+    # Alias of the cache in `CACHES` pinning token clients, it has to be
+    # shared by all workers for reads served by another one to stick
+    'PIN_CACHE': 'shared',
+    # Seconds between health checks of a healthy replica
+    'HEALTH_CHECK_INTERVAL': 10,
+    # Seconds before a failed replica is checked again
+    'RETRY_AFTER': 30,
+    # Replicas lagging more seconds behind are skipped(PostgreSQL only)
+    'MAX_LAG': 5,
+}
+
+# Replica the reads of the current request go to, None for the primary
+_replica_alias = contextvars.ContextVar('replica_alias', default=None)
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'REPLICAS', {})}
+
+
+def pin_cache_key(user_id):
+    return f'replicas:pin:{user_id}'
+
+
+def pin_cache():
+    return caches[get_config()['PIN_CACHE']]
+
+
+class ReplicaPool():
+    """
+    Replica aliases picked round robin, a replica is used only while its
+    last health check(connection usable and lag under `MAX_LAG`) passed.
+    Checks are repeated every `HEALTH_CHECK_INTERVAL` seconds, failed
+    replicas are retried after `RETRY_AFTER` seconds.
+    """
+    def __init__(self, config=None):
+        self.config = config or get_config()
+        aliases = self.config['ALIASES']
+        if aliases is None:
+            aliases = [alias for alias in settings.DATABASES if alias != DEFAULT_DB_ALIAS]
+        self.aliases = list(aliases)
+        self._cycle = itertools.cycle(self.aliases)
+        self._lock = threading.Lock()
+        # alias -> (healthy, checked at)
+        self.status = {}
+
+    def choose(self):
+        """A healthy replica or None when all are down"""
+        for i in range(len(self.aliases)):
+            with self._lock:
+                alias = next(self._cycle)
+            if self.is_healthy(alias):
+                return alias
+        return None
+
+    def is_healthy(self, alias):
+        healthy, checked = self.status.get(alias, (False, None))
+        interval = self.config['HEALTH_CHECK_INTERVAL'] if healthy else self.config['RETRY_AFTER']
+        if checked is not None and time.monotonic() - checked < interval:
+            return healthy
+
+        healthy = self.check(alias)
+        with self._lock:
+            self.status[alias] = (healthy, time.monotonic())
+        return healthy
+
+    def check(self, alias):
+        connection = connections[alias]
+        try:
+            # Persistent connections are reused, closed or broken ones reopened
+            if connection.connection is not None and not connection.is_usable():
+                connection.close()
+            connection.ensure_connection()
+            lag = self.get_lag(connection)
+        except DatabaseError as error:
+            logger.warning("Replica %s is unavailable: %s", alias, error)
+            connection.close()
+            return False
+
+        if lag is not None and lag > self.config['MAX_LAG']:
+            logger.warning("Replica %s is %.1fs behind the primary", alias, lag)
+            return False
+        return True
+
+    def get_lag(self, connection):
+        if connection.vendor != 'postgresql':
+            return None
+        with connection.cursor() as cursor:
+            # NULL when the server isn't replaying(e.g not a replica)
+            cursor.execute(
+                "SELECT EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())"
+            )
+            lag = cursor.fetchone()[0]
+        return None if lag is None else float(lag)
+
+    def mark_down(self, alias):
+        with self._lock:
+            self.status[alias] = (False, time.monotonic())
+
+
+replica_pool = ReplicaPool()
+
+
+def using_replicas():
+    """Alias of the replica reads of the current request go to, or None"""
+    return _replica_alias.get()
+
+
+def use_replicas(alias):
+    """Route reads of the current request to `alias`, returns a token for `leave_replicas`"""
+    return _replica_alias.set(alias)
+
+
+def leave_replicas(token):
+    _replica_alias.reset(token)
+
+
+class ReplicaRouter():
+    """
+    Send reads to the replica picked for the request in `use_replicas()`
+    (safe method requests of viewsets) and everything else to the primary.
+    All reads of a request go to one replica, so they see one snapshot.
+    """
+    def db_for_read(self, model, **hints):
+        return _replica_alias.get()
+
+    def db_for_write(self, model, **hints):
+        # Instances read from a replica are saved to the primary too
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *replica_pool.aliases}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+def get_pinned_until(request):
+    config = get_config()
+    try:
+        until = float(request.COOKIES.get(config['COOKIE_NAME'], 0))
+    except ValueError:
+        until = 0
+    return until
+
+
+def is_pinned(request):
+    """Whether `request` has to read from the primary because its user wrote recently"""
+    if get_pinned_until(request) > time.time():
+        return True
+    user = request.user
+    if user.is_authenticated:
+        return (pin_cache().get(pin_cache_key(user.pk)) or 0) > time.time()
+    return False
+
+
+async def ais_pinned(request):
+    if get_pinned_until(request) > time.time():
+        return True
+    user = request.user
+    if user.is_authenticated:
+        return (await pin_cache().aget(pin_cache_key(user.pk)) or 0) > time.time()
+    return False
+
+
+def pin_primary(request, response, user=None):
+    """
+    Stick reads of `user`(the requesting user by default) to the primary
+    for `STICKY_SECONDS`, in `PIN_CACHE` for token clients and in a
+    cookie for browsers and anonymous writers.
+    """
+    if not replica_pool.aliases:
+        return
+    config = get_config()
+    seconds = config['STICKY_SECONDS']
+    until = time.time() + seconds
+    user = user or request.user
+    if user.is_authenticated:
+        pin_cache().set(pin_cache_key(user.pk), until, seconds)
+    response.set_cookie(
+        config['COOKIE_NAME'], f'{until:.3f}', max_age=seconds, httponly=True, samesite='Lax'
+    )
+
+
+def should_use_replicas(request):
+    return (
+        bool(replica_pool.aliases)
+        and request.method in SAFE_METHODS
+        and not is_pinned(request)
+    )
+
+
+async def ashould_use_replicas(request):
+    return (
+        bool(replica_pool.aliases)
+        and request.method in SAFE_METHODS
+        and not await ais_pinned(request)
+    )
+
+
+class ReplicaReadsMixin():
+    """
+    Serve safe method requests of a viewset from a replica once the user
+    is authenticated and permitted(these read the primary), unless the user
+    wrote recently. Successful writes pin the user to the primary, reads
+    failing on a replica are retried on the primary.
+    """
+    replica_token = None
+
+    def enter_replicas(self):
+        alias = replica_pool.choose()
+        # Every replica is down, reads stay on the primary
+        if alias is not None:
+            self.replica_token = use_replicas(alias)
+
+    def leave_replicas(self):
+        if self.replica_token is not None:
+            leave_replicas(self.replica_token)
+            self.replica_token = None
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        if should_use_replicas(request):
+            self.enter_replicas()
+
+    def handle_exception(self, exc):
+        handler = getattr(self, self.request.method.lower(), None)
+        if self.replica_token is not None and isinstance(exc, DatabaseError):
+            alias = using_replicas()
+            if connections[alias].connection is not None and not connections[alias].is_usable():
+                replica_pool.mark_down(alias)
+            logger.warning("Read from replica %s failed, retrying on the primary: %s", alias, exc)
+            self.leave_replicas()
+            if handler is not None:
+                try:
+                    return handler(self.request, *self.args, **self.kwargs)
+                except Exception as retry_exc:
+                    exc = retry_exc
+        return super().handle_exception(exc)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        self.leave_replicas()
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if request.method not in SAFE_METHODS and response.status_code < 400:
+            pin_primary(request, response)
+        return response
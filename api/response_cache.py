@@ -0,0 +1,270 @@
+import re
+import time
+import asyncio
+import hashlib
+import threading
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.cache.backends.memcached import BaseMemcachedCache
+from django.core.cache.backends.redis import RedisCache
+
+from .cache import LRUCache
+from .principal import get_principal
+
+
+class LocalBackend():
+    """In-process LRU backend, entries are not shared between workers"""
+    atomic = True
+
+    def __init__(self, max_entries):
+        self.cache = LRUCache(maxsize=max_entries)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value, timeout):
+        self.cache.set(key, value, ttl=timeout)
+
+    def add(self, key, value, timeout):
+        with self.lock:
+            if self.cache.get(key) is not None:
+                return False
+            self.cache.set(key, value, ttl=timeout)
+            return True
+
+    def delete(self, key):
+        self.cache.delete(key)
+
+    def incr(self, key, initial=0):
+        with self.lock:
+            value = (self.cache.get(key) or initial) + 1
+            self.cache.set(key, value, ttl=None)
+            return value
+
+    # Nothing blocks in memory, the async API is the sync one
+
+    async def aget(self, key):
+        return self.get(key)
+
+    async def aset(self, key, value, timeout):
+        self.set(key, value, timeout)
+
+    async def aadd(self, key, value, timeout):
+        return self.add(key, value, timeout)
+
+    async def adelete(self, key):
+        self.delete(key)
+
+
+class DjangoCacheBackend():
+    """
+    Backend on top of a cache in `CACHES` e.g `FileBasedCache`, memcached
+    or redis, which is shared by all gunicorn workers.
+    """
+    # Caches whose `add` and `incr` are atomic, `FileBasedCache` and the
+    # database cache read then write
+    atomic_caches = (RedisCache, BaseMemcachedCache, LocMemCache)
+
+    def __init__(self, alias):
+        self.alias = alias
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    @property
+    def atomic(self):
+        return isinstance(self.cache, self.atomic_caches)
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value, timeout):
+        self.cache.set(key, value, timeout)
+
+    def add(self, key, value, timeout):
+        return self.cache.add(key, value, timeout)
+
+    def delete(self, key):
+        self.cache.delete(key)
+
+    def incr(self, key, initial=0):
+        if not self.atomic:
+            # Concurrent increments may write the same value, it is still
+            # above the one both read
+            value = max(self.cache.get(key) or initial, initial) + 1
+            self.cache.set(key, value, None)
+            return value
+        self.cache.add(key, initial, None)
+        try:
+            return self.cache.incr(key)
+        except ValueError:
+            # Evicted between `add` and `incr`
+            self.cache.set(key, initial + 1, None)
+            return initial + 1
+
+    async def aget(self, key):
+        return await self.cache.aget(key)
+
+    async def aset(self, key, value, timeout):
+        await self.cache.aset(key, value, timeout)
+
+    async def aadd(self, key, value, timeout):
+        return await self.cache.aadd(key, value, timeout)
+
+    async def adelete(self, key):
+        await self.cache.adelete(key)
+
+
+def get_backend(name, max_entries):
+    if name == 'local':
+        return LocalBackend(max_entries)
+    return DjangoCacheBackend(name)
+
+
+class ResponseCache():
+    """
+    Cache of serialized responses which are invalidated all at once by
+    bumping a generation counter that is part of every key. Recomputing a
+    missing key is locked only on backends with an atomic `add`, others
+    let every worker compute it.
+    """
+    def __init__(self, namespace, backend, timeout, lock_timeout):
+        self.namespace = namespace
+        self.backend = backend
+        self.timeout = timeout
+        self.lock_timeout = lock_timeout
+
+    @property
+    def generation_key(self):
+        return f'{self.namespace}:generation'
+
+    @staticmethod
+    def initial_generation():
+        # From the clock, so that generations(and ETags made of them) aren't
+        # reused once the counter is evicted or the cache restarted
+        return time.time_ns() // 1000
+
+    def generation(self):
+        generation = self.backend.get(self.generation_key)
+        if generation is None:
+            self.backend.add(self.generation_key, self.initial_generation(), None)
+            generation = self.backend.get(self.generation_key)
+        return generation
+
+    async def ageneration(self):
+        generation = await self.backend.aget(self.generation_key)
+        if generation is None:
+            await self.backend.aadd(self.generation_key, self.initial_generation(), None)
+            generation = await self.backend.aget(self.generation_key)
+        return generation
+
+    def invalidate(self):
+        self.backend.incr(self.generation_key, self.initial_generation())
+
+    @staticmethod
+    def digest(parts):
+        return hashlib.md5("|".join(str(part) for part in parts).encode()).hexdigest()
+
+    def make_key(self, *parts, generation=None):
+        # Callers which already read the generation in the request pass it
+        if generation is None:
+            generation = self.generation()
+        return f'{self.namespace}:{generation}:{self.digest(parts)}'
+
+    async def amake_key(self, *parts, generation=None):
+        if generation is None:
+            generation = await self.ageneration()
+        return f'{self.namespace}:{generation}:{self.digest(parts)}'
+
+    def get_or_compute(self, key, compute):
+        """
+        Get the value of `key` or compute it, only one worker computes a
+        missing key while the others wait for it(up to `lock_timeout`).
+        """
+        value = self.backend.get(key)
+        if value is not None:
+            return value
+        if not self.backend.atomic:
+            value = compute()
+            if value is not None:
+                self.backend.set(key, value, self.timeout)
+            return value
+
+        lock_key = f'{key}:lock'
+        deadline = time.monotonic() + self.lock_timeout
+        while not self.backend.add(lock_key, 1, self.lock_timeout):
+            if time.monotonic() > deadline:
+                # The worker holding the lock is too slow, don't wait any longer
+                return compute()
+            time.sleep(0.01)
+            value = self.backend.get(key)
+            if value is not None:
+                return value
+
+        try:
+            value = compute()
+            if value is not None:
+                self.backend.set(key, value, self.timeout)
+            return value
+        finally:
+            self.backend.delete(lock_key)
+
+    async def aget_or_compute(self, key, compute):
+        """Async counterpart of `get_or_compute`, `compute` is a coroutine function"""
+        value = await self.backend.aget(key)
+        if value is not None:
+            return value
+        if not self.backend.atomic:
+            value = await compute()
+            if value is not None:
+                await self.backend.aset(key, value, self.timeout)
+            return value
+
+        lock_key = f'{key}:lock'
+        deadline = time.monotonic() + self.lock_timeout
+        while not await self.backend.aadd(lock_key, 1, self.lock_timeout):
+            if time.monotonic() > deadline:
+                return await compute()
+            await asyncio.sleep(0.01)
+            value = await self.backend.aget(key)
+            if value is not None:
+                return value
+
+        try:
+            value = await compute()
+            if value is not None:
+                await self.backend.aset(key, value, self.timeout)
+            return value
+        finally:
+            await self.backend.adelete(lock_key)
+
+
+RESPONSE_CACHE = getattr(settings, 'MARATHON_RESPONSE_CACHE', {})
+
+marathon_response_cache = ResponseCache(
+    namespace='marathons',
+    backend=get_backend(
+        RESPONSE_CACHE.get('BACKEND', 'shared'), RESPONSE_CACHE.get('MAX_ENTRIES', 1000)
+    ),
+    timeout=RESPONSE_CACHE.get('TIMEOUT', 60),
+    lock_timeout=RESPONSE_CACHE.get('LOCK_TIMEOUT', 5)
+)
+
+
+def get_role_tier(user):
+    principal = get_principal(user)
+    if principal.is_admin:
+        return 'admin'
+    if principal.is_organizer:
+        return 'organizer'
+    if principal.is_client:
+        return 'client'
+    return 'anonymous'
+
+
+def normalize_restql_query(query):
+    return re.sub(r'\s+', '', query)
@@ -0,0 +1,77 @@
+import django_filters
+from django.db import connections
+from django.core.validators import EMPTY_VALUES
+
+from .models import User, UserSearchGram, ngrams, uses_search_grams
+
+
+# Grams found in more users than this are too common to narrow a search down
+MAX_POSTINGS = 10000
+# Users of the rarest grams are intersected, the `icontains` filter does the rest
+INTERSECTED_GRAMS = 2
+
+
+def count_postings(using, field, grams, limit=MAX_POSTINGS):
+    """Users(up to `limit`) having each of `grams` in `field`, in one query"""
+    connection = connections[using]
+    quote = connection.ops.quote_name
+    probe = (
+        f'SELECT COUNT(*) FROM (SELECT 1 FROM {quote(UserSearchGram._meta.db_table)} '
+        f'WHERE {quote("field")} = %s AND {quote("gram")} = %s LIMIT {int(limit)}) postings'
+    )
+    grams = sorted(grams)
+    sql = ' UNION ALL '.join(f'SELECT {index}, ({probe})' for index in range(len(grams)))
+    params = [param for gram in grams for param in (field, gram)]
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return {grams[index]: count for index, count in cursor.fetchall()}
+
+
+def search_substring(queryset, field, value):
+    """
+    Users of `queryset` whose `field` contains `value`(case insensitive)
+    through the substring index. On PostgreSQL `icontains` is served by the
+    trigram GIN index as is, elsewhere candidates are the users having the
+    rarest grams of `value` in `UserSearchGram`.
+    """
+    using = queryset.db
+    queryset = queryset.filter(**{f'{field}__icontains': value})
+    grams = ngrams(value)
+    if not grams or not uses_search_grams(using):
+        # Shorter than a gram nothing narrows the scan down
+        return queryset
+
+    postings = count_postings(using, field, grams)
+    rarest = sorted(grams, key=postings.get)[:INTERSECTED_GRAMS]
+    if not postings[rarest[0]]:
+        return queryset.none()
+    if postings[rarest[0]] >= MAX_POSTINGS:
+        return queryset
+    for gram in rarest:
+        queryset = queryset.filter(pk__in=UserSearchGram.objects.filter(
+            field=field, gram=gram
+        ).values('user_id'))
+    return queryset
+
+
+class IndexedSubstringFilter(django_filters.CharFilter):
+    """`icontains` filter of a field indexed by `search_substring`"""
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('lookup_expr', 'icontains')
+        super().__init__(*args, **kwargs)
+
+    def filter(self, qs, value):
+        if value in EMPTY_VALUES:
+            return qs
+        if self.distinct:
+            qs = qs.distinct()
+        return search_substring(qs, self.field_name, value)
+
+
+class UserFilterSet(django_filters.FilterSet):
+    email__icontains = IndexedSubstringFilter(field_name='email')
+    username__icontains = IndexedSubstringFilter(field_name='username')
+
+    class Meta:
+        model = User
+        fields = ('id', 'email', 'username')
@@ -0,0 +1,199 @@
+import io
+import csv
+import random
+from datetime import timedelta
+
+from django.db import connection, transaction
+from django.utils import timezone
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import Group
+from rest_framework.authtoken.models import Token
+
+from .groups import create_groups
+from .models import (
+    ROLES, MARATHON_CATEGORY_NAME_CHOICES, CURRENCY_CHOICES, PAYMENT_STATUS_CHOICES,
+    User, Marathon, Category, Sponsor, Payment, MarathonStats, UserSearchGram, uses_search_grams
+)
+
+
+PAYMENT_COPY_FIELDS = (
+    'marathon', 'category', 'user', 'organizer', 'status',
+    'validation_date', 'created_at', 'updated_at'
+)
+
+
+class Seeder():
+    """
+    Create synthetic users, marathons, categories, sponsors and payments
+    in bulk, rows are generated from `seed` so every run produces the same
+    data. Payments are loaded with `COPY` on PostgreSQL and with batched
+    `bulk_create` elsewhere.
+
+    Bulk inserts bypass `save()` and signals, so marathon stats are rebuilt
+    at the end, search grams of users are added along with them and no auth
+    tokens are created except by `get_token`.
+    """
+    def __init__(self, prefix='seed', seed=0, batch_size=5000, stdout=None):
+        self.prefix = prefix
+        self.random = random.Random(seed)
+        self.batch_size = batch_size
+        self.stdout = stdout
+
+    def log(self, message):
+        if self.stdout is not None:
+            self.stdout.write(message)
+
+    def seed(self, users, marathons, payments, categories=2, sponsors=2):
+        create_groups()
+        with transaction.atomic():
+            users_by_role = self.create_users(users)
+            marathon_objs = self.create_marathons(marathons, users_by_role['organizer'])
+            category_objs = self.create_categories(marathon_objs, categories)
+            self.create_sponsors(marathon_objs, sponsors)
+            clients = users_by_role['client'] or users_by_role['organizer']
+            self.create_payments(payments, category_objs, clients)
+            MarathonStats.objects.rebuild(marathon_ids=[marathon.pk for marathon in marathon_objs])
+        self.analyze()
+        return users_by_role
+
+    def split_users(self, count):
+        # Few admins, about a tenth organizers and the rest clients
+        admins = max(1, count // 100)
+        organizers = max(1, count // 10)
+        return {'admin': admins, 'organizer': organizers, 'client': max(0, count - admins - organizers)}
+
+    def create_users(self, count):
+        # Hashing is slow on purpose, hash once and share it
+        password = make_password('password')
+        now = timezone.now()
+        users = []
+        roles = []
+        for role, role_count in self.split_users(count).items():
+            for i in range(role_count):
+                username = f'{self.prefix}-{role}-{i}'
+                users.append(User(
+                    username=username, email=f'{username}@marathon.com', password=password,
+                    full_name=f'{role.title()} {i}', gender=self.random.choice('MF'),
+                    date_joined=now
+                ))
+                roles.append(role)
+        users = User.objects.bulk_create(users, batch_size=self.batch_size)
+        if uses_search_grams():
+            UserSearchGram.objects.index(users, batch_size=self.batch_size)
+
+        groups = {group.name: group for group in Group.objects.filter(name__in=ROLES)}
+        Membership = User.groups.through
+        Membership.objects.bulk_create([
+            Membership(user_id=user.pk, group_id=groups[role].pk)
+            for user, role in zip(users, roles)
+        ], batch_size=self.batch_size)
+
+        users_by_role = {role: [] for role in ROLES}
+        for user, role in zip(users, roles):
+            users_by_role[role].append(user)
+        self.log(f"Created {len(users)} users")
+        return users_by_role
+
+    def create_marathons(self, count, organizers):
+        now = timezone.now()
+        marathons = Marathon.objects.bulk_create([
+            Marathon(
+                name=f'{self.prefix} marathon {i}', theme=f'Theme {i}',
+                organizer=organizers[i % len(organizers)],
+                start_date=now, end_date=now + timedelta(days=1)
+            )
+            for i in range(count)
+        ], batch_size=self.batch_size)
+        self.log(f"Created {len(marathons)} marathons")
+        return marathons
+
+    def create_categories(self, marathons, per_marathon):
+        names = [name for name, label in MARATHON_CATEGORY_NAME_CHOICES]
+        currencies = [currency for currency, label in CURRENCY_CHOICES]
+        categories = Category.objects.bulk_create([
+            Category(
+                name=names[i % len(names)], price=self.random.randint(5, 100),
+                currency=self.random.choice(currencies), marathon=marathon
+            )
+            for marathon in marathons for i in range(per_marathon)
+        ], batch_size=self.batch_size)
+        self.log(f"Created {len(categories)} categories")
+        return categories
+
+    def create_sponsors(self, marathons, per_marathon):
+        sponsors = Sponsor.objects.bulk_create([
+            Sponsor(name=f'Sponsor {i}', marathon=marathon)
+            for marathon in marathons for i in range(per_marathon)
+        ], batch_size=self.batch_size)
+        self.log(f"Created {len(sponsors)} sponsors")
+        return sponsors
+
+    def generate_payments(self, count, categories, clients):
+        organizers = {category.marathon_id: category.marathon.organizer_id for category in categories}
+        statuses = [status for status, label in PAYMENT_STATUS_CHOICES]
+        now = timezone.now()
+        for i in range(count):
+            category = self.random.choice(categories)
+            yield Payment(
+                marathon_id=category.marathon_id, category_id=category.pk,
+                user_id=self.random.choice(clients).pk,
+                organizer_id=organizers[category.marathon_id],
+                status=self.random.choice(statuses),
+                validation_date=now + timedelta(hours=self.random.randint(-72, 72)),
+                created_at=now, updated_at=now
+            )
+
+    def create_payments(self, count, categories, clients):
+        if not count:
+            return
+        payments = self.generate_payments(count, categories, clients)
+        if connection.vendor == 'postgresql':
+            self.copy_payments(payments, count)
+        else:
+            self.bulk_create_payments(payments, count)
+
+    def bulk_create_payments(self, payments, count):
+        batch = []
+        created = 0
+        for payment in payments:
+            batch.append(payment)
+            if len(batch) == self.batch_size:
+                Payment.objects.bulk_create(batch)
+                created += len(batch)
+                batch = []
+                self.log(f"Created {created}/{count} payments")
+        Payment.objects.bulk_create(batch)
+        self.log(f"Created {count} payments")
+
+    def copy_payments(self, payments, count):
+        fields = [Payment._meta.get_field(name) for name in PAYMENT_COPY_FIELDS]
+        columns = ", ".join(connection.ops.quote_name(field.column) for field in fields)
+        sql = (
+            f"COPY {connection.ops.quote_name(Payment._meta.db_table)} ({columns}) "
+            f"FROM STDIN WITH (FORMAT csv)"
+        )
+        created = 0
+        with connection.cursor() as cursor:
+            while created < count:
+                buffer = io.StringIO()
+                writer = csv.writer(buffer)
+                for payment in payments:
+                    writer.writerow([getattr(payment, field.attname) for field in fields])
+                    created += 1
+                    if created % self.batch_size == 0:
+                        break
+                buffer.seek(0)
+                if hasattr(cursor, 'copy_expert'):
+                    cursor.copy_expert(sql, buffer)
+                else:
+                    # psycopg 3
+                    with cursor.copy(sql) as copy:
+                        copy.write(buffer.getvalue())
+                self.log(f"Copied {created}/{count} payments")
+
+    def analyze(self):
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def get_token(self, user):
+        return Token.objects.get_or_create(user=user)[0]
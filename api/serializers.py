@@ -1,13 +1,28 @@
+import contextlib
+from datetime import timedelta
+from collections import Counter, defaultdict
+from collections.abc import Mapping
+
+from django.conf import settings
+from django.db import models, transaction, IntegrityError
+from django.db.models import Case, When, Value, F, ProtectedError
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db.models.fields.related import ManyToOneRel
+from django.utils import timezone
 from rest_framework.authtoken.models import Token
 from rest_framework.test import APIClient
 from rest_framework import serializers
 from django_restql.mixins import DynamicFieldsMixin
 from django_restql.serializers import NestedModelSerializer
-from django_restql.fields import NestedField
+from django_restql.fields import NestedField, BaseRESTQLNestedField
+from django_restql.operations import CREATE, UPDATE, REMOVE
 
 from api import views
+from .principal import get_principal
+from .instrumentation import TimedSerializerMixin
 from .models import (
-    User, Category, Sponsor, Marathon, Payment
+    User, Category, Sponsor, Marathon, Payment, MarathonStats, role_annotation,
+    deferred_marathon_touches
 )
 
 
@@ -17,8 +32,23 @@ ROLE_CHOICES = (
     ('client', 'client')
 )
 
+# Time given to a registration to be paid before it can be cancelled
+PAYMENT_VALIDATION_PERIOD = getattr(
+    settings, 'PAYMENT_VALIDATION_PERIOD', timedelta(days=3)
+)
+
+MAX_BULK_PAYMENTS = getattr(settings, 'MAX_BULK_PAYMENTS', 500)
+
+
+def payment_validation_date():
+    return timezone.now() + PAYMENT_VALIDATION_PERIOD
+
+
+def category_error(category_id):
+    return f"Such marathon does not have a category with `id={category_id}`"
+
 
-class UserSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+class UserSerializer(TimedSerializerMixin, DynamicFieldsMixin, serializers.ModelSerializer):
     password = serializers.CharField(
         write_only=True,
         style={'input_type': 'password'}
@@ -36,10 +66,20 @@ class UserSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
             'date_joined', 'payments', 'is_admin', 'is_organizer', 'is_client'
         )
 
+    # Role properties computed from `values()` rows(see `ValuesPlan`)
+    values_fields = {
+        'is_admin': (
+            ('is_staff', role_annotation('admin')),
+            lambda is_staff, has_role: is_staff or has_role
+        ),
+        'is_organizer': ((role_annotation('organizer'),), lambda has_role: has_role),
+        'is_client': ((role_annotation('client'),), lambda has_role: has_role),
+    }
+
     def validate_role(self, role):
         request = self.context.get('request')
         user = request.user
-        if role == 'admin' and not (user.is_authenticated and user.is_admin):
+        if role == 'admin' and not get_principal(user).is_admin:
             raise serializers.ValidationError(
                 "Can't assign this role to user if you've not logged in as admin.",
                 "Value error"
@@ -47,7 +87,7 @@ class UserSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
         return role
 
 
-class CategorySerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+class CategorySerializer(TimedSerializerMixin, DynamicFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Category
         fields = (
@@ -57,7 +97,7 @@ class CategorySerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     def validate_marathon(self, marathon):
         request = self.context.get('request')
         user = request.user
-        if marathon.organizer != user or not user.is_admin or user.role != 'admin':
+        if marathon.organizer_id != user.pk and not get_principal(user).is_admin:
             raise serializers.ValidationError(
                 {"category": f"Can't use the marathon which you do not organize."},
                 "Value error"
@@ -65,7 +105,7 @@ class CategorySerializer(DynamicFieldsMixin, serializers.ModelSerializer):
         return marathon
 
 
-class SponsorSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+class SponsorSerializer(TimedSerializerMixin, DynamicFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Sponsor
         fields = (
@@ -75,7 +115,7 @@ class SponsorSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
     def validate_marathon(self, marathon):
         request = self.context.get('request')
         user = request.user
-        if marathon.organizer != user or not user.is_admin or user.role != 'admin':
+        if marathon.organizer_id != user.pk and not get_principal(user).is_admin:
             raise serializers.ValidationError(
                 {"category": f"Can't use the marathon which you do not organize."},
                 "Value error"
@@ -83,11 +123,229 @@ class SponsorSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
         return marathon
 
 
-class MarathonSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+class BulkNestedWriteMixin():
+    """
+    Write `create`, `update` and `remove` operations of many-to-one
+    restql `NestedField`s in bulk: children of every operation are
+    validated with one list serializer(and referenced pks with one query)
+    before anything is written, then written with one `bulk_create`, one
+    `UPDATE` and one `DELETE ... WHERE id IN` per field in a single
+    transaction.
+
+    Removed children are deleted, their foreign key to the parent can't
+    be null. Children with payments(e.g categories people registered to)
+    can't be removed.
+    """
+    create_operations = (CREATE,)
+    update_operations = (CREATE, UPDATE, REMOVE)
+
+    def deferred_signals(self):
+        """Block batching per row signals of children, it yields a set of parent pks to touch"""
+        return contextlib.nullcontext(set())
+
+    def get_bulk_foreignkey(self, field, source):
+        if field.read_only or not isinstance(field, serializers.ListSerializer) \
+                or not isinstance(field, BaseRESTQLNestedField):
+            return None
+        rel = self.Meta.model._meta.get_field(source)
+        return rel.field.name if isinstance(rel, ManyToOneRel) else None
+
+    @property
+    def bulk_nested_fields(self):
+        fields = {}
+        for field in self.fields.values():
+            foreignkey = self.get_bulk_foreignkey(field, field.source)
+            if foreignkey is not None:
+                fields[field.source] = (field, foreignkey)
+        return fields
+
+    def to_internal_value(self, data):
+        # Operations are validated here, restql(which queries every
+        # referenced pk on its own) gets none of them
+        operations = {}
+        if isinstance(data, Mapping):
+            data = data.copy()
+            for source, (field, foreignkey) in self.bulk_nested_fields.items():
+                if field.field_name in data:
+                    operations[source] = data[field.field_name]
+                    data[field.field_name] = {}
+
+        attrs = super().to_internal_value(data)
+        fields = self.bulk_nested_fields
+        errors = {}
+        for source, values in operations.items():
+            field, foreignkey = fields[source]
+            try:
+                attrs[source] = self.validate_nested_operations(field, foreignkey, values)
+            except serializers.ValidationError as error:
+                errors[field.field_name] = error.detail
+        if errors:
+            raise serializers.ValidationError(errors)
+        return attrs
+
+    def validate_nested_operations(self, field, foreignkey, operations):
+        operations = serializers.DictField().run_validation(operations)
+        allowed = self.create_operations if self.instance is None else self.update_operations
+        child = field.child
+        to_pk = child.Meta.model._meta.pk.to_python
+        validated = {}
+        for operation, values in operations.items():
+            if operation not in allowed:
+                raise serializers.ValidationError(
+                    f"`{operation}` is not a valid operation, valid operations for this "
+                    f"request are {', '.join(f'`{name}`' for name in allowed)}",
+                    code='invalid_operation'
+                )
+            try:
+                validated[operation] = self.validate_nested_operation(
+                    child, foreignkey, operation, values
+                )
+            except serializers.ValidationError as error:
+                raise serializers.ValidationError({operation: error.detail}) from None
+        return validated
+
+    def validate_nested_operation(self, child, foreignkey, operation, values):
+        model = child.Meta.model
+        if operation == REMOVE:
+            return validate_pks(model, values)
+
+        if operation == UPDATE:
+            values = serializers.DictField().run_validation(values)
+            pks = validate_pks(model, list(values))
+            items = list(values.values())
+        else:
+            items = serializers.ListField().run_validation(values)
+        serializer = child.serializer_class(
+            data=items,
+            many=True,
+            partial=operation == UPDATE,
+            context={**self.context, "parent_operation": operation}
+        )
+        # Children belong to the parent being written
+        serializer.child.fields.pop(foreignkey, None)
+        if not serializer.is_valid():
+            raise serializers.ValidationError(serializer.errors)
+        if operation == CREATE:
+            return serializer.validated_data
+        return dict(zip(pks, serializer.validated_data))
+
+    def pop_nested_operations(self, validated_data):
+        return {
+            source: (field, foreignkey, validated_data.pop(source))
+            for source, (field, foreignkey) in self.bulk_nested_fields.items()
+            if source in validated_data
+        }
+
+    def write_nested_operations(self, instance, nested):
+        for source, (field, foreignkey, operations) in nested.items():
+            model = field.child.Meta.model
+            children = model._default_manager.filter(**{foreignkey: instance})
+            try:
+                if operations.get(REMOVE):
+                    self.check_removable(model, operations[REMOVE])
+                    children.filter(pk__in=operations[REMOVE]).delete()
+                if operations.get(UPDATE):
+                    self.bulk_update_children(model, children, operations[UPDATE])
+                if operations.get(CREATE):
+                    model._default_manager.bulk_create([
+                        model(**values, **{foreignkey: instance})
+                        for values in operations[CREATE]
+                    ])
+            except ProtectedError:
+                # Refused like deleting the protected object itself
+                raise
+            except IntegrityError as error:
+                raise serializers.ValidationError(
+                    f"Error on `{field.field_name}` field: {error}", "constrain_error"
+                ) from None
+        return bool(nested)
+
+    def check_removable(self, model, pks):
+        """
+        Queryset deletes cascade without calling `Payment.delete`, children
+        with payments are refused rather than deleting registrations with them.
+        """
+        for rel in model._meta.related_objects:
+            if rel.related_model is not Payment:
+                continue
+            payments = Payment.objects.filter(**{f'{rel.field.name}__in': pks})
+            if payments.exists():
+                raise ProtectedError(
+                    f"Can't remove a {model._meta.verbose_name} with payments", payments
+                )
+
+    def bulk_update_children(self, model, children, updates):
+        """
+        One `UPDATE` of every child in `updates`, each column is set with a
+        `CASE` over the distinct values given to it(rather than over every
+        row like `bulk_update`), pks which don't belong to the parent are
+        ignored like restql does.
+        """
+        columns = defaultdict(lambda: defaultdict(list))
+        for pk, values in updates.items():
+            for name, value in values.items():
+                field = model._meta.get_field(name)
+                if isinstance(value, models.Model):
+                    value = value.pk
+                columns[field][value].append(pk)
+
+        assignments = {}
+        for field, groups in columns.items():
+            if len(groups) == 1 and len(next(iter(groups.values()))) == len(updates):
+                value = Value(next(iter(groups)), output_field=field)
+            else:
+                value = Case(
+                    *[When(pk__in=pks, then=Value(value, output_field=field)) for value, pks in groups.items()],
+                    default=F(field.attname), output_field=field
+                )
+            assignments[field.attname] = value
+        # `update` doesn't call `pre_save`, `auto_now` fields are set here
+        now = timezone.now()
+        for field in model._meta.concrete_fields:
+            if getattr(field, 'auto_now', False):
+                assignments[field.attname] = now
+        children.filter(pk__in=updates).update(**assignments)
+
+    def create(self, validated_data):
+        nested = self.pop_nested_operations(validated_data)
+        with transaction.atomic(), self.deferred_signals() as touched:
+            instance = super().create(validated_data)
+            if self.write_nested_operations(instance, nested):
+                touched.add(instance.pk)
+        return instance
+
+    def update(self, instance, validated_data):
+        nested = self.pop_nested_operations(validated_data)
+        with transaction.atomic(), self.deferred_signals() as touched:
+            instance = super().update(instance, validated_data)
+            if self.write_nested_operations(instance, nested):
+                touched.add(instance.pk)
+        return instance
+
+
+def validate_pks(model, pks):
+    """Check that children of `model` referenced by a nested operation exist with one query"""
+    pks = serializers.ListField().run_validation(pks)
+    relation = serializers.PrimaryKeyRelatedField(queryset=model._default_manager.all())
+    values = []
+    for pk in pks:
+        try:
+            values.append(model._meta.pk.to_python(pk))
+        except (TypeError, ValueError, DjangoValidationError):
+            relation.fail('incorrect_type', data_type=type(pk).__name__)
+    existing = set(model._default_manager.filter(pk__in=values).values_list('pk', flat=True))
+    for pk, value in zip(pks, values):
+        if value not in existing:
+            relation.fail('does_not_exist', pk_value=pk)
+    return values
+
+
+class MarathonSerializer(TimedSerializerMixin, BulkNestedWriteMixin, DynamicFieldsMixin,
+                         serializers.ModelSerializer):
     organizer = NestedField(UserSerializer, read_only=True, fields=['full_name'])
     sponsors = NestedField(SponsorSerializer, many=True, required=False, fields=['name'],
         create_ops=['create'], update_ops=['create', 'remove', 'update'])
-    categories = NestedField(CategorySerializer, required=True, exclude=['marathon'],
+    categories = NestedField(CategorySerializer, many=True, required=True, exclude=['marathon'],
         create_ops=['create'], update_ops=['create', 'remove', 'update'])
 
     class Meta:
@@ -97,6 +355,9 @@ class MarathonSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
             'categories', 'start_date', 'end_date',
         )
 
+    def deferred_signals(self):
+        return deferred_marathon_touches()
+
     def create(self, validated_data):
         request = self.context.get('request')
         user = request.user
@@ -104,7 +365,7 @@ class MarathonSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
         return super().create(validated_data)
 
 
-class PaymentSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
+class PaymentSerializer(TimedSerializerMixin, DynamicFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Payment
         fields = (
@@ -114,17 +375,98 @@ class PaymentSerializer(DynamicFieldsMixin, serializers.ModelSerializer):
             'user', 'status', 'validation_date'
         )
 
+    def validate(self, data):
+        marathon = data.get('marathon', getattr(self.instance, 'marathon', None))
+        category = data.get('category', getattr(self.instance, 'category', None))
+
+        # Compare ids to avoid fetching marathon categories
+        if category.marathon_id != marathon.pk:
+            raise serializers.ValidationError(
+                {"category": category_error(category.pk)},
+                "Value error"
+            )
+        return data
+
     def create(self, validated_data):
         request = self.context.get('request')
         user = request.user
         validated_data.update({'user': user})
         validated_data.update({'status': 'UNPAID'})
-        marathon = validated_data.get('marathon', None)
-        category = validated_data.get('category', None)
+        validated_data.update({'validation_date': payment_validation_date()})
+        return super().create(validated_data)
 
-        if category not in marathon.categories:
-            raise serializers.ValidationError(
-                {"category": f"Such marathon does not have a category with `id={category.pk}`"},
-                "Value error"
+
+class BulkPaymentListSerializer(serializers.ListSerializer):
+    def to_internal_value(self, data):
+        if isinstance(data, list) and len(data) > MAX_BULK_PAYMENTS:
+            raise serializers.ValidationError({
+                "non_field_errors": [f"Can't register more than {MAX_BULK_PAYMENTS} payments at once."]
+            })
+        items = super().to_internal_value(data)
+
+        # Validate all (marathon, category) pairs with a single query
+        category_ids = {item['category'] for item in items}
+        category_marathons = {
+            category_id: (marathon_id, organizer_id)
+            for category_id, marathon_id, organizer_id in Category.objects.filter(
+                pk__in=category_ids
+            ).values_list('pk', 'marathon_id', 'marathon__organizer_id')
+        }
+
+        errors = []
+        for item in items:
+            marathon_id, organizer_id = category_marathons.get(item['category'], (None, None))
+            if marathon_id != item['marathon']:
+                errors.append({"category": [category_error(item['category'])]})
+            else:
+                item['organizer'] = organizer_id
+                errors.append({})
+
+        if any(errors):
+            raise serializers.ValidationError(errors)
+        return items
+
+    def create(self, validated_data):
+        request = self.context.get('request')
+        user = request.user
+        validation_date = payment_validation_date()
+        payments = [
+            Payment(
+                marathon_id=item['marathon'],
+                category_id=item['category'],
+                organizer_id=item['organizer'],
+                user=user,
+                status='UNPAID',
+                validation_date=validation_date
             )
-        return super().create(validated_data)
+            for item in validated_data
+        ]
+        # `bulk_create` skips `Payment.save`, so stats are updated here
+        registrations = Counter(payment.stats_key for payment in payments)
+        with transaction.atomic():
+            payments = Payment.objects.bulk_create(payments)
+            for stats_key, count in registrations.items():
+                MarathonStats.objects.add(*stats_key, delta=count)
+            return payments
+
+
+class BulkPaymentSerializer(TimedSerializerMixin, serializers.Serializer):
+    """Registration item of `POST /payments/bulk/`"""
+    marathon = serializers.IntegerField()
+    category = serializers.IntegerField()
+
+    class Meta:
+        list_serializer_class = BulkPaymentListSerializer
+
+
+
+class MarathonStatsSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    category_name = serializers.CharField(source='category.name', read_only=True)
+    currency = serializers.CharField(source='category.currency', read_only=True)
+
+    class Meta:
+        model = MarathonStats
+        fields = (
+            'category', 'category_name', 'currency', 'status', 'registrations'
+        )
+        read_only_fields = fields
@@ -1,3 +1,1711 @@
-from django.test import TestCase
+import re
+import io
+import csv
+import gzip
+import json
+import time
+import threading
+import uuid
+import decimal
+import datetime
+import unittest
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.test import TestCase, TransactionTestCase, Client, AsyncClient, override_settings
+from django.db import connection, connections, OperationalError
+from django.utils import timezone
+from django.db.models import F, Sum
+from django.core.cache import cache, caches
+from django.core.management import call_command, CommandError
+from django.contrib.auth.hashers import PBKDF2PasswordHasher
+from django.contrib.auth.models import Group
+from django.test.utils import CaptureQueriesContext
+from django.db.migrations.executor import MigrationExecutor
+from rest_framework.test import APIClient, APIRequestFactory
+from rest_framework.request import Request
+from rest_framework.renderers import JSONRenderer
+from rest_framework.relations import Hyperlink
+from rest_framework.utils.serializer_helpers import ReturnDict
+from rest_framework.authtoken.models import Token
+
+from .urls import router
+from .groups import create_groups, get_group_id
+from .seeding import Seeder
+from .benchmark import run_benchmark, compare, measure_serialization, run_nested_write_benchmark
+from .instrumentation import RequestMetrics, fingerprint
+from .hashers import hashing_pool, HashingPool, HashingPoolSaturated, PooledPBKDF2PasswordHasher
+from .authentication import token_cache, CachedTokenAuthentication, TokenCache
+from .response_cache import marathon_response_cache, ResponseCache, DjangoCacheBackend
+from .views import ValuesListMixin, UserViewSet, MarathonViewSet, PaymentViewSet
+from .values_plan import ValuesPlan
+from .pagination import KeysetPagination
+from .serializers import category_error
+from .renderers import ORJSONRenderer, MessagePackRenderer, msgpack
+from .compression import accepted_encodings
+from .expiry import PaymentExpirySweeper
+from .throttling import RateLimiter, TokenBucket, TokenBucketThrottle, rate_limiter
+from .idempotency import CacheStore, DatabaseStore, get_config as get_idempotency_config
+from .replicas import (
+    ReplicaPool, ReplicaRouter, ReplicaReadsMixin, replica_pool, use_replicas, leave_replicas,
+    get_config as get_replicas_config
+)
+from .search import search_substring, count_postings
+from .models import (
+    User, Category, Sponsor, Marathon, Payment, MarathonStats, IdempotencyKey,
+    UserSearchGram, ngrams, uses_search_grams
+)
+
+
+class APITestCase(TestCase):
+    def setUp(self):
+        # Replica connections don't see data of the test transaction, see `ReplicaTests`
+        replicas = mock.patch.object(replica_pool, 'aliases', [])
+        replicas.start()
+        self.addCleanup(replicas.stop)
+        # Tests send bursts of requests, `ThrottlingTests` enable a limiter of their own
+        throttling = mock.patch.object(rate_limiter, 'enabled', False)
+        throttling.start()
+        self.addCleanup(throttling.stop)
+        for alias in settings.CACHES:
+            caches[alias].clear()
+        token_cache.clear()
+        create_groups()
+        self.admin = self.create_user('admin')
+        self.organizer = self.create_user('organizer')
+        self.client_user = self.create_user('client')
+
+    def create_user(self, role, username=None):
+        user = User.objects.create_user(username or role, f'{username or role}@marathon.com', 'password')
+        user.groups.add(Group.objects.get(name=role))
+        return user
+
+    def create_marathon(self, organizer=None, categories=('FULL', 'HALF'), sponsors=1):
+        now = timezone.now()
+        marathon = Marathon.objects.create(
+            name='Marathon', organizer=organizer or self.organizer,
+            start_date=now, end_date=now
+        )
+        for name in categories:
+            Category.objects.create(name=name, price=10, currency='USD', marathon=marathon)
+        for i in range(sponsors):
+            Sponsor.objects.create(name=f'Sponsor {i}', marathon=marathon)
+        return marathon
+
+    def create_payment(self, marathon, user=None, status='UNPAID'):
+        return Payment.objects.create(
+            marathon=marathon, category=marathon.categories.first(),
+            user=user or self.client_user, status=status,
+            validation_date=timezone.now()
+        )
+
+    def api_client(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
+
+    def count_queries(self, user, url):
+        # Warm up per process caches(e.g group memberships) first
+        client = self.api_client(user)
+        client.get(url)
+        # Measure computing the response rather than serving it from cache
+        marathon_response_cache.invalidate()
+        with CaptureQueriesContext(connection) as context:
+            response = client.get(url)
+        self.assertEqual(response.status_code, 200, response.content)
+        return len(context.captured_queries)
+
+
+class QueryCountTests(APITestCase):
+    """
+    The number of queries of every endpoint must not grow with the
+    number of rows on a page.
+    """
+    sizes = (1, 8)
+
+    def assertConstantQueries(self, user, url, add_rows):
+        counts = []
+        created = 0
+        for size in self.sizes:
+            add_rows(size - created)
+            created = size
+            counts.append(self.count_queries(user, url))
+        self.assertEqual(len(set(counts)), 1, f"Queries of {url} grow with rows: {counts}")
+
+    def test_users_list(self):
+        def add_rows(count):
+            for i in range(count):
+                user = self.create_user('client', f'client-{User.objects.count()}')
+                self.create_payment(self.marathon, user=user)
+
+        self.marathon = self.create_marathon()
+        self.assertConstantQueries(self.admin, '/users/', add_rows)
+
+    def test_marathons_list(self):
+        def add_rows(count):
+            for i in range(count):
+                self.create_marathon(sponsors=2)
+
+        for user in (self.admin, self.organizer, self.client_user):
+            Marathon.objects.all().delete()
+            self.assertConstantQueries(user, '/marathons/', add_rows)
+
+    def test_categories_and_sponsors_list(self):
+        def add_rows(count):
+            for i in range(count):
+                self.create_marathon()
+
+        self.assertConstantQueries(self.admin, '/categories/', add_rows)
+        Marathon.objects.all().delete()
+        self.assertConstantQueries(self.admin, '/sponsors/', add_rows)
+
+    def test_payments_list(self):
+        marathon = self.create_marathon()
+
+        def add_rows(count):
+            for i in range(count):
+                self.create_payment(marathon)
+
+        for user in (self.admin, self.organizer, self.client_user):
+            Payment.objects.all().delete()
+            self.assertConstantQueries(user, '/payments/', add_rows)
+
+    def test_owner_permissions_do_not_query_related_objects(self):
+        marathon = self.create_marathon()
+        payment = self.create_payment(marathon)
+        category = marathon.categories.first()
+        sponsor = marathon.sponsors.first()
+
+        # Only the query for the object, none for walking `obj.marathon.organizer`
+        for url in (f'/categories/{category.pk}/', f'/sponsors/{sponsor.pk}/'):
+            self.assertEqual(self.count_queries(self.organizer, url), 1)
+        self.assertEqual(self.count_queries(self.organizer, f'/payments/{payment.pk}/'), 1)
+        self.assertEqual(self.count_queries(self.client_user, f'/payments/{payment.pk}/'), 1)
+
+
+class MarathonResponseCacheTests(APITestCase):
+    def test_responses_are_cached_until_marathon_changes(self):
+        marathon = self.create_marathon()
+        client = self.api_client(self.client_user)
+        url = f'/marathons/{marathon.pk}/'
+        client.get(url)
+
+        with CaptureQueriesContext(connection) as context:
+            response = client.get(url)
+        # Only the bare object for permissions and validators
+        self.assertEqual(len(context.captured_queries), 1)
+
+        category = marathon.categories.first()
+        category.price = 25
+        category.save()
+        response = client.get(url)
+        prices = [category['price'] for category in response.data['categories']]
+        self.assertIn(25, prices)
+
+    def test_stale_bodies_are_not_served_with_new_etags(self):
+        marathon = self.create_marathon()
+        client = self.api_client(self.client_user)
+        url = f'/marathons/{marathon.pk}/'
+        etag = client.get(url)['ETag']
+
+        # Written by another worker, whose invalidation this one hasn't seen
+        Marathon.objects.filter(pk=marathon.pk).update(name='Renamed', updated_at=timezone.now())
+        response = client.get(url)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.data['name'], 'Renamed')
+
+        response = client.get('/marathons/')
+        self.assertEqual(response.data['results'][0]['name'], 'Renamed')
+
+    def test_list_etags_change_on_deletes(self):
+        self.create_marathon()
+        marathon = self.create_marathon()
+        client = self.api_client(self.client_user)
+        response = client.get('/marathons/')
+        self.assertNotIn('Last-Modified', response)
+        etag = response['ETag']
+
+        # Validated by the cache generation, without an aggregate
+        with CaptureQueriesContext(connection) as context:
+            response = client.get('/marathons/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(context.captured_queries), 0)
+
+        # Deleting the newest row leaves `max(updated_at)` where it was
+        self.create_marathon().delete()
+        etag = client.get('/marathons/')['ETag']
+        marathon.delete()
+        response = client.get('/marathons/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 1)
+
+    def test_generation_is_read_once_per_request(self):
+        self.create_marathon()
+        client = self.api_client(self.client_user)
+        with mock.patch.object(
+            marathon_response_cache, 'generation', wraps=marathon_response_cache.generation
+        ) as generation:
+            self.assertEqual(client.get('/marathons/').status_code, 200)
+        self.assertEqual(generation.call_count, 1)
+
+    def test_locks_need_an_atomic_backend(self):
+        self.assertTrue(DjangoCacheBackend('default').atomic)
+        self.assertFalse(DjangoCacheBackend('shared').atomic)
+        response_cache = ResponseCache('test', DjangoCacheBackend('shared'), 60, 5)
+        with mock.patch.object(response_cache.backend, 'add') as add:
+            self.assertEqual(response_cache.get_or_compute('key', lambda: 1), 1)
+        add.assert_not_called()
+        self.assertEqual(response_cache.get_or_compute('key', lambda: 2), 1)
+
+        generation = response_cache.generation()
+        response_cache.invalidate()
+        self.assertGreater(response_cache.generation(), generation)
+
+    def test_restql_queries_are_normalized(self):
+        self.create_marathon()
+        client = self.api_client(self.client_user)
+        client.get('/marathons/?query={id, name}')
+
+        with CaptureQueriesContext(connection) as context:
+            response = client.get('/marathons/?query={ id,name }')
+        # Served from the cache
+        self.assertEqual(len(context.captured_queries), 0)
+        self.assertEqual(list(response.data['results'][0]), ['id', 'name'])
+
+
+@override_settings(ROOT_URLCONF='asgi_urls')
+class AsyncReadPathTests(APITestCase):
+    """Async views must answer exactly like the sync viewsets."""
+    def setUp(self):
+        super().setUp()
+        marathon = self.create_marathon()
+        self.create_marathon(sponsors=2)
+        self.create_payment(marathon)
+        self.marathon = marathon
+
+    def headers(self, user):
+        return {'Authorization': f'Token {Token.objects.get(user=user).key}'}
+
+    async def assertSameResponse(self, user, url, **headers):
+        headers.update(await sync_to_async(self.headers)(user))
+        with override_settings(ROOT_URLCONF='urls'):
+            expected = await sync_to_async(Client().get)(url, headers=headers)
+        async def compute(key, compute):
+            return await compute()
+
+        # Computed by the async path rather than served from the cache
+        with mock.patch.object(marathon_response_cache, 'aget_or_compute', compute):
+            response = await AsyncClient().get(url, headers=headers)
+        self.assertEqual(response.status_code, expected.status_code)
+        self.assertEqual(response.content, expected.content)
+        self.assertEqual(response.get('ETag'), expected.get('ETag'))
+        return response
+
+    async def test_marathons(self):
+        for user in (self.admin, self.organizer, self.client_user):
+            await self.assertSameResponse(user, '/marathons/')
+            await self.assertSameResponse(user, '/marathons/?query={id, name}')
+            await self.assertSameResponse(user, '/marathons/?page=1')
+            await self.assertSameResponse(user, '/marathons/?approximate_count=true')
+            await self.assertSameResponse(user, f'/marathons/{self.marathon.pk}/')
+        await self.assertSameResponse(self.client_user, '/marathons/0/')
+        await self.assertSameResponse(self.client_user, '/marathons/abc/')
+
+    async def test_payments(self):
+        for user in (self.admin, self.organizer, self.client_user):
+            await self.assertSameResponse(user, '/payments/')
+
+        # Writes are passed to the sync viewset
+        category = await self.marathon.categories.afirst()
+        response = await AsyncClient().post(
+            '/payments/', {'marathon': self.marathon.pk, 'category': category.pk},
+            content_type='application/json', headers=await sync_to_async(self.headers)(self.client_user)
+        )
+        self.assertEqual(response.status_code, 201, response.content)
+
+    async def test_errors(self):
+        response = await AsyncClient().get('/marathons/')
+        self.assertEqual(response.status_code, 401)
+        response = await AsyncClient().get(
+            '/marathons/', headers={'Authorization': 'Token invalid'}
+        )
+        self.assertEqual(response.status_code, 401)
+        # Users out of the required groups
+        user = await sync_to_async(User.objects.create_user)('nobody', 'nobody@marathon.com', 'password')
+        await self.assertSameResponse(user, '/payments/')
+
+    async def test_not_modified(self):
+        response = await self.assertSameResponse(self.client_user, '/marathons/')
+        response = await self.assertSameResponse(
+            self.client_user, '/marathons/', **{'If-None-Match': response['ETag']}
+        )
+        self.assertEqual(response.status_code, 304)
+
+
+class ValuesPlanTests(APITestCase):
+    """Lists assembled from `values()` rows must match serializers byte for byte."""
+    def setUp(self):
+        super().setUp()
+        for i in range(3):
+            marathon = self.create_marathon(sponsors=i)
+            for user in (self.client_user, self.admin):
+                self.create_payment(marathon, user=user)
+        self.admin.is_staff = True
+        self.admin.save()
+
+    def assertSameContent(self, user, url):
+        client = self.api_client(user)
+        marathon_response_cache.invalidate()
+        with mock.patch.object(ValuesListMixin, 'get_values_plan', return_value=None):
+            expected = client.get(url)
+        marathon_response_cache.invalidate()
+        response = client.get(url)
+        self.assertEqual(response.status_code, expected.status_code, url)
+        self.assertEqual(response.content, expected.content, url)
+        return response
+
+    def test_users(self):
+        for url in (
+            '/users/', '/users/?page=2', '/users/?query={id, payments, is_admin, is_client}',
+            '/users/?query={-email, -payments}', '/users/?username__icontains=client'
+        ):
+            self.assertSameContent(self.admin, url)
+
+    def test_marathons(self):
+        for user in (self.admin, self.organizer, self.client_user):
+            self.assertSameContent(user, '/marathons/')
+        for url in (
+            '/marathons/?query={id, name, categories{name}}',
+            '/marathons/?query={title: name, organizer{url, full_name}, sponsors{-name}}',
+            '/marathons/?query={id, unknown}', '/marathons/?page=1&query={url}',
+        ):
+            self.assertSameContent(self.client_user, url)
+
+    def test_payments(self):
+        for user in (self.admin, self.organizer, self.client_user):
+            self.assertSameContent(user, '/payments/')
+        self.assertSameContent(self.admin, '/payments/?query={id, url, user}&status=UNPAID')
+
+    def test_queries(self):
+        # One for the rows and one per related list, like prefetching
+        self.assertEqual(self.count_queries(self.admin, '/users/'), 3)
+        self.assertEqual(self.count_queries(self.admin, '/payments/'), 1)
+        self.assertEqual(self.count_queries(self.admin, '/marathons/?query={id, categories{id}}'), 2)
+
+    def test_benchmark(self):
+        for viewset in (UserViewSet, MarathonViewSet, PaymentViewSet):
+            result = measure_serialization(viewset, self.admin, rows=10, iterations=1)
+            self.assertTrue(result['identical'], viewset)
+            self.assertGreater(result['values_plan'], 0)
+
+
+class SelectedColumnsTests(APITestCase):
+    """Reads from model instances only load what the restql query selects."""
+    def setUp(self):
+        super().setUp()
+        self.marathon = self.create_marathon(sponsors=2)
+        self.payment = self.create_payment(self.marathon)
+
+    def get(self, user, url):
+        client = self.api_client(user)
+        client.get(url)
+        marathon_response_cache.invalidate()
+        queries = []
+
+        def record(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(record):
+            response = client.get(url)
+        marathon_response_cache.invalidate()
+        with mock.patch.object(ValuesPlan, 'restrict', lambda plan, queryset, required=(): queryset):
+            expected = client.get(url)
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response.content, expected.content, url)
+        return queries
+
+    def test_marathon(self):
+        queries = self.get(self.client_user, f'/marathons/{self.marathon.pk}/?query={{id, name}}')
+        # The bare object for validators, then the marathon without relations
+        self.assertEqual(len(queries), 2)
+        self.assertNotIn('"theme"', queries[1])
+        self.assertNotIn('"api_user"', queries[1])
+
+        queries = self.get(
+            self.client_user, f'/marathons/{self.marathon.pk}/?query={{organizer{{full_name}}, sponsors}}'
+        )
+        self.assertEqual(len(queries), 3)
+        self.assertIn('"api_user"."full_name"', queries[1])
+        self.assertNotIn('"api_user"."password"', queries[1])
+        self.assertNotIn('"updated_at"', queries[2])
+
+    def test_payment(self):
+        for user in (self.client_user, self.organizer, self.admin):
+            queries = self.get(user, f'/payments/{self.payment.pk}/?query={{id, status}}')
+            self.assertEqual(len(queries), 1)
+            self.assertNotIn('"validation_date"', queries[0])
+
+    def test_user(self):
+        queries = self.get(self.admin, f'/users/{self.client_user.pk}/?query={{id, username, is_admin}}')
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('"password"', queries[0])
+
+
+class RendererTests(APITestCase):
+    def test_orjson_renders_like_json_renderer(self):
+        now = timezone.now()
+        data = ReturnDict({
+            'floats': [0.1, 1 / 3, 10.0, 1e-05, 0.0001, 1e16, 1.5e300, -2.5e-07],
+            'ints': [0, -1, 2 ** 63, 2 ** 70],
+            'dates': [now, now.date(), now.time(), datetime.datetime(2020, 1, 1)],
+            'types': [decimal.Decimal('1.10'), uuid.UUID(int=1), (1, 2), None, True],
+            'strings': ['caf\u00e9', 'line\u2028separator\u2029', Hyperlink('http://testserver/', None)],
+            'nested': [{'a': {'b': []}}],
+        }, serializer=None)
+        for value in [data, *data.values(), {1: 'non string key'}, [], {}, 'text']:
+            self.assertEqual(ORJSONRenderer().render(value), JSONRenderer().render(value), value)
+        self.assertEqual(ORJSONRenderer().render(None), b'')
+        self.assertEqual(
+            ORJSONRenderer().render(data, 'application/json; indent=2'),
+            JSONRenderer().render(data, 'application/json; indent=2')
+        )
+
+    def test_parser(self):
+        client = self.api_client(self.client_user)
+        response = client.post('/payments/', '{"marathon": ', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('JSON parse error', response.data['detail'])
+
+        marathon = self.create_marathon()
+        response = client.post('/payments/', json.dumps({
+            'marathon': marathon.pk, 'category': marathon.categories.first().pk
+        }), content_type='application/json')
+        self.assertEqual(response.status_code, 201, response.content)
+
+    @unittest.skipIf(msgpack is None, "msgpack isn't installed")
+    def test_msgpack(self):
+        self.create_marathon()
+        client = self.api_client(self.client_user)
+        response = client.get('/marathons/', HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(response['Content-Type'], 'application/msgpack')
+        expected = client.get('/marathons/')
+        self.assertEqual(msgpack.unpackb(response.content), json.loads(expected.content))
+        self.assertEqual(MessagePackRenderer().render(None), b'')
+
+    def test_accepted_encodings(self):
+        self.assertEqual(accepted_encodings('gzip, deflate, br'), {'gzip', 'deflate', 'br'})
+        self.assertEqual(accepted_encodings('br;q=0, GZIP;q=0.5, identity'), {'gzip', 'identity'})
+        self.assertEqual(accepted_encodings(''), set())
+
+    @override_settings(COMPRESSION={'MIN_SIZE': 1024, 'ENCODINGS': ('gzip',)})
+    def test_compression(self):
+        marathon = self.create_marathon()
+        for i in range(20):
+            self.create_payment(marathon)
+        client = self.api_client(self.admin)
+
+        plain = client.get('/payments/')
+        self.assertFalse(plain.has_header('Content-Encoding'))
+        response = client.get('/payments/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEqual(gzip.decompress(response.content), plain.content)
+
+        # Below the threshold
+        response = client.get(f'/payments/{marathon.payments.first().pk}/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+        # Streaming responses are compressed as they are sent
+        plain = b''.join(client.get('/payments/export/').streaming_content)
+        response = client.get('/payments/export/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(b''.join(response.streaming_content)), plain)
+
+    @override_settings(COMPRESSION={'MIN_SIZE': 0, 'ENCODINGS': ('gzip',)})
+    def test_tokens_are_not_compressed(self):
+        client = APIClient()
+        response = client.post(
+            '/auth/', {'username': 'client', 'password': 'password'}, HTTP_ACCEPT_ENCODING='gzip'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertIn('token', response.json())
+        get_group_id('client')
+        response = client.post('/register/', {
+            'username': 'runner', 'email': 'runner@marathon.com',
+            'password': 'password', 'role': 'client'
+        }, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        # Everything else still is
+        response = self.api_client(self.admin).get('/users/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+
+    @override_settings(COMPRESSION={'MIN_SIZE': 0, 'ENCODINGS': ('gzip',)})
+    def test_compressed_etags_are_weak(self):
+        self.create_marathon()
+        client = self.api_client(self.client_user)
+        response = client.get('/marathons/', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertTrue(response['ETag'].startswith('W/"'))
+        response = client.get(
+            '/marathons/', HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=response['ETag']
+        )
+        self.assertEqual(response.status_code, 304)
+
+
+class ExportTests(APITestCase):
+    def test_exports_are_filtered(self):
+        marathon = self.create_marathon()
+        other = self.create_marathon()
+        payment = self.create_payment(marathon, status='PAID')
+        self.create_payment(marathon)
+        self.create_payment(other, status='PAID')
+        client = self.api_client(self.admin)
+
+        response = client.get(f'/payments/export/?marathon={marathon.pk}')
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual({row['marathon_id'] for row in rows}, {marathon.pk})
+        self.assertEqual(len(rows), 2)
+
+        response = client.get(f'/payments/export/?marathon={marathon.pk}&status=PAID')
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual([row['id'] for row in rows], [payment.pk])
+
+    def test_csv_formulas_are_escaped(self):
+        marathon = self.create_marathon()
+        self.client_user.full_name = '=HYPERLINK("http://example.com")'
+        self.client_user.phone = '+255700000000'
+        self.client_user.save()
+        self.create_payment(marathon)
+
+        response = self.api_client(self.admin).get('/payments/export/?output=csv')
+        content = b''.join(response.streaming_content).decode()
+        row, = csv.DictReader(io.StringIO(content))
+        self.assertEqual(row['user__full_name'], '\'=HYPERLINK("http://example.com")')
+        self.assertEqual(row['user__phone'], "'+255700000000")
+        self.assertEqual(row['category__name'], 'FULL')
+
+
+class MarathonStatsTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.marathon = self.create_marathon()
+        self.full, self.half = self.marathon.categories.order_by('pk')
+
+    def assertMatchesRebuild(self):
+        rows = MarathonStats.objects.filter(registrations__gt=0)
+        stats = set(rows.values_list('marathon', 'category', 'status', 'registrations'))
+        MarathonStats.objects.rebuild()
+        self.assertEqual(stats, set(MarathonStats.objects.values_list(
+            'marathon', 'category', 'status', 'registrations'
+        )))
+        return stats
+
+    def test_increments_match_rebuild(self):
+        payments = [self.create_payment(self.marathon) for i in range(3)]
+        self.create_payment(self.create_marathon(), status='PAID')
+        self.assertIn((self.marathon.pk, self.full.pk, 'UNPAID', 3), self.assertMatchesRebuild())
+
+        payments[0].status = 'PAID'
+        payments[0].save()
+        payments[1].category = self.half
+        payments[1].save()
+        # Partly loaded payments too
+        payment = Payment.objects.only('pk', 'status').get(pk=payments[2].pk)
+        payment.status = 'CANCELLED'
+        payment.save()
+        stats = self.assertMatchesRebuild()
+        self.assertEqual({row[1:] for row in stats if row[0] == self.marathon.pk}, {
+            (self.full.pk, 'PAID', 1), (self.half.pk, 'UNPAID', 1), (self.full.pk, 'CANCELLED', 1)
+        })
+
+        response = self.api_client(self.admin).delete(f'/payments/{payments[1].pk}/')
+        self.assertEqual(response.status_code, 204, response.content)
+        Payment.objects.get(pk=payments[2].pk).delete()
+        self.assertNotIn(self.half.pk, {row[1] for row in self.assertMatchesRebuild()})
+
+    def test_stats_leave_out_empty_rows(self):
+        payment = self.create_payment(self.marathon)
+        payment.status = 'PAID'
+        payment.save()
+        # The UNPAID row is down to zero
+        self.assertTrue(MarathonStats.objects.filter(registrations=0).exists())
+
+        response = self.api_client(self.organizer).get(f'/marathons/{self.marathon.pk}/stats/')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(
+            [(row['category'], row['status'], row['registrations']) for row in response.data['registrations']],
+            [(self.full.pk, 'PAID', 1)]
+        )
+        self.assertEqual(response.data['revenue'], [{'currency': 'USD', 'amount': 10.0}])
+
+
+class PaymentOrganizerTests(APITestCase):
+    def test_reassigned_marathons_move_their_payments(self):
+        marathon = self.create_marathon()
+        other = self.create_marathon()
+        payments = [self.create_payment(marathon), self.create_payment(marathon, status='PAID')]
+        self.create_payment(other)
+        organizer = self.create_user('organizer', 'organizer-2')
+
+        marathon.organizer = organizer
+        marathon.save()
+        self.assertEqual(
+            set(Payment.objects.filter(organizer=organizer).values_list('pk', flat=True)),
+            {payment.pk for payment in payments}
+        )
+        self.assertEqual(Payment.objects.get(marathon=other).organizer_id, self.organizer.pk)
+
+        # Organizers list payments of the marathons they organize now
+        response = self.api_client(organizer).get('/payments/')
+        self.assertEqual(len(response.data['results']), 2)
+        response = self.api_client(self.organizer).get('/payments/')
+        self.assertEqual([payment['marathon'] for payment in response.data['results']], [other.pk])
+
+
+class BulkPaymentTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.marathon = self.create_marathon()
+        self.other = self.create_marathon(organizer=self.create_user('organizer', 'organizer-2'))
+        self.full, self.half = self.marathon.categories.order_by('pk')
+
+    def stats(self):
+        return set(MarathonStats.objects.values_list('marathon', 'category', 'status', 'registrations'))
+
+    def post(self, items):
+        return self.api_client(self.client_user).post('/payments/bulk/', items, format='json')
+
+    def test_bulk_registration(self):
+        other_category = self.other.categories.first()
+        response = self.post([
+            {'marathon': self.marathon.pk, 'category': self.full.pk},
+            {'marathon': self.marathon.pk, 'category': self.full.pk},
+            {'marathon': self.marathon.pk, 'category': self.half.pk},
+            {'marathon': self.other.pk, 'category': other_category.pk},
+        ])
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual(len(response.data), 4)
+
+        # Payments belong to the organizer of their marathon
+        self.assertEqual(
+            set(Payment.objects.values_list('marathon', 'organizer', 'user', 'status')),
+            {(self.marathon.pk, self.organizer.pk, self.client_user.pk, 'UNPAID'),
+             (self.other.pk, self.other.organizer_id, self.client_user.pk, 'UNPAID')}
+        )
+        # Stats are added by category, like payments saved one by one
+        self.assertEqual(self.stats(), {
+            (self.marathon.pk, self.full.pk, 'UNPAID', 2),
+            (self.marathon.pk, self.half.pk, 'UNPAID', 1),
+            (self.other.pk, other_category.pk, 'UNPAID', 1),
+        })
+        self.post([{'marathon': self.marathon.pk, 'category': self.full.pk}])
+        self.assertIn((self.marathon.pk, self.full.pk, 'UNPAID', 3), self.stats())
+
+        expected = self.stats()
+        MarathonStats.objects.rebuild()
+        self.assertEqual(self.stats(), expected)
+
+    def test_per_item_errors(self):
+        other_category = self.other.categories.first()
+        response = self.post([
+            {'marathon': self.marathon.pk, 'category': self.full.pk},
+            {'marathon': self.marathon.pk, 'category': other_category.pk},
+            {'marathon': self.other.pk, 'category': other_category.pk},
+        ])
+        self.assertEqual(response.status_code, 400, response.content)
+        self.assertEqual(response.data, [{}, {'category': [category_error(other_category.pk)]}, {}])
+
+        response = self.post([
+            {'marathon': self.marathon.pk, 'category': self.full.pk},
+            {'marathon': self.marathon.pk},
+        ])
+        self.assertEqual(response.status_code, 400, response.content)
+        # Field errors are keyed by item index by DRF
+        self.assertEqual(response.data, {1: {'category': ['This field is required.']}})
+
+        # Either all or none are created
+        self.assertFalse(Payment.objects.exists())
+        self.assertFalse(MarathonStats.objects.exists())
+
+    def test_limit(self):
+        item = {'marathon': self.marathon.pk, 'category': self.full.pk}
+        with mock.patch('api.serializers.MAX_BULK_PAYMENTS', 2):
+            response = self.post([item] * 3)
+            self.assertEqual(response.status_code, 400, response.content)
+            self.assertEqual(
+                response.data['non_field_errors'], ["Can't register more than 2 payments at once."]
+            )
+            self.assertFalse(Payment.objects.exists())
+
+            self.assertEqual(self.post([item] * 2).status_code, 201)
+
+
+class KeysetPaginationTests(APITestCase):
+    def paginate(self, url, ordering):
+        paginator = KeysetPagination()
+        paginator.ordering = ordering
+        paginator.page_size = 2
+        request = Request(APIRequestFactory().get(url))
+        page = paginator.paginate_queryset(Marathon.objects.all(), request)
+        return [marathon.pk for marathon in page], paginator.get_next_link(), paginator.get_previous_link()
+
+    def test_equal_ordering_values(self):
+        for name in ('A', 'A', 'A', 'B', 'B', 'C', 'C', 'D'):
+            Marathon.objects.create(
+                name=name, organizer=self.organizer, start_date=timezone.now(), end_date=timezone.now()
+            )
+        expected = list(Marathon.objects.order_by('name', 'pk').values_list('pk', flat=True))
+
+        pages, url = [], 'http://testserver/marathons/'
+        while url is not None:
+            page, url, previous = self.paginate(url, 'name')
+            pages.append(page)
+        # Every marathon once, in order, though positions repeat across pages
+        self.assertEqual([pk for page in pages for pk in page], expected)
+        self.assertEqual(len(pages), 4)
+
+        # And back from the last page, pages may split ties elsewhere(turning
+        # back on a page of ties only skips rows, like DRF's cursors do)
+        back, url = [], previous
+        while url is not None:
+            page, next_url, url = self.paginate(url, 'name')
+            back = page + back
+        self.assertEqual(back, expected[:-len(pages[-1])])
+
+    def test_page_number_fallback(self):
+        for i in range(12):
+            self.create_marathon(categories=(), sponsors=0)
+        client = self.api_client(self.client_user)
+        response = client.get('/marathons/?page=2')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response.data['count'], 12)
+        self.assertEqual(len(response.data['results']), 2)
+        self.assertIsNone(response.data['next'])
+
+        response = client.get('/marathons/')
+        self.assertNotIn('count', response.data)
+        self.assertEqual(len(response.data['results']), 10)
+        self.assertIn('cursor=', response.data['next'])
+
+    def test_invalid_cursor(self):
+        self.create_marathon()
+        client = self.api_client(self.client_user)
+        for cursor in ('garbage', 'cD0xMA'):
+            response = client.get(f'/marathons/?cursor={cursor}')
+            self.assertEqual(response.status_code, 404, cursor)
+            self.assertEqual(str(response.data['detail']), 'Invalid cursor')
+
+
+class SeedingTests(APITestCase):
+    def test_seed(self):
+        Seeder(prefix='seeded', batch_size=20).seed(users=50, marathons=4, payments=70)
+
+        users = User.objects.filter(username__startswith='seeded-')
+        self.assertEqual(users.count(), 50)
+        for role, count in (('admin', 1), ('organizer', 5), ('client', 44)):
+            self.assertEqual(users.filter(groups__name=role).count(), count)
+
+        payments = Payment.objects.filter(marathon__name__startswith='seeded')
+        self.assertEqual(payments.count(), 70)
+        self.assertFalse(payments.exclude(organizer=F('marathon__organizer')).exists())
+        self.assertFalse(payments.exclude(category__marathon=F('marathon')).exists())
+        self.assertEqual(Category.objects.filter(marathon__name__startswith='seeded').count(), 8)
+        registrations = MarathonStats.objects.aggregate(total=Sum('registrations'))['total']
+        self.assertEqual(registrations, 70)
+
+
+class BenchmarkTests(APITestCase):
+    def test_every_endpoint_is_measured(self):
+        results = run_benchmark(router, [20], iterations=1)
+        self.assertEqual(len(results['20']), 13)
+        for name, result in results['20'].items():
+            self.assertEqual(result['status'], 200, name)
+            if name != 'marathon-list':
+                self.assertGreater(result['queries'], 0, name)
+        # Served from the response cache once warmed up
+        self.assertEqual(results['20']['marathon-list']['queries'], 0)
+        # Seeded rows are rolled back
+        self.assertFalse(User.objects.filter(username__startswith='bench-').exists())
+
+    def test_missing_baseline(self):
+        options = {'baseline': '/nonexistent/baseline.json', 'stdout': io.StringIO()}
+        with self.assertRaisesMessage(CommandError, "No baseline at /nonexistent/baseline.json"):
+            call_command('benchmark_api', check=True, **options)
+
+        with mock.patch('api.management.commands.benchmark_api.run_benchmark', return_value={}):
+            call_command('benchmark_api', **options)
+        self.assertIn("No baseline at", options['stdout'].getvalue())
+
+    def test_compare(self):
+        baseline = {'100': {'marathon-list': {
+            'status': 200, 'queries': 3, 'bytes': 1000, 'p50': 2.0, 'p95': 4.0, 'p99': 8.0
+        }}}
+        result = dict(baseline['100']['marathon-list'], p50=2.5, p99=9.0, bytes=1020)
+        self.assertEqual(compare({'100': {'marathon-list': result}}, baseline), [])
+
+        result = dict(result, queries=4, p95=10.0)
+        regressions = compare({'100': {'marathon-list': result}}, baseline)
+        self.assertEqual(len(regressions), 2)
+        self.assertIn('queries 3 -> 4', regressions[0])
+
+
+class NestedWriteTests(APITestCase):
+    def create(self, categories, sponsors=()):
+        response = self.api_client(self.organizer).post('/marathons/', {
+            'name': 'Marathon', 'start_date': '2026-01-01T00:00:00Z', 'end_date': '2026-01-02T00:00:00Z',
+            'categories': {'create': categories}, 'sponsors': {'create': list(sponsors)}
+        }, format='json')
+        self.assertEqual(response.status_code, 201, response.content)
+        return Marathon.objects.get(pk=response.data['id'])
+
+    def patch(self, marathon, data):
+        with CaptureQueriesContext(connection) as context:
+            response = self.api_client(self.organizer).patch(
+                f'/marathons/{marathon.pk}/', data, format='json'
+            )
+        return response, len(context.captured_queries)
+
+    def test_create(self):
+        marathon = self.create(
+            [{'name': 'FULL', 'price': 10, 'currency': 'USD'}, {'name': 'HALF', 'price': '5.5', 'currency': 'TZS'}],
+            [{'name': 'Sponsor'}]
+        )
+        self.assertEqual(
+            list(marathon.categories.order_by('pk').values_list('name', 'price', 'currency')),
+            [('FULL', 10.0, 'USD'), ('HALF', 5.5, 'TZS')]
+        )
+        self.assertEqual(list(marathon.sponsors.values_list('name', flat=True)), ['Sponsor'])
+
+    def test_queries_dont_grow_with_children(self):
+        counts = []
+        for size in (2, 10):
+            marathon = self.create([{'name': 'FULL', 'price': 10, 'currency': 'USD'}] * size)
+            categories = list(marathon.categories.values_list('pk', flat=True))
+            response, queries = self.patch(marathon, {
+                'categories': {
+                    'update': {str(pk): {'price': 20} for pk in categories[1:]},
+                    'remove': categories[:1],
+                    'create': [{'name': 'HALF', 'price': 5, 'currency': 'USD'}] * size,
+                },
+                'sponsors': {'create': [{'name': 'Sponsor'}] * size},
+            })
+            self.assertEqual(response.status_code, 200, response.content)
+            counts.append(queries)
+            self.assertEqual(marathon.categories.count(), size * 2 - 1)
+            self.assertEqual(marathon.categories.filter(price=20).count(), size - 1)
+            self.assertEqual(marathon.sponsors.count(), size)
+        self.assertEqual(counts[0], counts[1])
+
+    def test_categories_with_payments_are_kept(self):
+        marathon = self.create([
+            {'name': 'FULL', 'price': 10, 'currency': 'USD'}, {'name': 'HALF', 'price': 5, 'currency': 'USD'},
+            {'name': 'HALF', 'price': 1, 'currency': 'TZS'}
+        ])
+        paid = self.create_payment(marathon, status='PAID')
+        unpaid, empty = marathon.categories.exclude(pk=paid.category_id).order_by('pk')
+        Payment.objects.create(
+            marathon=marathon, category=unpaid, user=self.client_user,
+            status='UNPAID', validation_date=timezone.now()
+        )
+        for removed in ([paid.category_id, unpaid.pk], [unpaid.pk]):
+            response, queries = self.patch(marathon, {
+                'categories': {'remove': removed},
+                'sponsors': {'create': [{'name': 'Sponsor'}]},
+            })
+            self.assertEqual(response.status_code, 403, response.content)
+            self.assertTrue(response.data['detail'].startswith("Can't remove a category with payments"))
+            # Nothing of the write is kept
+            self.assertEqual(marathon.categories.count(), 3)
+            self.assertEqual(Payment.objects.filter(marathon=marathon).count(), 2)
+            self.assertFalse(marathon.sponsors.exists())
+
+        response, queries = self.patch(marathon, {'categories': {'remove': [empty.pk]}})
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(marathon.categories.count(), 2)
+
+    def test_invalid_operations(self):
+        marathon = self.create([{'name': 'FULL', 'price': 10, 'currency': 'USD'}])
+        response, queries = self.patch(marathon, {'categories': {'delete': [1]}})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('`delete` is not a valid operation', str(response.data['categories']))
+        response, queries = self.patch(marathon, {'categories': ['FULL']})
+        self.assertEqual(response.status_code, 400)
+        response, queries = self.patch(marathon, {'categories': {'update': {'abc': {'price': 5}}}})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('update', response.data['categories'])
+
+    def test_writes_touch_the_marathon(self):
+        marathon = self.create([{'name': 'FULL', 'price': 10, 'currency': 'USD'}])
+        category = marathon.categories.get()
+        response, queries = self.patch(marathon, {'categories': {'update': {str(category.pk): {'price': 30}}}})
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response.data['categories'][0]['price'], 30.0)
+        updated = Marathon.objects.get(pk=marathon.pk)
+        self.assertGreater(updated.updated_at, marathon.updated_at)
+        self.assertGreater(Category.objects.get(pk=category.pk).updated_at, category.updated_at)
+
+    def test_payload_is_validated_before_writes(self):
+        marathon = self.create([{'name': 'FULL', 'price': 10, 'currency': 'USD'}])
+        category = marathon.categories.get()
+        response, queries = self.patch(marathon, {
+            'categories': {
+                'remove': [category.pk],
+                'create': [{'name': 'HALF', 'price': 5, 'currency': 'USD'}, {'name': 'BAD', 'price': 5, 'currency': 'USD'}],
+            },
+            'sponsors': {'create': [{}]},
+        })
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('name', response.data['categories']['create'][1])
+        self.assertIn('name', response.data['sponsors']['create'][0])
+        self.assertEqual(list(marathon.categories.all()), [category])
+        self.assertFalse(marathon.sponsors.exists())
+
+        response, queries = self.patch(marathon, {'categories': {'remove': [category.pk + 100]}})
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('remove', response.data['categories'])
+
+    def test_benchmark(self):
+        results = run_nested_write_benchmark([2, 4], iterations=1)
+        self.assertEqual(results['2']['queries'], results['4']['queries'])
+        self.assertFalse(User.objects.filter(username__startswith='bench-').exists())
+
+
+class PaymentExpiryTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.marathon = self.create_marathon()
+        past = timezone.now() - datetime.timedelta(days=1)
+        self.expired = [self.create_payment(self.marathon) for i in range(5)]
+        Payment.objects.filter(pk__in=[payment.pk for payment in self.expired]).update(validation_date=past)
+        self.paid = self.create_payment(self.marathon, status='PAID')
+        Payment.objects.filter(pk=self.paid.pk).update(validation_date=past)
+        self.pending = self.create_payment(self.marathon)
+        Payment.objects.filter(pk=self.pending.pk).update(validation_date=past + datetime.timedelta(days=2))
+
+    def stats(self):
+        return sorted(MarathonStats.objects.values_list('category_id', 'status', 'registrations'))
+
+    def test_sweep(self):
+        stats = PaymentExpirySweeper(chunk_size=2).sweep()
+        self.assertEqual(stats.cancelled, 5)
+        self.assertEqual(stats.chunks, 3)
+        self.assertEqual(
+            Payment.objects.filter(status='CANCELLED').count(), 5
+        )
+        self.assertEqual(Payment.objects.get(pk=self.paid.pk).status, 'PAID')
+        self.assertEqual(Payment.objects.get(pk=self.pending.pk).status, 'UNPAID')
+        # Stats moved along, like a rebuild from payments
+        stats = self.stats()
+        MarathonStats.objects.rebuild()
+        self.assertEqual(stats, self.stats())
+        self.assertEqual(PaymentExpirySweeper().sweep().cancelled, 0)
+
+    def test_dry_run(self):
+        stats = self.stats()
+        result = PaymentExpirySweeper(chunk_size=2, dry_run=True).sweep()
+        self.assertEqual((result.cancelled, result.chunks), (5, 3))
+        self.assertFalse(Payment.objects.filter(status='CANCELLED').exists())
+        self.assertEqual(stats, self.stats())
+
+    def test_command(self):
+        out = io.StringIO()
+        call_command('expire_payments', '--chunk-size', '10', '--max-chunks', '1', stdout=out)
+        result = json.loads(out.getvalue())
+        self.assertEqual((result['cancelled'], result['chunks'], result['dry_run']), (5, 1, False))
+
+
+class IdempotencyTests(APITestCase):
+    def setUp(self):
+        super().setUp()
+        self.marathon = self.create_marathon()
+        self.client = self.api_client(self.client_user)
+
+    def use_store(self, store):
+        patcher = mock.patch('api.idempotency.idempotency_store', store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def pay(self, key, category=None, client=None):
+        payload = {'marathon': self.marathon.pk, 'category': category or self.marathon.categories.first().pk}
+        return (client or self.client).post(
+            '/payments/', json.dumps(payload), content_type='application/json',
+            HTTP_IDEMPOTENCY_KEY=key
+        )
+
+    def assertReplayed(self, store):
+        self.use_store(store)
+        response = self.pay('key-1')
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertFalse(response.has_header('Idempotent-Replayed'))
+
+        # A retry storm costs one lookup of the key(plus the user's groups)
+        with CaptureQueriesContext(connection) as context:
+            for i in range(3):
+                replayed = self.pay('key-1')
+                self.assertEqual(replayed.status_code, 201)
+                self.assertEqual(replayed['Idempotent-Replayed'], 'true')
+                self.assertEqual(replayed.json(), response.json())
+        self.assertFalse([
+            query for query in context.captured_queries if 'api_payment' in query['sql']
+        ])
+        self.assertEqual(Payment.objects.count(), 1)
+
+        # Keys are per user, and other keys run
+        self.assertEqual(self.pay('key-1', client=self.api_client(self.admin)).status_code, 201)
+        self.assertEqual(self.pay('key-2').status_code, 201)
+        self.assertEqual(Payment.objects.count(), 3)
+
+    def test_database_store(self):
+        self.assertReplayed(DatabaseStore(get_idempotency_config()))
+        self.assertEqual(IdempotencyKey.objects.count(), 3)
+
+    def test_cache_store(self):
+        self.assertReplayed(CacheStore('default', get_idempotency_config()))
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+    def test_key_reused_with_other_payload(self):
+        self.assertEqual(self.pay('key').status_code, 201)
+        response = self.pay('key', category=self.marathon.categories.last().pk)
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(response.data['detail'].code, 'idempotency_key_reused')
+        self.assertEqual(Payment.objects.count(), 1)
+
+    def test_key_in_flight(self):
+        retries = []
+        create = PaymentViewSet.perform_create
+
+        def perform_create(view, serializer):
+            # A client retries while the first request is writing
+            retries.append(self.pay('key'))
+            create(view, serializer)
+
+        with mock.patch.object(PaymentViewSet, 'perform_create', perform_create):
+            response = self.pay('key')
+        self.assertEqual(response.status_code, 201, response.content)
+        self.assertEqual(retries[0].status_code, 409)
+        self.assertEqual(retries[0]['Retry-After'], '1')
+        self.assertEqual(self.pay('key')['Idempotent-Replayed'], 'true')
+        self.assertEqual(Payment.objects.count(), 1)
+
+    def test_failed_requests_release_the_key(self):
+        response = self.pay('key', category=-1)
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(IdempotencyKey.objects.exists())
+        self.assertEqual(self.pay('key').status_code, 201)
+
+    def test_expired_keys(self):
+        self.assertEqual(self.pay('key').status_code, 201)
+        IdempotencyKey.objects.update(expires_at=timezone.now())
+        # Expired responses aren't replayed, the row is taken over
+        response = self.pay('key')
+        self.assertFalse(response.has_header('Idempotent-Replayed'))
+        self.assertEqual(Payment.objects.count(), 2)
+
+        IdempotencyKey.objects.update(expires_at=timezone.now())
+        out = io.StringIO()
+        call_command('purge_idempotency_keys', stdout=out)
+        self.assertIn('Deleted 1', out.getvalue())
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+    def test_register(self):
+        client = APIClient()
+        get_group_id('client')
+        payload = {
+            'username': 'runner', 'email': 'runner@marathon.com',
+            'password': 'password', 'role': 'client'
+        }
+        response = client.post('/register/', payload, HTTP_IDEMPOTENCY_KEY='signup')
+        self.assertEqual(response.status_code, 200, response.content)
+        # The key, then the token which isn't stored with the response
+        with self.assertNumQueries(2):
+            replayed = client.post('/register/', payload, HTTP_IDEMPOTENCY_KEY='signup')
+        self.assertEqual(replayed.data, response.data)
+        self.assertEqual(User.objects.filter(username='runner').count(), 1)
+        # The stored payload digest doesn't reveal the password
+        stored = json.dumps(list(IdempotencyKey.objects.values()), default=str)
+        self.assertNotIn('password', stored)
+        self.assertNotIn(response.data['token'], stored)
+
+    def test_invalid_key(self):
+        self.assertEqual(self.pay('').status_code, 400)
+        self.assertEqual(self.pay('k' * 256).status_code, 400)
+        self.assertFalse(Payment.objects.exists())
+
+
+class UserSearchTests(APITestCase):
+    terms = ('client', 'LIENT', 'ient-1', '@marathon.com', 'zzz', 'cl', 'organizer-1@')
+
+    def setUp(self):
+        super().setUp()
+        for i in range(12):
+            self.create_user('client', f'client-{i}')
+        self.create_user('organizer', 'organizer-1')
+
+    def grams(self, user):
+        return set(UserSearchGram.objects.filter(user=user).values_list('field', 'gram'))
+
+    def test_ngrams(self):
+        self.assertEqual(ngrams('Abcd'), {'abc', 'bcd'})
+        self.assertEqual(ngrams('Straße'), ngrams('STRASSE'))
+        self.assertEqual(ngrams('Jürgen'), ngrams('JURGEN'))
+        self.assertEqual(ngrams('ab'), set())
+        self.assertEqual(ngrams(None), set())
+
+    def test_grams_are_left_alone_on_postgresql(self):
+        # The table doesn't exist there
+        with mock.patch('api.models.uses_search_grams', return_value=False), \
+                CaptureQueriesContext(connection) as context:
+            user = self.create_user('client', 'runner')
+            user.email = 'runner@example.com'
+            user.save()
+            user.delete()
+            self.create_user('client', 'walker')
+            User.objects.filter(username='walker').delete()
+        self.assertFalse([
+            query for query in context.captured_queries if 'api_usersearchgram' in query['sql']
+        ])
+
+    @unittest.skipUnless(uses_search_grams(), "PostgreSQL uses trigram indexes")
+    def test_grams_follow_users(self):
+        user = User.objects.get(username='client-1')
+        expected = {('username', gram) for gram in ngrams('client-1')}
+        expected |= {('email', gram) for gram in ngrams('client-1@marathon.com')}
+        self.assertEqual(self.grams(user), expected)
+
+        user.email = 'runner@example.com'
+        user.save()
+        self.assertIn(('email', 'exa'), self.grams(user))
+        self.assertNotIn(('email', 'mar'), self.grams(user))
+        # Saving other fields leaves grams alone
+        with CaptureQueriesContext(connection) as context:
+            user.save(update_fields=['last_login'])
+        self.assertFalse([
+            query for query in context.captured_queries if 'api_usersearchgram' in query['sql']
+        ])
+
+        UserSearchGram.objects.all().delete()
+        out = io.StringIO()
+        call_command('rebuild_user_search', stdout=out)
+        self.assertEqual(self.grams(user), {
+            *{('username', gram) for gram in ngrams('client-1')},
+            *{('email', gram) for gram in ngrams('runner@example.com')}
+        })
+        pk = user.pk
+        user.delete()
+        self.assertFalse(UserSearchGram.objects.filter(user_id=pk).exists())
+
+    def test_search_matches_icontains(self):
+        for field in ('email', 'username'):
+            for term in self.terms:
+                expected = set(User.objects.filter(**{f'{field}__icontains': term}).values_list('pk', flat=True))
+                found = set(search_substring(User.objects.all(), field, term).values_list('pk', flat=True))
+                self.assertEqual(found, expected, (field, term))
+
+    def test_non_ascii_usernames(self):
+        user = self.create_user('client', 'Jürgen-Straße')
+        for term in ('jürgen', 'JÜRGEN', 'Jurgen', 'straße', 'STRASSE', 'gen-STR'):
+            # Collations folding case or accents(e.g MySQL) match these, so must grams
+            self.assertLessEqual(ngrams(term), ngrams(user.username), term)
+            expected = set(User.objects.filter(username__icontains=term).values_list('pk', flat=True))
+            found = set(search_substring(User.objects.all(), 'username', term).values_list('pk', flat=True))
+            self.assertEqual(found, expected, term)
+
+    @unittest.skipUnless(uses_search_grams(), "PostgreSQL uses trigram indexes")
+    def test_rarest_grams(self):
+        self.assertEqual(count_postings('default', 'username', {'t-1', 'zzz', 'cli'}), {
+            't-1': 3, 'zzz': 0, 'cli': 13
+        })
+        self.assertEqual(count_postings('default', 'username', {'cli'}, limit=5), {'cli': 5})
+        # Grams nobody has answer without querying users
+        with self.assertNumQueries(1):
+            self.assertFalse(search_substring(User.objects.all(), 'email', 'nobody'))
+
+    def test_users_filters(self):
+        client = self.api_client(self.admin)
+        response = client.get('/users/?username__icontains=ENT-1')
+        self.assertEqual(
+            sorted(user['username'] for user in response.data['results']),
+            ['client-1', 'client-10', 'client-11']
+        )
+        response = client.get('/users/?email__icontains=organizer-1@&username=organizer-1')
+        self.assertEqual([user['username'] for user in response.data['results']], ['organizer-1'])
+        response = client.get('/users/?email=client-2@marathon.com')
+        self.assertEqual(response.data['count'], 1)
+
+
+class ThrottlingTests(APITestCase):
+    scopes = {
+        'auth': {'RATE': '3/min', 'BURST': 3},
+        'auth_username': {'RATE': '1/min', 'BURST': 1},
+        'reads': {'RATE': '2/min', 'BURST': 2},
+        'payments': {'RATE': '1/min', 'BURST': 1},
+    }
+
+    def use_limiter(self, **kwargs):
+        limiter = RateLimiter(self.scopes, **kwargs)
+        patcher = mock.patch.object(TokenBucketThrottle, 'limiter', limiter)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return limiter
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=2, capacity=2, now=0)
+        self.assertEqual((bucket.take(0), bucket.take(0)), (0, 0))
+        self.assertEqual(bucket.take(0), 0.5)
+        # Refilled at `rate` up to `capacity`
+        self.assertEqual(bucket.take(0.5), 0)
+        self.assertEqual(bucket.take(100), 0)
+        self.assertEqual(bucket.tokens, 1)
+        bucket.drain(10, 100)
+        self.assertEqual(bucket.tokens, -2)
+        self.assertEqual(bucket.take(100), 1.5)
+
+    def test_reads(self):
+        limiter = self.use_limiter()
+        self.create_marathon()
+        client = self.api_client(self.client_user)
+        self.assertEqual([client.get('/marathons/').status_code for i in range(2)], [200, 200])
+        response = client.get('/marathons/')
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '30')
+        # Buckets are per user and scope
+        self.assertEqual(self.api_client(self.admin).get('/marathons/').status_code, 200)
+        self.assertEqual(client.post('/marathons/', {}).status_code, 403)
+
+        stats = limiter.stats()
+        self.assertEqual(stats['reads'], {'allowed': 3, 'throttled': 1, 'buckets': 2})
+
+    @override_settings(ROOT_URLCONF='asgi_urls')
+    async def test_async_reads(self):
+        await sync_to_async(self.use_limiter)()
+        await sync_to_async(self.create_marathon)()
+        headers = {'Authorization': f'Token {self.client_user.auth_token.key}'}
+        statuses = [(await AsyncClient().get('/marathons/', headers=headers)).status_code for i in range(3)]
+        self.assertEqual(statuses, [200, 200, 429])
+
+    def test_writes(self):
+        limiter = self.use_limiter()
+        marathon = self.create_marathon()
+        client = self.api_client(self.client_user)
+        payload = {'marathon': marathon.pk, 'category': marathon.categories.first().pk}
+        self.assertEqual(client.post('/payments/', payload).status_code, 201)
+        self.assertEqual(client.post('/payments/', payload).status_code, 429)
+        self.assertEqual(Payment.objects.count(), 1)
+
+        # Logins and registrations are per IP and username
+        client = APIClient()
+        credentials = {'username': 'client', 'password': 'password'}
+        self.assertEqual(client.post('/auth/', credentials).status_code, 200)
+        self.assertEqual(client.post('/auth/', credentials).status_code, 429)
+        self.assertEqual(client.post('/auth/', credentials, REMOTE_ADDR='10.0.0.1').status_code, 200)
+        # e.g users behind one NAT
+        credentials = {'username': 'admin', 'password': 'password'}
+        self.assertEqual(client.post('/auth/', credentials).status_code, 200)
+        # On top of a bucket per IP, rotating usernames doesn't get around it
+        credentials = {'username': 'organizer', 'password': 'password'}
+        self.assertEqual(client.post('/auth/', credentials).status_code, 429)
+        self.assertEqual(limiter.stats()['auth_username']['buckets'], 3)
+
+    def test_shared_buckets(self):
+        workers = [RateLimiter(self.scopes, shared_alias='default', sync_interval=0) for i in range(2)]
+        self.assertEqual(workers[0].allow('reads', 'user:1'), 0)
+        self.assertEqual(workers[1].allow('reads', 'user:1'), 0)
+        # Both synced once, the next sync drains what the other worker took
+        self.assertEqual(workers[0].allow('reads', 'user:1'), 0)
+        self.assertGreater(workers[0].allow('reads', 'user:1'), 0)
+        self.assertGreater(workers[1].allow('reads', 'user:1'), 0)
+        self.assertEqual(workers[0].stats()['reads']['shared'], {'allowed': 3, 'throttled': 2})
+
+
+class RequestMetricsTests(APITestCase):
+    def test_no_server_timing_by_default(self):
+        response = self.api_client(self.admin).get('/users/')
+        self.assertNotIn('Server-Timing', response)
+
+    @override_settings(REQUEST_METRICS={'SERVER_TIMING': 'staff'})
+    def test_server_timing_for_staff(self):
+        self.assertNotIn('Server-Timing', self.api_client(self.client_user).get('/marathons/'))
+        self.assertNotIn('Server-Timing', self.client.get('/marathons/'))
+        self.client_user.is_staff = True
+        self.client_user.save()
+        self.assertIn('Server-Timing', self.api_client(self.client_user).get('/marathons/'))
+
+    @override_settings(REQUEST_METRICS={'SERVER_TIMING': True})
+    def test_server_timing(self):
+        self.create_marathon()
+        response = self.api_client(self.client_user).get('/marathons/')
+        timings = dict(
+            metric.split(';', 1) for metric in response['Server-Timing'].split(', ')
+        )
+        for phase in ('auth', 'permissions', 'db', 'serializer', 'render', 'total'):
+            self.assertTrue(timings[phase].startswith('dur='), phase)
+        self.assertNotEqual(timings['queries'], 'desc="0"')
+
+    @override_settings(REQUEST_METRICS={'SLOW_REQUEST_THRESHOLD': 0})
+    def test_slow_requests_are_logged(self):
+        with self.assertLogs('api.requests') as logs:
+            self.api_client(self.admin).get('/users/')
+        record = json.loads(logs.output[-1].split(':', 2)[2])
+        self.assertEqual(record['event'], 'slow_request')
+        self.assertEqual(record['path'], '/users/')
+        self.assertEqual(len(record['slowest_queries']), min(5, record['queries']))
+        for query in record['slowest_queries']:
+            self.assertIsNone(re.search(r'%s|\b\d+\b', query['fingerprint']))
+
+    def test_duplicate_queries(self):
+        metrics = RequestMetrics()
+        for user_id in range(3):
+            metrics.add_query(
+                'SELECT "auth_group"."name" FROM "auth_group" WHERE "user_id" = %s', 0.001
+            )
+        metrics.add_query('SELECT 1', 0.001)
+        self.assertEqual(metrics.duplicates(3), {
+            'SELECT "auth_group"."name" FROM "auth_group" WHERE "user_id" = ?': 3
+        })
+
+    @override_settings(REQUEST_METRICS={'SLOW_REQUEST_THRESHOLD': None})
+    def test_duplicate_query_threshold_per_view(self):
+        with self.assertNoLogs('api.requests', 'WARNING'):
+            self.api_client(self.admin).get('/users/')
+        with mock.patch.object(UserViewSet, 'duplicate_query_threshold', 1, create=True):
+            with self.assertLogs('api.requests', 'WARNING') as logs:
+                self.api_client(self.admin).get('/users/')
+        self.assertTrue(all('duplicate_queries' in output for output in logs.output))
+
+    def test_fingerprint(self):
+        self.assertEqual(
+            fingerprint("SELECT * FROM t1 WHERE id IN (%s, %s,%s) AND name = 'x' LIMIT 21"),
+            "SELECT * FROM t1 WHERE id IN (...) AND name = ? LIMIT ?"
+        )
+
+
+class AuthenticationTests(APITestCase):
+    def test_register(self):
+        client = APIClient()
+        get_group_id('client')
+        # Unique username check, then user, token, search grams(but on PostgreSQL)
+        # and membership inserts in a transaction
+        with self.assertNumQueries(7 if uses_search_grams() else 6):
+            response = client.post('/register/', {
+                'username': 'runner', 'email': 'runner@marathon.com',
+                'password': 'password', 'role': 'client'
+            })
+        self.assertEqual(response.status_code, 200, response.content)
+
+        user = User.objects.with_roles().get(username='runner')
+        self.assertEqual(response.data['token'], Token.objects.get(user=user).key)
+        self.assertEqual(
+            (response.data['is_admin'], response.data['is_organizer'], response.data['is_client']),
+            (False, False, True)
+        )
+        self.assertEqual(response.data['payments'], [])
+        self.assertTrue(user.check_password('password'))
+        self.assertTrue(user.is_client)
+
+    def token_client(self, user):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Token {Token.objects.get(user=user).key}')
+        self.assertEqual(client.get('/marathons/').status_code, 200)
+        return client
+
+    def test_cached_tokens_are_revoked(self):
+        client = self.token_client(self.admin)
+        Token.objects.filter(user=self.admin).delete()
+        self.assertEqual(client.get('/marathons/').status_code, 401)
+
+        client = self.token_client(self.organizer)
+        self.organizer.is_active = False
+        self.organizer.save()
+        self.assertEqual(client.get('/marathons/').status_code, 401)
+
+    def test_token_cache_staleness_across_workers(self):
+        self.assertEqual(TokenCache(10, ttl=300).local.ttl, 300)
+        workers = [TokenCache(10, ttl=300, shared_alias='default') for i in range(2)]
+        self.assertEqual(workers[0].local.ttl, TokenCache.SHARED_LOCAL_TTL)
+
+        now = time.monotonic()
+        with mock.patch('api.cache.time.monotonic', return_value=now):
+            workers[0].set('key', 'snapshot')
+            self.assertEqual(workers[1].get('key'), 'snapshot')
+            workers[0].invalidate(['key'])
+            # Still in the other worker's memory
+            self.assertEqual(workers[1].get('key'), 'snapshot')
+        with mock.patch('api.cache.time.monotonic', return_value=now + TokenCache.SHARED_LOCAL_TTL + 1):
+            self.assertIsNone(workers[1].get('key'))
+
+    def test_cached_tokens_leave_passwords_out(self):
+        key = Token.objects.get(user=self.client_user).key
+        CachedTokenAuthentication().authenticate_credentials(key)
+        created, values = token_cache.get(key)
+        self.assertNotIn(self.client_user.password, values)
+
+        user, token = CachedTokenAuthentication().authenticate_credentials(key)
+        # Loaded when needed
+        with self.assertNumQueries(1):
+            self.assertTrue(user.check_password('password'))
+
+    def test_removed_groups_revoke_access(self):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Token {Token.objects.get(user=self.admin).key}')
+        self.assertEqual(client.get('/users/').status_code, 200)
+
+        User.objects.get(pk=self.admin.pk).groups.remove(Group.objects.get(name='admin'))
+        self.assertEqual(client.get('/users/').status_code, 403)
+        User.objects.get(pk=self.admin.pk).groups.add(Group.objects.get(name='admin'))
+        self.assertEqual(client.get('/users/').status_code, 200)
+        # From the group side too
+        Group.objects.get(name='admin').user_set.clear()
+        self.assertEqual(client.get('/users/').status_code, 403)
+
+    def test_login(self):
+        client = APIClient()
+        # Credentials, then roles with token and payments
+        with self.assertNumQueries(3):
+            response = client.post('/auth/', {'username': 'organizer', 'password': 'password'})
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response.data['token'], Token.objects.get(user=self.organizer).key)
+        self.assertTrue(response.data['is_organizer'])
+
+
+class HashingPoolTests(APITestCase):
+    def test_hashes_match_django(self):
+        self.assertEqual(
+            PooledPBKDF2PasswordHasher().encode('password', 'salt', 1000),
+            PBKDF2PasswordHasher().encode('password', 'salt', 1000)
+        )
+        stats = hashing_pool.stats()
+        self.assertEqual(stats['in_flight'], 0)
+        self.assertGreater(stats['completed'], 0)
+
+    def test_saturated_pool(self):
+        self.create_marathon()
+        capacity = hashing_pool.workers + hashing_pool.max_queue
+        for i in range(capacity):
+            hashing_pool.slots.acquire()
+        try:
+            response = APIClient().post('/auth/', {'username': 'client', 'password': 'password'})
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response['Retry-After'], str(hashing_pool.retry_after))
+            # Reads don't hash passwords
+            response = self.api_client(self.client_user).get('/marathons/')
+            self.assertEqual(response.status_code, 200)
+        finally:
+            for i in range(capacity):
+                hashing_pool.slots.release()
+
+        response = APIClient().post('/auth/', {'username': 'client', 'password': 'password'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_timed_out_hash(self):
+        done = threading.Event()
+        self.addCleanup(done.set)
+
+        def slow_pbkdf2(*args):
+            done.wait()
+            return b''
+
+        with mock.patch('api.hashers.pbkdf2', slow_pbkdf2), \
+                mock.patch.object(hashing_pool, 'timeout', 0.05):
+            response = APIClient().post('/auth/', {'username': 'client', 'password': 'password'})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], str(hashing_pool.retry_after))
+
+    def test_timed_out_hashes_hold_their_slot(self):
+        pool = HashingPool(workers=1, max_queue=1, timeout=0.05)
+        running, queued = threading.Event(), threading.Event()
+        self.addCleanup(pool.executor.shutdown)
+        self.addCleanup(running.set)
+        self.addCleanup(queued.set)
+        with self.assertRaises(HashingPoolSaturated):
+            pool.run(running.wait)
+        with self.assertRaises(HashingPoolSaturated):
+            pool.run(queued.wait)
+        self.assertEqual(pool.stats()['timed_out'], 2)
+        # The running hash keeps its slot, the queued one was cancelled
+        self.assertEqual(pool.stats()['in_flight'], 1)
+        self.assertTrue(pool.slots.acquire(blocking=False))
+        with self.assertRaises(HashingPoolSaturated):
+            pool.run(int)
+        pool.slots.release()
+
+        running.set()
+        deadline = time.monotonic() + 5
+        while pool.stats()['in_flight'] and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(pool.stats()['in_flight'], 0)
+        self.assertEqual(pool.run(int, '42'), 42)
+        self.assertEqual(pool.stats()['completed'], 1)
+
+
+class PaymentOrganizerMigrationTests(TransactionTestCase):
+    before = [('api', '0006_marathonstats')]
+    after = [('api', '0007_auto_20261018_0357')]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes('api'))
+        super().tearDown()
+
+    def test_organizers_are_backfilled(self):
+        apps = self.migrate(self.before)
+        User = apps.get_model('api', 'User')
+        Marathon = apps.get_model('api', 'Marathon')
+        Category = apps.get_model('api', 'Category')
+        Payment = apps.get_model('api', 'Payment')
+        now = timezone.now()
+        expected = {}
+        for index in range(2):
+            organizer = User.objects.create(username=f'organizer-{index}')
+            marathon = Marathon.objects.create(
+                name='Marathon', organizer=organizer, start_date=now, end_date=now
+            )
+            category = Category.objects.create(name='FULL', price=10, currency='USD', marathon=marathon)
+            for status in ('PAID', 'UNPAID'):
+                payment = Payment.objects.create(
+                    marathon=marathon, category=category, user=organizer,
+                    status=status, validation_date=now
+                )
+                expected[payment.pk] = organizer.pk
+
+        Payment = self.migrate(self.after).get_model('api', 'Payment')
+        self.assertEqual(dict(Payment.objects.values_list('pk', 'organizer_id')), expected)
+
+
+class ReplicaRouterTests(TestCase):
+    def setUp(self):
+        self.pool = ReplicaPool({**get_replicas_config(), 'ALIASES': ['replica1', 'replica2']})
+        for alias in self.pool.aliases:
+            self.pool.status[alias] = (True, time.monotonic())
+        patcher = mock.patch('api.replicas.replica_pool', self.pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.router = ReplicaRouter()
+
+    def test_reads_outside_requests_use_the_primary(self):
+        self.assertIsNone(self.router.db_for_read(User))
+        self.assertEqual(self.router.db_for_write(User), 'default')
+
+    def test_round_robin_and_fallback(self):
+        aliases = set()
+        for i in range(2):
+            view = ReplicaReadsMixin()
+            view.enter_replicas()
+            try:
+                # Every read of a request goes to the replica picked for it
+                reads = {self.router.db_for_read(User) for i in range(4)}
+                self.assertEqual(len(reads), 1)
+                aliases |= reads
+                # Writes never go to replicas
+                self.assertEqual(self.router.db_for_write(User), 'default')
+            finally:
+                view.leave_replicas()
+        self.assertEqual(aliases, {'replica1', 'replica2'})
+        self.assertIsNone(self.router.db_for_read(User))
+
+        self.pool.mark_down('replica1')
+        token = use_replicas(self.pool.choose())
+        try:
+            self.assertEqual(self.router.db_for_read(User), 'replica2')
+        finally:
+            leave_replicas(token)
+
+        # Every replica is down, reads stay on the primary
+        self.pool.mark_down('replica2')
+        view = ReplicaReadsMixin()
+        view.enter_replicas()
+        self.assertIsNone(view.replica_token)
+        self.assertIsNone(self.router.db_for_read(User))
+
+    def test_health_checks_are_cached(self):
+        self.pool.status.clear()
+        with mock.patch.object(self.pool, 'check', return_value=False) as check:
+            self.assertIsNone(self.pool.choose())
+            self.assertIsNone(self.pool.choose())
+        # Once per replica, failed replicas are retried after `RETRY_AFTER`
+        self.assertEqual(check.call_count, 2)
+
+        self.pool.status['replica1'] = (False, time.monotonic() - self.pool.config['RETRY_AFTER'])
+        with mock.patch.object(self.pool, 'check', return_value=True):
+            self.assertEqual(self.pool.choose(), 'replica1')
+
+
+@unittest.skipUnless('replica1' in settings.DATABASES, "No replica configured(see `DATABASE_REPLICAS`)")
+class ReplicaTests(TransactionTestCase):
+    """
+    Requests against a replica mirroring the test database, replicas
+    need their own connections so data has to be committed.
+    """
+    databases = '__all__'
+
+    def setUp(self):
+        for alias in settings.CACHES:
+            caches[alias].clear()
+        token_cache.clear()
+        create_groups()
+        self.admin = User.objects.create_user('admin', 'admin@marathon.com', 'password')
+        self.admin.groups.add(Group.objects.get(name='admin'))
+        replica_pool.status.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def get(self, url, client=None):
+        queries = {'default': 0, 'replica1': 0}
+
+        def recorder(alias):
+            def record(execute, sql, params, many, context):
+                queries[alias] += 1
+                return execute(sql, params, many, context)
+            return record
+
+        # Connecting installs the metrics recorder, which must not end up inside ours
+        connections['replica1'].ensure_connection()
+        with connections['default'].execute_wrapper(recorder('default')), \
+                connections['replica1'].execute_wrapper(recorder('replica1')):
+            response = (client or self.client).get(url)
+        self.assertEqual(response.status_code, 200, response.content)
+        return queries
+
+    def test_reads_use_the_replica(self):
+        queries = self.get('/users/')
+        self.assertGreater(queries['replica1'], 0)
+
+    def test_reads_stick_to_the_primary_after_writes(self):
+        response = self.client.patch(f'/users/{self.admin.pk}/', {'first_name': 'Admin'})
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertIn(get_replicas_config()['COOKIE_NAME'], response.cookies)
+        self.assertEqual(self.get('/users/')['replica1'], 0)
+
+        # Token clients don't send the cookie, they are pinned by user in a
+        # cache all workers share(rather than the per worker default one)
+        client = APIClient()
+        client.force_authenticate(self.admin)
+        cache.clear()
+        self.assertEqual(self.get('/users/', client)['replica1'], 0)
+
+        caches[get_replicas_config()['PIN_CACHE']].clear()
+        self.client.cookies.clear()
+        self.assertGreater(self.get('/users/')['replica1'], 0)
+
+    def test_fallback_to_the_primary(self):
+        with mock.patch.object(replica_pool, 'check', return_value=False):
+            queries = self.get('/users/')
+        self.assertEqual(queries['replica1'], 0)
+
+        # Reads failing on a replica are retried on the primary
+        def fail(execute, sql, params, many, context):
+            raise OperationalError('replica went away')
+
+        replica_pool.status.clear()
+        connections['replica1'].ensure_connection()
+        with connections['replica1'].execute_wrapper(fail):
+            response = self.client.get('/users/')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(len(response.data['results']), 1)
@@ -0,0 +1,299 @@
+import math
+import time
+import hashlib
+import logging
+import threading
+import contextlib
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.throttling import BaseThrottle
+from rest_framework.permissions import SAFE_METHODS
+
+from .cache import LRUCache
+
+
+logger = logging.getLogger('api.throttling')
+
+DEFAULTS = {
+    # False lets every request through e.g for servers started by benchmarks
+    'ENABLED': True,
+    # Requests allowed per period and bucket size(requests in a burst) of every scope
+    'SCOPES': {
+        'auth': {'RATE': '120/min', 'BURST': 60},
+        'auth_username': {'RATE': '20/min', 'BURST': 10},
+        'reads': {'RATE': '1200/min', 'BURST': 200},
+        'payments': {'RATE': '60/min', 'BURST': 20},
+    },
+    # Alias of a cache in `CACHES` shared by all workers(None for per worker limits)
+    'SHARED_CACHE': None,
+    # Seconds between syncs of a bucket(and of counters) with the shared cache
+    'SYNC_INTERVAL': 1,
+    # Buckets kept per worker, the least recently used ones are dropped
+    'MAX_BUCKETS': 10000,
+}
+
+PERIODS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
+
+COUNTERS = ('allowed', 'throttled')
+
+
+def get_config():
+    return {**DEFAULTS, **getattr(settings, 'THROTTLING', {})}
+
+
+def parse_rate(rate):
+    """`'<requests>/<period>'` e.g `'100/min'` as requests per second"""
+    requests, period = rate.split('/')
+    return int(requests) / PERIODS[period[0]]
+
+
+class TokenBucket():
+    """
+    `capacity` tokens refilled at `rate` tokens per second, a request takes
+    one. `consumed` is what this worker took since its last sync, `seen`
+    the shared total of all workers at that sync.
+    """
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'consumed', 'synced', 'seen')
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+        self.consumed = 0
+        self.synced = now
+        self.seen = None
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now):
+        """Take a token, returns 0 or the seconds until one is available"""
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            self.consumed += 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def drain(self, count, now):
+        """Remove tokens taken by other workers, bursts are paid back by waiting"""
+        self.refill(now)
+        self.tokens = max(-self.capacity, self.tokens - count)
+
+
+class RateLimiter():
+    """
+    Token buckets per scope and client kept in process, so allowing a
+    request costs no round trip. With a shared cache every bucket adds its
+    consumption to a shared counter every `sync_interval` seconds and is
+    drained by what the other workers consumed meanwhile, limits are then
+    global up to what workers allow between two syncs.
+    """
+    def __init__(self, scopes, shared_alias=None, sync_interval=1, max_buckets=10000):
+        self.scopes = {
+            name: (parse_rate(scope['RATE']), scope['BURST']) for name, scope in scopes.items()
+        }
+        self.shared_alias = shared_alias
+        self.sync_interval = sync_interval
+        self.buckets = LRUCache(maxsize=max_buckets)
+        self.enabled = True
+        self._lock = threading.Lock()
+        self.counters = {name: Counter() for name in self.scopes}
+        self._unpublished = {name: Counter() for name in self.scopes}
+        self._published = time.monotonic()
+
+    @property
+    def shared(self):
+        if self.shared_alias is None:
+            return None
+        return caches[self.shared_alias]
+
+    @staticmethod
+    def shared_key(scope, ident):
+        return f'throttle:{scope}:{ident}'
+
+    @staticmethod
+    def counter_key(scope, counter):
+        return f'throttle:counters:{scope}:{counter}'
+
+    def allow(self, scope, ident):
+        """Take a token of `ident` in `scope`, returns 0 or the seconds to wait"""
+        if not self.enabled or scope not in self.scopes:
+            return 0.0
+        key = (scope, ident)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(*self.scopes[scope], now)
+                self.buckets.set(key, bucket)
+            consumed = None
+            if self.shared_alias is not None and now - bucket.synced >= self.sync_interval:
+                consumed, bucket.consumed, bucket.synced = bucket.consumed, 0, now
+            else:
+                wait, unpublished = self.take(scope, bucket, now)
+
+        if consumed is not None:
+            # Drained by the other workers before taking a token
+            self.sync(key, bucket, consumed)
+            with self._lock:
+                wait, unpublished = self.take(scope, bucket, now)
+        if unpublished is not None:
+            self.publish(unpublished)
+        return wait
+
+    def take(self, scope, bucket, now):
+        """Take a token of `bucket`, returns the wait and counters due for publishing"""
+        wait = bucket.take(now)
+        counter = 'throttled' if wait else 'allowed'
+        self.counters[scope][counter] += 1
+        self._unpublished[scope][counter] += 1
+        unpublished = None
+        if self.shared_alias is not None and now - self._published >= self.sync_interval:
+            unpublished, self._published = self._unpublished, now
+            self._unpublished = {name: Counter() for name in self.scopes}
+        return wait, unpublished
+
+    def incr(self, key, delta, timeout):
+        shared = self.shared
+        shared.add(key, 0, timeout)
+        try:
+            return shared.incr(key, delta)
+        except ValueError:
+            # Expired between `add` and `incr`
+            shared.set(key, delta, timeout)
+            return delta
+
+    def sync(self, key, bucket, consumed):
+        scope, ident = key
+        rate, capacity = self.scopes[scope]
+        # Kept while a bucket could still be partly empty
+        timeout = max(60, math.ceil(capacity / rate) * 2)
+        try:
+            total = self.incr(self.shared_key(scope, ident), consumed, timeout)
+        except Exception as error:
+            # Limits fall back to per worker ones while the cache is down
+            logger.warning("Couldn't sync rate limit bucket %s: %s", key, error)
+            with self._lock:
+                bucket.consumed += consumed
+            return
+
+        with self._lock:
+            if bucket.seen is not None:
+                # Less than seen means the counter expired, nobody else took tokens
+                others = max(0, total - consumed - bucket.seen)
+                bucket.drain(others, time.monotonic())
+            bucket.seen = total
+
+    def publish(self, unpublished):
+        try:
+            for scope, counters in unpublished.items():
+                for counter, delta in counters.items():
+                    if delta:
+                        self.incr(self.counter_key(scope, counter), delta, None)
+        except Exception as error:
+            logger.warning("Couldn't publish rate limit counters: %s", error)
+
+    def stats(self):
+        """Requests allowed and throttled per scope, by this worker and by all if shared"""
+        with self._lock:
+            stats = {
+                scope: {counter: counters[counter] for counter in COUNTERS}
+                for scope, counters in self.counters.items()
+            }
+        shared = {}
+        if self.shared is not None:
+            keys = [self.counter_key(scope, counter) for scope in self.scopes for counter in COUNTERS]
+            shared = self.shared.get_many(keys)
+        keys = self.buckets.keys()
+        for scope in self.scopes:
+            stats[scope]['buckets'] = sum(1 for key in keys if key[0] == scope)
+            if self.shared is not None:
+                stats[scope]['shared'] = {
+                    counter: shared.get(self.counter_key(scope, counter), 0) for counter in COUNTERS
+                }
+        return stats
+
+    def reset(self):
+        with self._lock:
+            self.buckets.clear()
+            for counters in (*self.counters.values(), *self._unpublished.values()):
+                counters.clear()
+
+
+CONFIG = get_config()
+
+rate_limiter = RateLimiter(
+    scopes=CONFIG['SCOPES'],
+    shared_alias=CONFIG['SHARED_CACHE'],
+    sync_interval=CONFIG['SYNC_INTERVAL'],
+    max_buckets=CONFIG['MAX_BUCKETS']
+)
+rate_limiter.enabled = CONFIG['ENABLED']
+
+
+@contextlib.contextmanager
+def unthrottled(limiter=rate_limiter):
+    """Let every request through in the block e.g for benchmarks"""
+    enabled = limiter.enabled
+    limiter.enabled = False
+    try:
+        yield
+    finally:
+        limiter.enabled = enabled
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """
+    Throttle of `rate_limiter` per user(or client IP when anonymous).
+    Views pick scopes in `throttle_scopes` for safe methods(`read`) and
+    the others(`write`), every view's reads are in the `reads` scope and
+    writes aren't throttled unless it says otherwise. Fields of the payload
+    in a view's `throttle_field_scopes` get a bucket per client and value
+    in their scope on top(e.g usernames of logins), so one username can't
+    use up a whole NAT's bucket and rotating usernames doesn't get around
+    the client's own bucket.
+    """
+    default_scopes = {'read': 'reads', 'write': None}
+    limiter = rate_limiter
+
+    def get_scope(self, request, view):
+        scopes = {**self.default_scopes, **getattr(view, 'throttle_scopes', {})}
+        return scopes['read' if request.method in SAFE_METHODS else 'write']
+
+    def get_ident(self, request):
+        user = request.user
+        if user is not None and user.is_authenticated:
+            return f'user:{user.pk}'
+        return f'ip:{super().get_ident(request)}'
+
+    def get_field_idents(self, request, view, ident):
+        """Scopes of `throttle_field_scopes` with the ident of their field's value"""
+        data = request.data
+        for field, scope in getattr(view, 'throttle_field_scopes', {}).items():
+            value = str(data.get(field, '') if hasattr(data, 'get') else '')
+            # Digested to bound the size of keys made of client input
+            yield scope, f'{ident}:{field}:{hashlib.md5(value.encode()).hexdigest()}'
+
+    def allow_request(self, request, view):
+        scope = self.get_scope(request, view)
+        if scope is None:
+            return True
+        ident = self.get_ident(request)
+        self.delay = self.limiter.allow(scope, ident)
+        if self.delay:
+            # Before making field buckets, a client rotating values can't
+            # push more of them through the LRU than its own bucket allows
+            return False
+        for field_scope, field_ident in self.get_field_idents(request, view, ident):
+            self.delay = self.limiter.allow(field_scope, field_ident)
+            if self.delay:
+                return False
+        return True
+
+    def wait(self):
+        return self.delay
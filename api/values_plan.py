@@ -0,0 +1,284 @@
+from types import SimpleNamespace
+from collections import defaultdict
+
+from django.db.models import Prefetch
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models.fields.related import ForeignObjectRel, ManyToManyRel
+from rest_framework.serializers import BaseSerializer, ListSerializer
+from rest_framework.relations import (
+    HyperlinkedIdentityField, ManyRelatedField, PrimaryKeyRelatedField
+)
+
+from .cache import LRUCache
+from .instrumentation import timed, TimedSerializerMixin
+from .response_cache import normalize_restql_query
+
+
+# Reversed in place of a pk to get the url of every row by substitution
+URL_PK_SENTINEL = '8a6c0e3f'
+
+_plans = LRUCache(maxsize=256)
+
+_UNSUPPORTED = object()
+
+
+class UnsupportedField(Exception):
+    """The plan can't express a field, the serializer has to be used"""
+
+
+class ValuesPlan():
+    """
+    Read only representation of a serializer compiled against `values()`
+    rows, it gives the same output as `to_representation` of the serializer
+    (after restql field selection) without building model instances.
+
+    Flat fields and nested to-one serializers are columns of the main
+    query, nested to-many serializers and pk lists are fetched with one
+    query per relation for the whole page and grouped by parent.
+
+    Read only properties can be computed from columns by declaring them in
+    `values_fields` of the serializer as `{name: (columns, function)}`.
+    """
+    def __init__(self, model, prefix='', columns=None):
+        self.model = model
+        self.prefix = prefix
+        self.pk_column = prefix + model._meta.pk.attname
+        self.columns = [] if columns is None else columns
+        self.fields = []
+        self.related = []
+        self.add_column(self.pk_column)
+
+    def add_column(self, name):
+        if name not in self.columns:
+            self.columns.append(name)
+        return name
+
+    @classmethod
+    def compile(cls, serializer, model=None, prefix='', columns=None):
+        if has_custom_representation(serializer):
+            raise UnsupportedField(serializer.field_name)
+        if getattr(serializer, 'dynamic_fields_mixin_kwargs', {}).get('return_pk'):
+            raise UnsupportedField(serializer.field_name)
+        # What restql does in `to_representation`, select fields of the query
+        serializer.is_ready_to_use_dynamic_fields = True
+        plan = cls(model or serializer.Meta.model, prefix, columns)
+        for field in serializer.fields.values():
+            if not field.write_only:
+                plan.add_field(serializer, field)
+        return plan
+
+    def add_field(self, serializer, field):
+        key = field.field_name
+        if isinstance(field, HyperlinkedIdentityField):
+            if field.lookup_field != 'pk':
+                raise UnsupportedField(key)
+            self.fields.append((key, 'url', field))
+            return
+
+        if len(field.source_attrs) != 1:
+            raise UnsupportedField(key)
+        source = field.source
+
+        computed = getattr(serializer, 'values_fields', {}).get(source)
+        if computed is not None:
+            if self.prefix:
+                # Computed columns may be annotations of the main queryset only
+                raise UnsupportedField(key)
+            columns, function = computed
+            columns = [self.add_column(column) for column in columns]
+            self.fields.append((key, 'computed', (columns, function)))
+            return
+
+        try:
+            model_field = self.model._meta.get_field(source)
+        except FieldDoesNotExist:
+            raise UnsupportedField(key) from None
+
+        if isinstance(field, (ListSerializer, ManyRelatedField)):
+            if self.prefix or not isinstance(model_field, ForeignObjectRel) \
+                    or isinstance(model_field, ManyToManyRel):
+                raise UnsupportedField(key)
+            fk = model_field.field.attname
+            accessor = model_field.get_accessor_name()
+            if isinstance(field, ListSerializer):
+                child = ValuesPlan.compile(field.child, model=model_field.related_model)
+                child.add_column(fk)
+                self.related.append(RelatedPlan(key, accessor, model_field.related_model, fk, child))
+            elif isinstance(field.child_relation, PrimaryKeyRelatedField) \
+                    and field.child_relation.pk_field is None:
+                self.related.append(RelatedPlan(key, accessor, model_field.related_model, fk))
+            else:
+                raise UnsupportedField(key)
+            self.fields.append((key, 'related', None))
+        elif not model_field.concrete or model_field.many_to_many:
+            raise UnsupportedField(key)
+        elif isinstance(field, BaseSerializer):
+            if not model_field.is_relation:
+                raise UnsupportedField(key)
+            column = self.add_column(self.prefix + source)
+            nested = ValuesPlan.compile(
+                field, model=model_field.related_model,
+                prefix=self.prefix + source + '__', columns=self.columns
+            )
+            self.fields.append((key, 'nested', (column, nested)))
+        elif isinstance(field, PrimaryKeyRelatedField):
+            if field.pk_field is not None:
+                raise UnsupportedField(key)
+            self.fields.append((key, 'column', self.add_column(self.prefix + source)))
+        elif model_field.is_relation:
+            raise UnsupportedField(key)
+        else:
+            column = self.add_column(self.prefix + source)
+            self.fields.append((key, 'value', (column, field.to_representation)))
+
+    def values(self, queryset):
+        """`queryset` as rows of the columns of this plan"""
+        return queryset.select_related(None).prefetch_related(None).values(*self.columns)
+
+    def joins(self):
+        for key, kind, spec in self.fields:
+            if kind == 'nested':
+                column, nested = spec
+                yield column
+                yield from nested.joins()
+
+    def restrict(self, queryset, required=()):
+        """
+        `queryset` loading only the columns and relations of this plan and
+        the `required` fields, for serializers fed with model instances.
+        """
+        annotations = queryset.query.annotations
+        columns = [column for column in self.columns if column not in annotations]
+        queryset = queryset.select_related(None).prefetch_related(None)
+        joins = list(self.joins())
+        if joins:
+            queryset = queryset.select_related(*joins)
+        if self.related:
+            queryset = queryset.prefetch_related(*[related.prefetch() for related in self.related])
+        return queryset.only(*columns, *required)
+
+    def bind(self, context, related):
+        """
+        Getters of every field for one response, urls depend on the
+        request and related items on the page.
+        """
+        pk_column = self.pk_column
+        getters = []
+        for key, kind, spec in self.fields:
+            if kind == 'column':
+                getter = lambda row, column=spec: row[column]
+            elif kind == 'value':
+                column, to_representation = spec
+                getter = lambda row, column=column, to_representation=to_representation: (
+                    None if row[column] is None else to_representation(row[column])
+                )
+            elif kind == 'url':
+                getter = url_getter(spec, context, pk_column)
+            elif kind == 'computed':
+                columns, function = spec
+                getter = lambda row, columns=columns, function=function: (
+                    function(*[row[column] for column in columns])
+                )
+            elif kind == 'nested':
+                column, nested = spec
+                nested_getters = nested.bind(context, related)
+                getter = lambda row, column=column, getters=nested_getters: (
+                    None if row[column] is None
+                    else {key: getter(row) for key, getter in getters}
+                )
+            else:
+                items = related[key]
+                getter = lambda row, items=items: items.get(row[pk_column], [])
+            getters.append((key, getter))
+        return getters
+
+    def fetch_related(self, rows, context):
+        ids = [row[self.pk_column] for row in rows]
+        return {
+            related.key: related.fetch(ids, context) if ids else {}
+            for related in self.related
+        }
+
+    def serialize(self, rows, context):
+        """Representations of `rows`(from `values()`) in the serializer's context"""
+        rows = list(rows)
+        related = self.fetch_related(rows, context)
+        with timed('serializer'):
+            getters = self.bind(context, related)
+            return [{key: getter(row) for key, getter in getters} for row in rows]
+
+
+class RelatedPlan():
+    """Items of a to-many relation(or their pks if `plan` is None) grouped by parent"""
+    def __init__(self, key, accessor, model, fk, plan=None):
+        self.key = key
+        self.accessor = accessor
+        self.model = model
+        self.fk = fk
+        self.plan = plan
+
+    def prefetch(self):
+        queryset = self.model._default_manager.order_by('pk')
+        if self.plan is None:
+            return Prefetch(self.accessor, queryset=queryset.only(self.fk))
+        return Prefetch(self.accessor, queryset=self.plan.restrict(queryset))
+
+    def fetch(self, ids, context):
+        # Ordered like the prefetches of the viewsets
+        queryset = self.model._default_manager.filter(**{f'{self.fk}__in': ids}).order_by('pk')
+        items = defaultdict(list)
+        if self.plan is None:
+            for parent, pk in queryset.values_list(self.fk, 'pk'):
+                items[parent].append(pk)
+            return items
+
+        rows = list(self.plan.values(queryset))
+        for row, item in zip(rows, self.plan.serialize(rows, context)):
+            items[row[self.fk]].append(item)
+        return items
+
+
+def has_custom_representation(serializer):
+    """Whether `to_representation` of `serializer` is overridden outside DRF and restql"""
+    for klass in type(serializer).__mro__:
+        if klass is TimedSerializerMixin or 'to_representation' not in vars(klass):
+            continue
+        return klass.__module__.partition('.')[0] not in ('rest_framework', 'django_restql')
+    return False
+
+
+def url_getter(field, context, pk_column):
+    request = context['request']
+    format = context.get('format')
+    if format and field.format and field.format != format:
+        format = field.format
+
+    url = field.get_url(SimpleNamespace(pk=URL_PK_SENTINEL), field.view_name, request, format)
+    if url is None or url.count(URL_PK_SENTINEL) != 1:
+        return lambda row: field.get_url(
+            SimpleNamespace(pk=row[pk_column]), field.view_name, request, format
+        )
+    start, end = url.split(URL_PK_SENTINEL)
+    return lambda row: start + str(row[pk_column]) + end
+
+
+def get_values_plan(serializer, request):
+    """
+    Compiled plan of `serializer`(an instance built for `request`) or
+    `None` if it has fields the plan can't express. Plans are cached per
+    serializer class and restql query.
+    """
+    query = request.GET.get('query')
+    key = (type(serializer), None if query is None else normalize_restql_query(query))
+    plan = _plans.get(key)
+    if plan is None:
+        try:
+            plan = ValuesPlan.compile(serializer)
+        except UnsupportedField:
+            plan = _UNSUPPORTED
+        _plans.set(key, plan)
+    return None if plan is _UNSUPPORTED else plan
+
+
+def clear_values_plans():
+    _plans.clear()
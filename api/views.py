@@ -1,8 +1,14 @@
-from rest_framework import viewsets, status
+import hashlib
+from calendar import timegm
+from collections import defaultdict
+
+from rest_framework import viewsets, status, serializers
 from rest_framework.response import Response
-from django.db.models import ProtectedError
-from django.contrib.auth.models import Group
-from django.shortcuts import get_object_or_404
+from rest_framework.decorators import action
+from django.db.models import ProtectedError, Max, Count, Prefetch
+from django.utils.cache import get_conditional_response, quote_etag
+from django.utils.http import http_date
+from rest_framework.generics import get_object_or_404
 from rest_framework.authtoken.models import Token
 from django_restql.mixins import EagerLoadingMixin
 from rest_framework.authtoken.views import ObtainAuthToken
@@ -10,18 +16,29 @@ from rest_framework.permissions import (
     IsAuthenticatedOrReadOnly, IsAuthenticated
 )
 from drf_guard.operators import And, Or, Not
-from drf_guard.permissions import HasRequiredGroups, HasRequiredPermissions
+from drf_guard.permissions import HasRequiredPermissions
 
 from .permissions import (
     IsAllowedUser, IsCategoryOwner, IsSponsorOwner, IsMarathonOwner,
-    IsPaymentOwner, IsAdminUser
+    IsPaymentOwner, IsAdminUser, HasRequiredGroups
 )
+from .principal import get_principal
+from .instrumentation import InstrumentedViewMixin
+from .replicas import ReplicaReadsMixin, pin_primary
+from .idempotency import idempotent_response
+from .throttling import TokenBucketThrottle
+from .search import UserFilterSet
+from .pagination import KeysetPagination
+from .values_plan import get_values_plan
+from .response_cache import marathon_response_cache, get_role_tier, normalize_restql_query
+from .export import PAYMENT_EXPORT_FIELDS, EXPORT_FORMATS, export_response
 from .models import (
     User, Category, Sponsor, Marathon, Payment
 )
 from .serializers import (
     UserSerializer, CategorySerializer, SponsorSerializer, 
-    MarathonSerializer, PaymentSerializer
+    MarathonSerializer, PaymentSerializer, BulkPaymentSerializer,
+    MarathonStatsSerializer
 )
 
 
@@ -42,6 +59,17 @@ def fields(*args):
     return lookup_fields
 
 
+def get_export_format(request):
+    """Get the export format requested through `?output=` query param"""
+    output = request.query_params.get('output', 'ndjson')
+    if output not in EXPORT_FORMATS:
+        formats = ", ".join(EXPORT_FORMATS)
+        raise serializers.ValidationError(
+            {"output": f"Invalid export format, choose one of {formats}."}
+        )
+    return output
+
+
 class HandleProtectedErrorMixin():
     def error_response(self, error):
         error_args = map(lambda arg: str(arg), error.args)
@@ -69,16 +97,250 @@ class HandleProtectedErrorMixin():
             return self.error_response(e)
 
 
-class LoginUser(ObtainAuthToken):
+class BareObjectMixin():
+    def get_bare_object(self):
+        """
+        Get the requested object without its related objects and check
+        object permissions on it, this is cheap enough to run before
+        answering from validators or caches.
+        """
+        if not hasattr(self, '_bare_object'):
+            lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+            queryset = self.filter_queryset(self.get_queryset()).select_related(None)
+            obj = get_object_or_404(
+                queryset.prefetch_related(None),
+                **{self.lookup_field: self.kwargs[lookup_url_kwarg]}
+            )
+            self.check_object_permissions(self.request, obj)
+            self._bare_object = obj
+        return self._bare_object
+
+
+class ConditionalGetMixin(BareObjectMixin):
+    """
+    Answer list and retrieve with `304 Not Modified` when the ETag(or
+    Last-Modified of retrieve) sent by the client still matches, these are
+    computed before anything is serialized. Lists are validated by the
+    generation of the view's `response_cache` when it has one, which every
+    write(deletes too) bumps so no query is needed, and by the count and
+    `max(updated_at)` of the rows otherwise. They carry no Last-Modified,
+    deleting a row doesn't move it back.
+    """
+    last_modified_field = 'updated_at'
+
+    def get_list_state(self, queryset):
+        generation = None
+        if getattr(self, 'response_cache', None) is not None:
+            generation = self.get_cache_generation()
+        if generation is not None:
+            return generation
+        state = queryset.order_by().aggregate(
+            last_modified=Max(self.last_modified_field), count=Count('pk')
+        )
+        return (state['last_modified'], state['count'])
+
+    async def aget_list_state(self, queryset):
+        generation = None
+        if getattr(self, 'response_cache', None) is not None:
+            generation = await self.aget_cache_generation()
+        if generation is not None:
+            return generation
+        state = await queryset.order_by().aaggregate(
+            last_modified=Max(self.last_modified_field), count=Count('pk')
+        )
+        return (state['last_modified'], state['count'])
+
+    def get_validators(self, request, state, last_modified=None):
+        # Cached bodies are keyed by the state too, see `ResponseCacheMixin`
+        self.validated_state = state
+        key = "|".join([request.build_absolute_uri(), request.accepted_media_type, str(state)])
+        etag = quote_etag(hashlib.md5(key.encode()).hexdigest())
+        if last_modified is not None:
+            last_modified = timegm(last_modified.utctimetuple())
+        return etag, last_modified
+
+    def set_validators(self, response, etag, last_modified):
+        if 200 <= response.status_code < 300 or response.status_code == 304:
+            response['ETag'] = etag
+            if last_modified is not None:
+                response['Last-Modified'] = http_date(last_modified)
+        return response
+
+    def conditional_response(self, request, etag, last_modified, get_response):
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = get_response()
+        return self.set_validators(response, etag, last_modified)
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        etag, last_modified = self.get_validators(request, self.get_list_state(queryset))
+        return self.conditional_response(
+            request, etag, last_modified,
+            lambda: super(ConditionalGetMixin, self).list(request, *args, **kwargs)
+        )
+
+    def retrieve(self, request, *args, **kwargs):
+        obj = self.get_bare_object()
+        last_modified = getattr(obj, self.last_modified_field)
+        etag, last_modified = self.get_validators(request, last_modified, last_modified)
+        return self.conditional_response(
+            request, etag, last_modified,
+            lambda: super(ConditionalGetMixin, self).retrieve(request, *args, **kwargs)
+        )
+
+
+class ResponseCacheMixin(BareObjectMixin):
+    """
+    Serve list and retrieve from `response_cache`, keyed by path,
+    normalized restql query, pagination params and role tier. Under
+    `ConditionalGetMixin` the state validators are computed from is part
+    of the key too, a body cached before a write(which another worker may
+    not have invalidated yet) is then a miss rather than served with the
+    new ETag.
+    """
+    response_cache = None
+    validated_state = None
+    cache_generation = None
+
+    def get_cache_generation(self):
+        # Read once per request, validators and the key share it
+        if self.cache_generation is None:
+            self.cache_generation = self.response_cache.generation()
+        return self.cache_generation
+
+    async def aget_cache_generation(self):
+        if self.cache_generation is None:
+            self.cache_generation = await self.response_cache.ageneration()
+        return self.cache_generation
+
+    def get_response_cache_parts(self, request):
+        params = sorted(
+            (key, normalize_restql_query(value) if key == 'query' else value)
+            for key, values in request.query_params.lists() for value in values
+        )
+        return (
+            request.build_absolute_uri(request.path), params,
+            get_role_tier(request.user), self.validated_state
+        )
+
+    def get_response_cache_key(self, request):
+        return self.response_cache.make_key(
+            *self.get_response_cache_parts(request), generation=self.get_cache_generation()
+        )
+
+    def cached_response(self, request, get_response):
+        response = None
+
+        def compute():
+            nonlocal response
+            response = get_response()
+            if response.status_code == status.HTTP_200_OK:
+                return response.data
+            return None
+
+        data = self.response_cache.get_or_compute(self.get_response_cache_key(request), compute)
+        if response is not None:
+            return response
+        return Response(data)
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(
+            request, lambda: super(ResponseCacheMixin, self).list(request, *args, **kwargs)
+        )
+
+    def retrieve(self, request, *args, **kwargs):
+        self.get_bare_object()
+        return self.cached_response(
+            request, lambda: super(ResponseCacheMixin, self).retrieve(request, *args, **kwargs)
+        )
+
+
+class ValuesListMixin():
+    """
+    Serve list from `values()` rows assembled by the compiled `ValuesPlan`
+    of the serializer instead of model instances and serializers, the output
+    is the same. Serializers are used when the plan can't express a field
+    and for renderers not in `values_plan_formats`(e.g the browsable API
+    needs them).
+    """
+    values_plan_formats = ('json', 'msgpack')
+
+    def get_values_plan(self):
+        if self.request.accepted_renderer.format not in self.values_plan_formats:
+            return None
+        return get_values_plan(self.get_serializer(), self.request)
+
+    def list(self, request, *args, **kwargs):
+        plan = self.get_values_plan()
+        if plan is None:
+            return super().list(request, *args, **kwargs)
+
+        rows = plan.values(self.filter_queryset(self.get_queryset()))
+        context = self.get_serializer_context()
+        page = self.paginate_queryset(rows)
+        if page is not None:
+            return self.get_paginated_response(plan.serialize(page, context))
+        return Response(plan.serialize(rows, context))
+
+
+class SelectedColumnsMixin():
+    """
+    Load only the columns and relations selected by the restql query on
+    reads served from model instances(e.g retrieve), using the plan of the
+    serializer. `required_columns` are loaded anyway for permissions and
+    validators.
+    """
+    required_columns = ()
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.request.method != 'GET' or self.action not in ('list', 'retrieve'):
+            return queryset
+        try:
+            plan = get_values_plan(self.get_serializer(), self.request)
+        except serializers.ValidationError:
+            # Reported by the serializer
+            return queryset
+        if plan is None:
+            return queryset
+        return plan.restrict(queryset, self.required_columns)
+
+
+class OwnerEagerLoadingMixin():
+    """
+    Select relations walked by owner permissions(e.g `obj.marathon`)
+    on detail actions, which are the ones checking object permissions.
+    """
+    owner_select_related = ()
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.detail and self.owner_select_related:
+            queryset = queryset.select_related(*self.owner_select_related)
+        return queryset
+
+
+class LoginUser(InstrumentedViewMixin, ObtainAuthToken):
     """API endpoint that allows users to login and obtain auth token."""
+    throttle_classes = (TokenBucketThrottle,)
+    throttle_scopes = {'write': 'auth'}
+    throttle_field_scopes = {'username': 'auth_username'}
+
     def post(self, request, *args, **kwargs):
         serializer = self.serializer_class(
             data=request.data,
             context={'request': request}
         )
         serializer.is_valid(raise_exception=True)
-        user = serializer.validated_data['user']
-        token, created = Token.objects.get_or_create(user=user)
+        # Roles and token in one query
+        user = User.objects.with_roles().select_related('auth_token').get(
+            pk=serializer.validated_data['user'].pk
+        )
+        try:
+            token = user.auth_token
+        except Token.DoesNotExist:
+            token = Token.objects.create(user=user)
         user_serializer = UserSerializer(user, context={'request': request})
         data = {
             'token': token.key,
@@ -87,9 +349,24 @@ class LoginUser(ObtainAuthToken):
         return Response(data)
 
 
-class RegisterUser(ObtainAuthToken):
+class RegisterUser(InstrumentedViewMixin, ObtainAuthToken):
     """API endpoint that allows users to register and obtain auth token."""
+    throttle_classes = (TokenBucketThrottle,)
+    throttle_scopes = {'write': 'auth'}
+    throttle_field_scopes = {'username': 'auth_username'}
+
     def post(self, request, *args, **kwargs):
+        return idempotent_response(
+            request, lambda: self.register(request),
+            secret_fields=('token',), restore=self.restore_token
+        )
+
+    def restore_token(self, data):
+        # Tokens aren't stored with responses of idempotency keys
+        token = Token.objects.get(user_id=data['id'])
+        return {'token': token.key, **data}
+
+    def register(self, request):
         serializer = UserSerializer(
             data=request.data,
             context={'request': request}
@@ -100,21 +377,22 @@ class RegisterUser(ObtainAuthToken):
         email = data.pop("email", "")
         password = data.pop("password")
         role = data.pop("role")
-        user = User.objects.create_user(username, email, password)
-        user.save()
-        user.groups.add(Group.objects.get(name=role))
-        token, created = Token.objects.get_or_create(user=user)
+        user = User.objects.create_user_with_role(username, email, password, role)
         user_serializer = UserSerializer(user, context={'request': request})
         data = {
-            'token': token.key,
+            'token': user.auth_token.key,
             **user_serializer.data
         }
-        return Response(data)
+        response = Response(data)
+        # The new user reads from the primary until replicas have the account
+        pin_primary(request, response, user)
+        return response
 
 
-class UserViewSet(HandleProtectedErrorMixin, viewsets.ModelViewSet):
+class UserViewSet(InstrumentedViewMixin, ReplicaReadsMixin, HandleProtectedErrorMixin,
+                  ValuesListMixin, SelectedColumnsMixin, EagerLoadingMixin, viewsets.ModelViewSet):
     """API endpoint that allows users to be viewed or edited."""
-    queryset = User.objects.all().order_by('-date_joined')
+    queryset = User.objects.with_roles().order_by('-date_joined')
     serializer_class = UserSerializer
     permission_classes = (HasRequiredGroups, HasRequiredPermissions)
     http_method_names = ['get', 'put', 'patch', 'delete']
@@ -143,16 +421,20 @@ class UserViewSet(HandleProtectedErrorMixin, viewsets.ModelViewSet):
          }
     }
 
-    filter_fields = fields(
-        'id', {'email': ['exact', 'icontains']}, 
-        {'username': ['exact', 'icontains']}
-    )
+    # Related lists are ordered by pk, like `ValuesPlan` fetches them
+    prefetch_related = {
+        'payments': Prefetch('payments', queryset=Payment.objects.order_by('pk'))
+    }
 
+    # `email` and `username` are exact or `icontains` through the substring index
+    filterset_class = UserFilterSet
 
-class CategoryViewSet(HandleProtectedErrorMixin, viewsets.ModelViewSet):
+
+class CategoryViewSet(InstrumentedViewMixin, ReplicaReadsMixin, HandleProtectedErrorMixin, OwnerEagerLoadingMixin, viewsets.ModelViewSet):
     """API endpoint that allows categories to be viewed or edited."""
     queryset = Category.objects.all().order_by('-id')
     serializer_class = CategorySerializer
+    owner_select_related = ('marathon',)
     permission_classes = (HasRequiredGroups, HasRequiredPermissions)
     groups_and_permissions = {
          'GET': {
@@ -183,15 +465,16 @@ class CategoryViewSet(HandleProtectedErrorMixin, viewsets.ModelViewSet):
          }
     }
 
-    filter_fields = fields(
+    filterset_fields = fields(
         'id', 
     )
 
 
-class SponsorViewSet(HandleProtectedErrorMixin, viewsets.ModelViewSet):
+class SponsorViewSet(InstrumentedViewMixin, ReplicaReadsMixin, HandleProtectedErrorMixin, OwnerEagerLoadingMixin, viewsets.ModelViewSet):
     """API endpoint that allows sponsors to be viewed or edited."""
     queryset = Sponsor.objects.all().order_by('-id')
     serializer_class = SponsorSerializer
+    owner_select_related = ('marathon',)
     permission_classes = (HasRequiredGroups, HasRequiredPermissions)
     groups_and_permissions = {
          'GET': {
@@ -222,15 +505,20 @@ class SponsorViewSet(HandleProtectedErrorMixin, viewsets.ModelViewSet):
          }
     }
 
-    filter_fields = fields(
+    filterset_fields = fields(
         'id', 
     )
 
 
-class MarathonViewSet(HandleProtectedErrorMixin, EagerLoadingMixin, viewsets.ModelViewSet):
+class MarathonViewSet(InstrumentedViewMixin, ReplicaReadsMixin, HandleProtectedErrorMixin,
+                      ConditionalGetMixin, ResponseCacheMixin, ValuesListMixin, SelectedColumnsMixin,
+                      EagerLoadingMixin, viewsets.ModelViewSet):
     """API endpoint that allows marathons to be viewed or edited."""
     queryset = Marathon.objects.all().order_by('-id')
     serializer_class = MarathonSerializer
+    required_columns = ('updated_at',)
+    pagination_class = KeysetPagination
+    response_cache = marathon_response_cache
     permission_classes = (HasRequiredGroups, HasRequiredPermissions)
     groups_and_permissions = {
          'GET': {
@@ -262,28 +550,89 @@ class MarathonViewSet(HandleProtectedErrorMixin, EagerLoadingMixin, viewsets.Mod
     }
 
     select_related = {'organizer': 'organizer'}
-    prefetch_related = {'sponsors': 'sponsors', 'categories': 'categories'}
+    prefetch_related = {
+        'sponsors': Prefetch('sponsors', queryset=Sponsor.objects.order_by('pk')),
+        'categories': Prefetch('categories', queryset=Category.objects.order_by('pk'))
+    }
 
-    filter_fields = fields(
+    filterset_fields = fields(
         'id'
     )
 
+    @action(detail=True, permission_classes=[IsAuthenticated, IsMarathonOwner | IsAdminUser])
+    def export(self, request, *args, **kwargs):
+        """Stream payments and participants of a marathon as NDJSON or CSV."""
+        output = get_export_format(request)
+        marathon = get_object_or_404(Marathon, pk=kwargs['pk'])
+        self.check_object_permissions(request, marathon)
+        payments = Payment.objects.filter(marathon=marathon).order_by('id')
+        return export_response(
+            payments, PAYMENT_EXPORT_FIELDS, output, f'marathon-{marathon.pk}-payments'
+        )
+
+    @action(detail=True, permission_classes=[IsAuthenticated, IsMarathonOwner | IsAdminUser])
+    def stats(self, request, *args, **kwargs):
+        """Registrations by category and status, and revenue by currency."""
+        marathon = get_object_or_404(Marathon, pk=kwargs['pk'])
+        self.check_object_permissions(request, marathon)
+        # Rows are kept at zero once their last payment moves on
+        rows = marathon.stats.filter(registrations__gt=0).select_related('category').order_by(
+            'category_id', 'status'
+        )
+
+        revenue = defaultdict(float)
+        for row in rows:
+            if row.status == 'PAID':
+                revenue[row.category.currency] += row.registrations * row.category.price
+
+        data = {
+            'registrations': MarathonStatsSerializer(rows, many=True).data,
+            'revenue': [
+                {'currency': currency, 'amount': amount}
+                for currency, amount in sorted(revenue.items())
+            ]
+        }
+        return Response(data)
+
 
-class PaymentViewSet(HandleProtectedErrorMixin, viewsets.ModelViewSet):
+class PaymentViewSet(InstrumentedViewMixin, ReplicaReadsMixin, HandleProtectedErrorMixin,
+                     ValuesListMixin, SelectedColumnsMixin, viewsets.ModelViewSet):
     """API endpoint that allows payments to be viewed or edited."""
     queryset = Payment.objects.all().order_by('-id')
     serializer_class = PaymentSerializer
+    required_columns = ('user', 'organizer')
+    pagination_class = KeysetPagination
     permission_classes = (HasRequiredGroups, HasRequiredPermissions)
+    throttle_scopes = {'write': 'payments'}
 
     def get_queryset(self):
         queryset = super().get_queryset()
         user = self.request.user
-        if user.is_admin:
+        principal = get_principal(user)
+        if principal.is_admin:
             return queryset
-        elif user.is_organizer:
-            return queryset.filter(marathon__organizer=user)
+        elif principal.is_organizer:
+            return queryset.filter(organizer=user)
         return queryset.filter(user=user)
 
+    def create(self, request, *args, **kwargs):
+        return idempotent_response(
+            request, lambda: super(PaymentViewSet, self).create(request, *args, **kwargs)
+        )
+
+    @action(detail=False, methods=['post'])
+    def bulk(self, request, *args, **kwargs):
+        """Register a list of payments at once, either all or none are created."""
+        serializer = BulkPaymentSerializer(
+            data=request.data,
+            many=True,
+            context=self.get_serializer_context()
+        )
+        serializer.is_valid(raise_exception=True)
+        payments = serializer.save()
+        data = self.get_serializer(payments, many=True).data
+        return Response(data, status=status.HTTP_201_CREATED)
+
     groups_and_permissions = {
          'GET': {
              'list': {
@@ -313,6 +662,13 @@ class PaymentViewSet(HandleProtectedErrorMixin, viewsets.ModelViewSet):
          }
     }
 
-    filter_fields = fields(
-        'id', 
-    )
\ No newline at end of file
+    filterset_fields = fields(
+        'id', 'marathon', 'status'
+    )
+
+    @action(detail=False, permission_classes=[IsAuthenticated])
+    def export(self, request, *args, **kwargs):
+        """Stream payments visible to the user(after filtering) as NDJSON or CSV."""
+        output = get_export_format(request)
+        payments = self.filter_queryset(self.get_queryset()).order_by('id')
+        return export_response(payments, PAYMENT_EXPORT_FIELDS, output, 'payments')
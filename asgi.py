@@ -12,5 +12,6 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'settings')
+os.environ.setdefault('MARATHON_ASGI', '1')
 
 application = get_asgi_application()
\ No newline at end of file
@@ -0,0 +1,14 @@
+"""
+URL Configuration used under ASGI, hot read endpoints are routed to async
+views and everything else falls through to the sync `urls`.
+"""
+from django.urls import path, include
+
+from api import async_views
+
+urlpatterns = [
+    path('marathons/', async_views.marathon_list),
+    path('marathons/<str:pk>/', async_views.marathon_detail),
+    path('payments/', async_views.payment_list),
+    path('', include('urls')),
+]
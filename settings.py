@@ -11,6 +11,8 @@ https://docs.djangoproject.com/en/3.0/ref/settings/
 """
 
 import os
+import tempfile
+from importlib.util import find_spec
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -45,6 +47,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.instrumentation.RequestMetricsMiddleware',
+    'api.compression.CompressionMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -56,7 +60,11 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
 ]
 
-ROOT_URLCONF = 'urls'
+# ASGI workers(see `asgi.py`) route hot read endpoints to async views
+if 'MARATHON_ASGI' in os.environ:
+    ROOT_URLCONF = 'asgi_urls'
+else:
+    ROOT_URLCONF = 'urls'
 
 TEMPLATES = [
     {
@@ -104,6 +112,44 @@ DATABASES = {
     'default': db_conf
 }
 
+# Read replicas, comma separated names of databases next to `default`
+# (e.g `DATABASE_REPLICAS=marathon_replica`) or paths of SQLite files
+replica_names = [name.strip() for name in os.environ.get('DATABASE_REPLICAS', '').split(',')]
+for index, name in enumerate(filter(None, replica_names)):
+    replica_conf = {**db_conf, 'NAME': name}
+    if name.endswith('.sqlite3'):
+        replica_conf = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': name}
+    DATABASES[f'replica{index + 1}'] = {
+        **replica_conf,
+        # Kept open across requests and checked before being reused
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+        # Tests read replicas from the test database of `default`
+        'TEST': {'MIRROR': 'default'},
+    }
+
+DATABASE_ROUTERS = ['api.replicas.ReplicaRouter']
+
+########## Read replicas ##########################
+REPLICAS = {
+    # Aliases in `DATABASES` safe method requests of viewsets read from,
+    # all but `default` if None
+    'ALIASES': None,
+    # Seconds reads of a user stick to the primary after they write
+    'STICKY_SECONDS': 5,
+    # Cookie pinning browsers and anonymous writers to the primary
+    'COOKIE_NAME': 'primary_until',
+    # Alias of the cache in `CACHES` shared by all workers which pins token clients
+    'PIN_CACHE': 'shared',
+    # Seconds between health checks of a replica, failed ones are
+    # skipped for `RETRY_AFTER` seconds
+    'HEALTH_CHECK_INTERVAL': 10,
+    'RETRY_AFTER': 30,
+    # Replicas lagging more seconds behind are skipped(PostgreSQL only)
+    'MAX_LAG': 5,
+}
+########## End of Read replicas ###################
+
 #Auth model
 AUTH_USER_MODEL = 'api.User'
 
@@ -112,11 +158,110 @@ CORS_ORIGIN_ALLOW_ALL = True
 CORS_ALLOW_CREDENTIALS = True
 ############ End of CORS Configs ###################
 
+########## Caches ##################################
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Shared by all workers of the host, use memcached or redis when
+    # workers run on several hosts
+    'shared': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(tempfile.gettempdir(), 'marathon-cache'),
+    },
+}
+########## End of Caches ###########################
+
+########## Token authentication cache ##############
+# Max number of tokens kept in each worker's memory
+TOKEN_AUTH_CACHE_SIZE = 10000
+# Seconds a cached token is trusted, revoked tokens and deactivated users
+# are invalidated in the worker making the change(and the shared tier), so
+# without a shared tier this bounds how long other workers still accept them
+TOKEN_AUTH_CACHE_TTL = 300
+# Alias of a shared cache in `CACHES` used as a second tier(None to disable)
+TOKEN_AUTH_SHARED_CACHE = None
+# Seconds a worker keeps tokens in memory, None is `TOKEN_AUTH_CACHE_TTL`
+# without a shared tier and 5 with one, which then bounds staleness
+TOKEN_AUTH_LOCAL_CACHE_TTL = None
+########## End of Token authentication cache #######
+
+########## Principal group memberships ############
+# Seconds group names of a user are cached, changes are invalidated in the
+# cache holding them so with a per worker one this bounds staleness in the others
+PRINCIPAL_GROUPS_CACHE_TIMEOUT = 300
+# Alias of the cache in `CACHES` holding them, shared by all workers so that
+# changes are seen by every worker right away
+PRINCIPAL_GROUPS_CACHE = 'shared'
+########## End of Principal group memberships #####
+
+########## Marathon response cache ################
+MARATHON_RESPONSE_CACHE = {
+    # Alias of a cache in `CACHES` shared by all workers, or 'local' for a
+    # per worker LRU(only with a single worker, invalidations aren't seen
+    # by the other workers)
+    'BACKEND': 'shared',
+    'TIMEOUT': 60,
+    'MAX_ENTRIES': 1000,
+    # Seconds other workers wait for the one recomputing a missing response,
+    # only with redis, memcached or 'local'(which have an atomic `add`)
+    'LOCK_TIMEOUT': 5,
+}
+########## End of Marathon response cache #########
+
+########## Idempotency keys ########################
+IDEMPOTENCY = {
+    # 'database' for the `IdempotencyKey` table or alias of a cache in `CACHES`
+    # shared by all workers e.g memcached or redis
+    'BACKEND': 'database',
+    # Seconds responses are replayed for repeats of an `Idempotency-Key`
+    'TTL': 24 * 60 * 60,
+    # Seconds a key stays locked by a request which never finished
+    'LOCK_TIMEOUT': 60,
+}
+########## End of Idempotency keys #################
+
+########## Rate limiting ###########################
+THROTTLING = {
+    # Servers started by `compare_servers` aren't throttled
+    'ENABLED': 'MARATHON_UNTHROTTLED' not in os.environ,
+    # Requests per period and burst of the scopes of `TokenBucketThrottle`,
+    # logins and registrations are per IP(`auth`, roomy for clients behind
+    # one NAT) and per IP and username(`auth_username`), reads and payment
+    # writes per user
+    'SCOPES': {
+        'auth': {'RATE': '120/min', 'BURST': 60},
+        'auth_username': {'RATE': '20/min', 'BURST': 10},
+        'reads': {'RATE': '1200/min', 'BURST': 200},
+        'payments': {'RATE': '60/min', 'BURST': 20},
+    },
+    # Alias of a cache in `CACHES` shared by all workers to sync buckets
+    # with every `SYNC_INTERVAL` seconds(None for per worker limits)
+    'SHARED_CACHE': None,
+    'SYNC_INTERVAL': 1,
+}
+########## End of Rate limiting ####################
+
+########## Request metrics #########################
+REQUEST_METRICS = {
+    # Send auth, permissions, db, serializer and render timings in a
+    # `Server-Timing` header, True for everyone or 'staff' for staff users
+    # only(they tell how a request was served, e.g whether a hash ran)
+    'SERVER_TIMING': False,
+    # Log requests slower than this many milliseconds to `api.requests`
+    'SLOW_REQUEST_THRESHOLD': 500,
+    'SLOWEST_QUERIES': 5,
+    # Log statements repeated this many times in a request(N+1 queries),
+    # views can set their own `duplicate_query_threshold`
+    'DUPLICATE_QUERY_THRESHOLD': 10,
+}
+########## End of Request metrics ##################
+
 REST_FRAMEWORK = {
     # Use Django's standard `django.contrib.auth` permissions,
     # or allow read-only access for unauthenticated users.
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'api.authentication.CachedTokenAuthentication',
     ],
 
     'DEFAULT_PERMISSION_CLASSES': [
@@ -126,10 +271,64 @@ REST_FRAMEWORK = {
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
 
     'PAGE_SIZE': 10,
+    # Token buckets per user(or IP) and scope, see `THROTTLING`
+    'DEFAULT_THROTTLE_CLASSES': [
+        'api.throttling.TokenBucketThrottle',
+    ],
     'DEFAULT_FILTER_BACKENDS': [
         'django_filters.rest_framework.DjangoFilterBackend',
     ],
+
+    # orjson renders the same bytes as DRF's `JSONRenderer`, MessagePack
+    # is offered when `msgpack` is installed
+    'DEFAULT_RENDERER_CLASSES': [
+        'api.renderers.ORJSONRenderer',
+        *(['api.renderers.MessagePackRenderer'] if find_spec('msgpack') else []),
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'api.parsers.ORJSONParser',
+        *(['api.parsers.MessagePackParser'] if find_spec('msgpack') else []),
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
+}
+
+########## Response compression ###################
+COMPRESSION = {
+    # Smaller responses are sent as they are
+    'MIN_SIZE': 1024,
+    # `br` is used only if `brotli` is installed
+    'ENCODINGS': ('br', 'gzip'),
+    'BROTLI_QUALITY': 4,
+    # Responses with tokens aren't compressed(BREACH)
+    'EXCLUDED_PATHS': ('/auth/', '/register/'),
+}
+########## End of Response compression ############
+
+PASSWORD_HASHERS = [
+    # PBKDF2 in a bounded pool(see `PASSWORD_HASHING_POOL`), it also verifies
+    # existing `pbkdf2_sha256` hashes so Django's hasher must not be listed
+    'api.hashers.PooledPBKDF2PasswordHasher',
+    'django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher',
+    'django.contrib.auth.hashers.Argon2PasswordHasher',
+    'django.contrib.auth.hashers.BCryptSHA256PasswordHasher',
+    'django.contrib.auth.hashers.ScryptPasswordHasher',
+]
+
+########## Password hashing pool ##################
+PASSWORD_HASHING_POOL = {
+    # 'thread'(PBKDF2 releases the GIL) or 'process'
+    'EXECUTOR': 'thread',
+    # Hashes computed at once per worker process
+    'WORKERS': 2,
+    # Hashes allowed to wait for a worker, more get `503` with `Retry-After`
+    'MAX_QUEUE': 32,
+    'RETRY_AFTER': 1,
+    # Seconds a request waits for its hash before getting `503` too
+    'TIMEOUT': 30,
 }
+########## End of Password hashing pool ###########
 
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators